@@ -0,0 +1,196 @@
+import itertools
+import math
+
+from spatial import SpatialGrid
+
+class Patrol(object):
+    # The walk of a dormant guard in closed form, back and forth between
+    # min_x and max_x, starting from x at start_time.
+    def __init__(self, x, y, face, speed, bounds, start_time):
+        self.x = x
+        self.y = y
+        self.face = face
+        self.speed = speed
+        self.min_x, self.min_y, self.max_x, self.max_y = bounds
+        self.start_time = start_time
+
+    def get_bounds(self):
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+    def get_args(self):
+        return (self.x, self.y, self.face, self.speed, self.get_bounds(),
+                self.start_time)
+
+    def get_position(self, time):
+        # Returns the x and face at the given time. The phase runs from 0 to
+        # twice the patrol length, walking right for the first half.
+        length = self.max_x - self.min_x
+        if not self.speed or length <= 0.0:
+            return self.x, self.face
+        phase = self.x - self.min_x
+        if self.face < 0:
+            phase = 2.0 * length - phase
+        phase += self.speed * (time - self.start_time)
+        phase %= 2.0 * length
+        if phase < length:
+            return self.min_x + phase, 1
+        else:
+            return self.max_x - (phase - length), -1
+
+class ActivationSystem(object):
+    # Puts guards that are far from the player to sleep. A dormant guard has
+    # its body disabled, does not think, step or probe, and patrols its
+    # platform in closed form. Guards in the air land on the ground below
+    # first, or stay where they are if there is none. A guard wakes up where
+    # the patrol has taken it once the player is within activation_radius,
+    # or within the corners of the view plus margin if that is further, so
+    # that dormant guards are never on screen. Guards fall asleep margin
+    # further out, so that guards at the border do not flip every step.
+    def __init__(self, game_engine, activation_radius=24.0, margin=4.0,
+                 max_patrol_length=64):
+        self.game_engine = game_engine
+        self.activation_radius = activation_radius
+        self.margin = margin
+        self.max_patrol_length = max_patrol_length
+        self.patrols = {}
+        self.patrol_grid = SpatialGrid()
+        self.indices = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.patrols)
+
+    def add(self, actor):
+        self.indices[actor] = next(self.counter)
+
+    def remove(self, actor):
+        del self.indices[actor]
+        if self.patrols.pop(actor, None) is not None:
+            self.patrol_grid.remove(actor)
+
+    def update(self):
+        game_engine = self.game_engine
+        player_x, player_y = game_engine.player_actor.body.position
+        radius = self.get_radius(player_x, player_y)
+        bounds = (player_x - radius, player_y - radius,
+                  player_x + radius, player_y + radius)
+        # Sort by index, so that guards wake up in the same order on replay.
+        actors = sorted(self.patrol_grid.query(bounds), key=self.indices.get)
+        for actor in actors:
+            patrol = self.patrols[actor]
+            x, face = patrol.get_position(game_engine.time)
+            if (x - player_x) ** 2 + (patrol.y - player_y) ** 2 < radius ** 2:
+                self.wake(actor)
+        sleep_distance = radius + self.margin
+        for actor in game_engine.active_character_actors:
+            if actor in self.indices:
+                x, y = actor.body.position
+                distance_squared = (x - player_x) ** 2 + (y - player_y) ** 2
+                if distance_squared > sleep_distance ** 2:
+                    self.sleep(actor)
+
+    def get_radius(self, x, y):
+        min_x, min_y, max_x, max_y = self.game_engine.get_view_bounds(x, y)
+        view_radius = 0.5 * math.hypot(max_x - min_x, max_y - min_y)
+        return max(self.activation_radius, view_radius + self.margin)
+
+    def sleep(self, actor):
+        game_engine = self.game_engine
+        x, y = actor.body.position
+        grounded = actor.state not in actor.air_states
+        if not grounded:
+            tiles = game_engine.level_actor.tiles
+            bottom = 2.0 * game_engine.level_actor.half_tile_height * (
+                tiles.min_y - 1)
+            ground_hit = game_engine.ground_probe.probe(x, y, y - bottom)
+            if ground_hit is not None:
+                (hit_x, hit_y), fraction, tile_index = ground_hit
+                y = hit_y + actor.radius
+                grounded = True
+        speed = 0.0
+        bounds = x, y, x, y
+        if grounded:
+            if actor.controls.left != actor.controls.right:
+                speed = actor.max_walk_velocity
+            bounds = self.get_patrol_bounds(actor, x, y)
+        patrol = Patrol(x, y, actor.face, speed, bounds, game_engine.time)
+        self.patrols[actor] = patrol
+        self.patrol_grid.insert(actor, bounds)
+        game_engine.sleep_actor(actor)
+
+    def wake(self, actor):
+        game_engine = self.game_engine
+        patrol = self.patrols.pop(actor)
+        self.patrol_grid.remove(actor)
+        x, face = patrol.get_position(game_engine.time)
+        y = patrol.y
+        rise = 2.0 * game_engine.level_actor.half_tile_height
+        length = patrol.max_y - patrol.min_y + actor.radius + 2.0 * rise
+        ground_hit = game_engine.ground_probe.probe(x, patrol.max_y + rise,
+                                                    length)
+        if ground_hit is not None:
+            (hit_x, hit_y), fraction, tile_index = ground_hit
+            y = hit_y + actor.radius
+        actor.body.position = x, y
+        actor.body.linearVelocity = face * patrol.speed, 0.0
+        actor.face = face
+        if ground_hit is None:
+            actor.state = actor.states.JUMP
+        elif patrol.speed:
+            actor.state = actor.states.WALK
+        else:
+            actor.state = actor.states.STAND
+        actor.controls.left = bool(patrol.speed) and face < 0
+        actor.controls.right = bool(patrol.speed) and face > 0
+        game_engine.wake_actor(actor)
+
+    def restore(self, actor, patrol_args):
+        # Puts a guard to sleep on a patrol made from the given arguments,
+        # or wakes it up where it is if there are none. Used when restoring
+        # checkpoints.
+        game_engine = self.game_engine
+        patrol = self.patrols.get(actor)
+        if (patrol is not None and patrol_args is not None and
+            patrol.get_args() == tuple(patrol_args)):
+            return
+        dormant = self.patrols.pop(actor, None) is not None
+        if dormant:
+            self.patrol_grid.remove(actor)
+        if patrol_args is None:
+            if dormant:
+                game_engine.wake_actor(actor)
+            return
+        patrol = Patrol(*patrol_args)
+        self.patrols[actor] = patrol
+        self.patrol_grid.insert(actor, patrol.get_bounds())
+        if not dormant:
+            game_engine.sleep_actor(actor)
+
+    def get_patrol_bounds(self, actor, x, y):
+        # Follows the ground tile by tile in both directions, up and down
+        # slopes, until it ends or steps by more than a tile.
+        game_engine = self.game_engine
+        probe = game_engine.ground_probe.probe
+        step = 2.0 * game_engine.level_actor.half_tile_width
+        rise = 2.0 * game_engine.level_actor.half_tile_height
+        length = actor.radius + 2.0 * rise
+        min_y = max_y = y
+        end_xs = []
+        for direction in (-1, 1):
+            end_x = x
+            end_y = y
+            for _ in xrange(self.max_patrol_length):
+                ground_hit = probe(end_x + direction * step, end_y + rise,
+                                   length)
+                if ground_hit is None:
+                    break
+                (hit_x, hit_y), fraction, tile_index = ground_hit
+                next_y = hit_y + actor.radius
+                if abs(next_y - end_y) > rise:
+                    break
+                end_x += direction * step
+                end_y = next_y
+                min_y = min(min_y, end_y)
+                max_y = max(max_y, end_y)
+            end_xs.append(end_x)
+        return end_xs[0], min_y, end_xs[1], max_y
@@ -0,0 +1,262 @@
+import argparse
+from array import array
+import json
+import multiprocessing
+import sys
+from timeit import default_timer
+
+from cnd.headless import init_pyglet
+
+init_pyglet()
+
+from cnd.main import GameEngine, configure_logging
+from cnd.profiler import Profiler
+
+class RunResult(object):
+    # The metrics of one simulation. Coverage counts the guard steps spent
+    # in each tile of the level, stored like the tile grid.
+    def __init__(self, level_name, seed, step_count, guard_count, tiles):
+        self.level_name = level_name
+        self.seed = seed
+        self.step_count = step_count
+        self.guard_count = guard_count
+        self.tiles = tiles
+        self.coverage = array('I', [0]) * (tiles.width * tiles.height)
+        self.detections = []
+        self.phase_times = {}
+        self.run_time = 0.0
+
+    @property
+    def first_detection_step(self):
+        if not self.detections:
+            return None
+        return self.detections[0][0]
+
+    def to_json(self):
+        return json.dumps({'level': self.level_name, 'seed': self.seed,
+                           'steps': self.step_count,
+                           'guards': self.guard_count,
+                           'detections': self.detections,
+                           'phase_times': self.phase_times,
+                           'run_time': self.run_time}, sort_keys=True)
+
+def run_simulation(task):
+    # Runs one headless simulation. Takes a tuple, so that it can be mapped
+    # over a process pool.
+    level_name, seed, step_count, guard_count, activation_radius = task
+    dt = 1.0 / 60.0
+    profiler = Profiler(GameEngine.phase_names, GameEngine.counter_names,
+                        window_size=None)
+    profiler.enabled = True
+    game_engine = GameEngine(640, 480, level_name=level_name,
+                             guard_count=guard_count, seed=seed,
+                             profiler=profiler,
+                             activation_radius=activation_radius, dt=dt)
+    level_actor = game_engine.level_actor
+    tiles = level_actor.tiles
+    result = RunResult(level_name, seed, step_count,
+                       len(game_engine.guard_actors), tiles)
+    coverage = result.coverage
+    seen_actors = set()
+    start_time = default_timer()
+    for step_index in xrange(step_count):
+        game_engine.step(dt)
+        for actor in game_engine.active_character_actors:
+            if actor in game_engine.ais:
+                tile_x, tile_y = level_actor.get_tile_position(
+                    *actor.body.position)
+                if tiles.in_bounds(tile_x, tile_y):
+                    coverage[tiles.get_index(tile_x, tile_y)] += 1
+        vision_system = game_engine.vision_system
+        for actor, visible, distance in zip(game_engine.observer_actors,
+                                            vision_system.visible,
+                                            vision_system.distances):
+            if visible and actor not in seen_actors:
+                result.detections.append((step_index, actor.name, distance))
+                seen_actors.add(actor)
+            elif not visible:
+                seen_actors.discard(actor)
+    result.run_time = default_timer() - start_time
+    for phase_name in profiler.phase_names:
+        result.phase_times[phase_name] = sum(profiler.samples[phase_name])
+    game_engine.delete()
+    return result
+
+class LevelSummary(object):
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.coverage = array('L', [0]) * (tiles.width * tiles.height)
+        self.run_count = 0
+        self.step_count = 0
+        self.detection_count = 0
+        self.first_detection_steps = []
+
+    def add(self, result):
+        self.run_count += 1
+        self.step_count += result.step_count
+        self.detection_count += len(result.detections)
+        if result.first_detection_step is not None:
+            self.first_detection_steps.append(result.first_detection_step)
+        coverage = self.coverage
+        for i, count in enumerate(result.coverage):
+            if count:
+                coverage[i] += count
+
+    def get_heatmap(self):
+        # One line per tile row from the top, with the level tiles where no
+        # guard has been.
+        shades = '.:-=+*%@'
+        tiles = self.tiles
+        max_count = max(self.coverage) if self.coverage else 0
+        lines = []
+        for j in reversed(xrange(tiles.height)):
+            line = []
+            for i in xrange(tiles.width):
+                count = self.coverage[j * tiles.width + i]
+                if count:
+                    shade = (len(shades) - 1) * count // max_count
+                    line.append(shades[shade])
+                else:
+                    value = tiles.data[j * tiles.width + i]
+                    line.append(chr(value) if value else ' ')
+            lines.append(''.join(line).rstrip())
+        return '\n'.join(lines)
+
+class BatchResult(object):
+    def __init__(self):
+        self.levels = {}
+        self.run_count = 0
+        self.step_count = 0
+        self.phase_times = {}
+        self.run_time = 0.0
+        self.wall_time = 0.0
+
+    def add(self, result):
+        summary = self.levels.get(result.level_name)
+        if summary is None:
+            summary = LevelSummary(result.tiles)
+            self.levels[result.level_name] = summary
+        summary.add(result)
+        self.run_count += 1
+        self.step_count += result.step_count
+        for phase_name, phase_time in result.phase_times.iteritems():
+            self.phase_times[phase_name] = (
+                self.phase_times.get(phase_name, 0.0) + phase_time)
+        self.run_time += result.run_time
+
+    def report(self, report_file, heatmaps=False):
+        report_file.write('runs: %d, steps: %d, wall time: %.2f s\n' %
+                          (self.run_count, self.step_count, self.wall_time))
+        report_file.write('steps/sec: %.1f (%.1f per worker)\n' %
+                          (self.step_count / max(self.wall_time, 1e-9),
+                           self.step_count / max(self.run_time, 1e-9)))
+        report_file.write('%-14s %9s\n' % ('phase (ms)', 'mean'))
+        for phase_name in GameEngine.phase_names:
+            phase_time = self.phase_times.get(phase_name)
+            if phase_time:
+                report_file.write('%-14s %9.3f\n' %
+                                  (phase_name, 1000.0 * phase_time /
+                                   max(self.step_count, 1)))
+        for level_name in sorted(self.levels):
+            summary = self.levels[level_name]
+            steps = sorted(summary.first_detection_steps)
+            report_file.write('level %s: %d runs, %d detections, '
+                              'detected in %d runs' %
+                              (level_name, summary.run_count,
+                               summary.detection_count, len(steps)))
+            if steps:
+                report_file.write(', median first detection at step %d' %
+                                  steps[len(steps) // 2])
+            report_file.write('\n')
+            if heatmaps:
+                report_file.write(summary.get_heatmap())
+                report_file.write('\n')
+
+def iter_runs(levels, seeds, steps, workers=None, guard_count=None,
+              activation_radius=None):
+    # Yields the result of each run as soon as it is done, in any order.
+    # Guards are kept awake by default, so that the whole level is covered.
+    tasks = [(level_name, seed, steps, guard_count, activation_radius)
+             for level_name in levels for seed in seeds]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            yield run_simulation(task)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(run_simulation, tasks):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def run(levels, seeds, steps, workers=None, guard_count=None,
+        activation_radius=None, callback=None):
+    # Runs every level with every seed over a pool of worker processes and
+    # aggregates the results. The callback gets each run result as it
+    # arrives.
+    batch_result = BatchResult()
+    start_time = default_timer()
+    for result in iter_runs(levels, seeds, steps, workers=workers,
+                            guard_count=guard_count,
+                            activation_radius=activation_radius):
+        if callback is not None:
+            callback(result)
+        batch_result.add(result)
+    batch_result.wall_time = default_timer() - start_time
+    return batch_result
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m cnd.batch',
+        description='Run seeded headless simulations over worker processes.')
+    parser.add_argument('levels', nargs='*', default=['level'],
+                        help='level names under resources/levels')
+    parser.add_argument('--runs', type=int, default=16,
+                        help='seeds per level')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=600)
+    parser.add_argument('--guards', type=int, default=None,
+                        help='guard count, spread over the level spawns')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes, one per core by default')
+    parser.add_argument('--activation-radius', type=float, default=None,
+                        help='let guards far from the thief sleep')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the metrics of every run as JSON lines')
+    parser.add_argument('--heatmaps', action='store_true',
+                        help='print the guard coverage of each level')
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args(args)
+
+def main():
+    configure_logging()
+    options = parse_args(sys.argv[1:])
+    seeds = range(options.first_seed, options.first_seed + options.runs)
+    output_file = None
+    callback = None
+    if options.output is not None:
+        output_file = open(options.output, 'w')
+        def callback(result):
+            output_file.write(result.to_json())
+            output_file.write('\n')
+            output_file.flush()
+    try:
+        batch_result = run(options.levels, seeds, options.steps,
+                           workers=options.workers,
+                           guard_count=options.guards,
+                           activation_radius=options.activation_radius,
+                           callback=callback)
+    finally:
+        if output_file is not None:
+            output_file.close()
+    batch_result.report(sys.stdout, heatmaps=options.heatmaps)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import resource
+import sys
+from timeit import default_timer
+
+from cnd.headless import init_pyglet
+
+init_pyglet()
+
+from cnd.main import GameEngine, configure_logging
+from cnd.memstats import get_memory_stats, write_memory_stats
+from cnd.profiler import Profiler
+from cnd.quality import QualityController
+from cnd.replay import Recorder, Recording, Replayer
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+class Benchmark(object):
+    def __init__(self, level_name='level', guard_count=None, step_count=600,
+                 seed=0, batch_characters=True, activation_radius=24.0,
+                 navigation=True, memstats=False, quality_level_index=0,
+                 record=False):
+        self.level_name = level_name
+        self.guard_count = guard_count
+        self.step_count = step_count
+        self.seed = seed
+        self.batch_characters = batch_characters
+        self.activation_radius = activation_radius
+        self.navigation = navigation
+        self.memstats = memstats
+        self.quality_level_index = quality_level_index
+        self.record = record
+        self.memory_stats = None
+        self.view_width = 640
+        self.view_height = 480
+        self.dt = 1.0 / 60.0
+        self.profiler = Profiler(GameEngine.phase_names,
+                                 GameEngine.counter_names, window_size=None)
+        self.step_time = 0.0
+        self.recording = None
+        self.replayer = None
+
+    @classmethod
+    def from_recording(cls, recording, memstats=False):
+        # Replays with the settings of the recording.
+        benchmark = cls(level_name=recording.level_name,
+                        guard_count=recording.guard_count,
+                        step_count=recording.step_count, seed=recording.seed,
+                        batch_characters=recording.batch_characters,
+                        activation_radius=recording.activation_radius,
+                        navigation=recording.navigation, memstats=memstats,
+                        quality_level_index=recording.quality_level_index)
+        benchmark.view_width = recording.view_width
+        benchmark.view_height = recording.view_height
+        benchmark.dt = recording.dt
+        benchmark.replayer = Replayer(recording)
+        return benchmark
+
+    def run(self):
+        game_engine = GameEngine(self.view_width, self.view_height,
+                                 level_name=self.level_name,
+                                 guard_count=self.guard_count, seed=self.seed,
+                                 profiler=self.profiler,
+                                 batch_characters=self.batch_characters,
+                                 activation_radius=self.activation_radius,
+                                 navigation=self.navigation,
+                                 quality_level_index=self.quality_level_index,
+                                 dt=self.dt)
+        if self.replayer is not None:
+            game_engine.input_filters.append(self.replayer)
+        elif self.record:
+            self.recording = Recording(
+                self.level_name, self.seed, self.guard_count,
+                len(game_engine.character_actors), self.dt,
+                view_width=self.view_width, view_height=self.view_height,
+                activation_radius=self.activation_radius,
+                navigation=self.navigation,
+                batch_characters=self.batch_characters,
+                quality_level_index=self.quality_level_index)
+            game_engine.input_filters.append(Recorder(self.recording))
+        self.profiler.enabled = True
+        start_time = default_timer()
+        for _ in xrange(self.step_count):
+            game_engine.step(self.dt)
+        self.step_time = default_timer() - start_time
+        if self.memstats:
+            self.memory_stats = get_memory_stats(game_engine)
+        game_engine.delete()
+
+    def report(self, report_file):
+        counters = self.profiler.counters
+        guard_count = self.guard_count
+        if guard_count is None:
+            guard_count = 'level'
+        report_file.write('level: %s, guards: %s, steps: %d, seed: %d\n' %
+                          (self.level_name, guard_count, self.step_count,
+                           self.seed))
+        steps_per_second = float(self.step_count) / max(self.step_time, 1e-9)
+        report_file.write('steps/sec: %.1f (%.1fx real time)\n' %
+                          (steps_per_second, steps_per_second * self.dt))
+        report_file.write('%-14s %9s %9s %9s %9s %9s\n' %
+                          ('phase (ms)', 'mean', 'p50', 'p90', 'p99', 'max'))
+        for phase_name in self.profiler.phase_names:
+            samples = sorted(self.profiler.samples[phase_name])
+            if not samples:
+                continue
+            mean = sum(samples) / max(len(samples), 1)
+            values = (mean, percentile(samples, 0.5),
+                      percentile(samples, 0.9), percentile(samples, 0.99),
+                      percentile(samples, 1.0))
+            report_file.write('%-14s %9.3f %9.3f %9.3f %9.3f %9.3f\n' %
+                              ((phase_name,) +
+                               tuple(1000.0 * value for value in values)))
+        report_file.write('  '.join('%s: %s' % (name, counters[name])
+                                    for name in self.profiler.counter_names))
+        report_file.write('\n')
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report_file.write('peak memory: %.1f MB\n' % (max_rss / 1024.0))
+        if self.memory_stats is not None:
+            write_memory_stats(report_file, self.memory_stats)
+        if self.replayer is not None:
+            divergence_step = self.replayer.divergence_step
+            if divergence_step is None:
+                report_file.write('replay: all checksums match\n')
+            else:
+                report_file.write('replay: diverged at step %d\n' %
+                                  divergence_step)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m cnd.bench',
+        description='Run the game engine headless at a fixed time step.')
+    parser.add_argument('--level', default='level',
+                        help='level name under resources/levels')
+    parser.add_argument('--guards', type=int, default=None,
+                        help='guard count, spread over the level spawns')
+    parser.add_argument('--steps', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='FILE',
+                        help='save the controls of every step to a file')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay a recording instead of a new run, with '
+                        'the settings it was recorded with')
+    parser.add_argument('--no-batch', action='store_true',
+                        help='step characters one by one, without NumPy')
+    parser.add_argument('--activation-radius', type=float, default=24.0,
+                        help='distance from the thief at which guards wake')
+    parser.add_argument('--no-activation', action='store_true',
+                        help='keep every guard awake')
+    parser.add_argument('--no-navigation', action='store_true',
+                        help='let guards walk at random')
+    parser.add_argument('--quality', type=int, default=0,
+                        choices=range(len(QualityController.levels)),
+                        help='fixed quality level, 0 for full quality')
+    parser.add_argument('--memstats', action='store_true',
+                        help='report the memory of actors, fixtures and tiles')
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args(args)
+
+def main():
+    configure_logging()
+    options = parse_args(sys.argv[1:])
+    activation_radius = options.activation_radius
+    if options.no_activation:
+        activation_radius = None
+    if options.replay is not None:
+        benchmark = Benchmark.from_recording(Recording.load(options.replay),
+                                             memstats=options.memstats)
+    else:
+        benchmark = Benchmark(level_name=options.level,
+                              guard_count=options.guards,
+                              step_count=options.steps, seed=options.seed,
+                              batch_characters=not options.no_batch,
+                              activation_radius=activation_radius,
+                              navigation=not options.no_navigation,
+                              memstats=options.memstats,
+                              quality_level_index=options.quality,
+                              record=options.record is not None)
+    benchmark.run()
+    if benchmark.recording is not None:
+        benchmark.recording.save(options.record)
+    benchmark.report(sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+from array import array
+from itertools import chain
+import struct
+
+class CheckpointError(Exception):
+    pass
+
+class Checkpoint(object):
+    # The state of a game engine packed into one string, for quicksaves and
+    # rewinding. It is restored in place into the game engine it was taken
+    # from, or one with the same level and characters, without creating
+    # bodies. Tiles, loaded chunks and contacts are not part of it, and
+    # noises that are still waiting to be heard are dropped on restore.
+    #
+    # The header has the time and step count of the engine. After the
+    # header and the random state, everything is stored in columns. For
+    # characters: positions and velocities, states, faces, control flags and
+    # dormant flags. For AIs, in character order: turn times, steering
+    # flags, goals, path lengths and the links of all paths, as source and
+    # target segments, kinds and start positions. Links are stored by value,
+    # since the navigation graph makes new ones when tiles change. For
+    # dormant guards: the faces and the other arguments of their patrols.
+    magic = 'CNDC'
+    version = 4
+    link_kinds = 'jump', 'drop'
+    header_struct = struct.Struct('<4sHdIII')
+    random_struct = struct.Struct('<i625I?d')
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def save(self, path):
+        with open(path, 'wb') as checkpoint_file:
+            checkpoint_file.write(self.data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as checkpoint_file:
+            return cls(checkpoint_file.read())
+
+def save_checkpoint(game_engine):
+    actors = list(game_engine.character_actors)
+    ais = game_engine.ais
+    ai_list = [ais[actor] for actor in actors if actor in ais]
+    version, internal_state, gauss_next = game_engine.random.getstate()
+    columns = [
+        array('d', chain.from_iterable(
+            chain(actor.body.position, actor.body.linearVelocity)
+            for actor in actors)),
+        array('b', [actor._state for actor in actors]),
+        array('b', [actor.face for actor in actors]),
+        array('B', [actor.controls.get_flags() for actor in actors]),
+        array('B', [actor.dormant for actor in actors]),
+        array('d', [ai.turn_time for ai in ai_list]),
+        array('B', [ai.steering for ai in ai_list]),
+        array('d', [ai.goal_x or 0.0 for ai in ai_list]),
+        array('d', [ai.goal_y or 0.0 for ai in ai_list]),
+        array('i', [-1 if ai.goal_segment_id is None else
+                    ai.goal_segment_id for ai in ai_list]),
+        array('I', [len(ai.path) if ai.path else 0 for ai in ai_list]),
+    ]
+    links = [link for ai in ai_list if ai.path for link in ai.path]
+    columns.append(array('i', [link.source for link in links]))
+    columns.append(array('i', [link.target for link in links]))
+    columns.append(array('B', [Checkpoint.link_kinds.index(link.kind)
+                               for link in links]))
+    columns.append(array('d', [link.start_x for link in links]))
+    patrols = []
+    activation_system = game_engine.activation_system
+    if activation_system is not None:
+        patrols = [activation_system.patrols[actor] for actor in actors
+                   if actor.dormant]
+    columns.append(array('b', [patrol.face for patrol in patrols]))
+    columns.append(array('d', chain.from_iterable(
+        (patrol.x, patrol.y, patrol.speed, patrol.min_x, patrol.min_y,
+         patrol.max_x, patrol.max_y, patrol.start_time)
+        for patrol in patrols)))
+    header = Checkpoint.header_struct.pack(Checkpoint.magic,
+                                           Checkpoint.version,
+                                           game_engine.time,
+                                           game_engine.step_count,
+                                           len(actors), len(ai_list))
+    random_state = Checkpoint.random_struct.pack(
+        version, *(internal_state + (gauss_next is not None,
+                                     gauss_next or 0.0)))
+    return Checkpoint(''.join([header, random_state] +
+                              [column.tostring() for column in columns]))
+
+def restore_checkpoint(game_engine, checkpoint):
+    data = checkpoint.data
+    actors = list(game_engine.character_actors)
+    ais = game_engine.ais
+    ai_list = [ais[actor] for actor in actors if actor in ais]
+    try:
+        (magic, version, time, step_count, character_count,
+         ai_count) = Checkpoint.header_struct.unpack_from(data)
+        if magic != Checkpoint.magic or version != Checkpoint.version:
+            raise CheckpointError('unknown checkpoint format')
+        if character_count != len(actors) or ai_count != len(ai_list):
+            raise CheckpointError('characters do not match checkpoint')
+        offset = Checkpoint.header_struct.size
+        random_state = Checkpoint.random_struct.unpack_from(data, offset)
+        offset += Checkpoint.random_struct.size
+    except struct.error as e:
+        raise CheckpointError(str(e))
+    def read_column(type_code, count):
+        column = array(type_code)
+        end = offset + count * column.itemsize
+        if end > len(data):
+            raise CheckpointError('truncated checkpoint')
+        column.fromstring(data[offset:end])
+        return column, end
+    motion, offset = read_column('d', 4 * character_count)
+    states, offset = read_column('b', character_count)
+    faces, offset = read_column('b', character_count)
+    flags, offset = read_column('B', character_count)
+    dormant_flags, offset = read_column('B', character_count)
+    turn_times, offset = read_column('d', ai_count)
+    steering_flags, offset = read_column('B', ai_count)
+    goal_xs, offset = read_column('d', ai_count)
+    goal_ys, offset = read_column('d', ai_count)
+    goal_segment_ids, offset = read_column('i', ai_count)
+    path_lengths, offset = read_column('I', ai_count)
+    link_count = sum(path_lengths)
+    link_sources, offset = read_column('i', link_count)
+    link_targets, offset = read_column('i', link_count)
+    link_kinds, offset = read_column('B', link_count)
+    link_start_xs, offset = read_column('d', link_count)
+    patrol_count = sum(dormant_flags)
+    patrol_faces, offset = read_column('b', patrol_count)
+    patrol_values, offset = read_column('d', 8 * patrol_count)
+    if offset != len(data):
+        raise CheckpointError('checkpoint size does not match')
+    activation_system = game_engine.activation_system
+    if patrol_count and activation_system is None:
+        raise CheckpointError('checkpoint has dormant guards')
+
+    # Guards that are dormant in only one of the engine and the checkpoint
+    # wake up or fall asleep first, since that changes their AIs.
+    if activation_system is not None:
+        j = 0
+        for actor, dormant in zip(actors, dormant_flags):
+            if dormant:
+                values = patrol_values[8 * j:8 * j + 8]
+                activation_system.restore(actor, (
+                    values[0], values[1], patrol_faces[j], values[2],
+                    tuple(values[3:7]), values[7]))
+                j += 1
+            elif actor.dormant:
+                activation_system.restore(actor, None)
+    for actor, x, y, vx, vy, state, face, flag in zip(
+        actors, motion[0::4], motion[1::4], motion[2::4], motion[3::4],
+        states, faces, flags):
+        body = actor.body
+        body.position = x, y
+        body.linearVelocity = vx, vy
+        actor._state = state
+        actor.face = face
+        actor.controls.set_flags(flag)
+    steering_ais = game_engine.steering_ais
+    link_offset = 0
+    for i, ai in enumerate(ai_list):
+        ai.turn_time = turn_times[i]
+        link_end = link_offset + path_lengths[i]
+        path = None
+        if steering_flags[i]:
+            links = zip(link_sources[link_offset:link_end],
+                        link_targets[link_offset:link_end],
+                        link_kinds[link_offset:link_end],
+                        link_start_xs[link_offset:link_end])
+            path = get_path(ai, links, goal_segment_ids[i])
+        link_offset = link_end
+        if path is None:
+            ai.path = ai.path_version = None
+            ai.goal_x = ai.goal_y = ai.goal_segment_id = None
+            ai.steering = False
+            steering_ais.discard(ai)
+        else:
+            ai.path = path
+            ai.path_version = ai.navigation_graph.version
+            ai.goal_x = goal_xs[i]
+            ai.goal_y = goal_ys[i]
+            ai.goal_segment_id = goal_segment_ids[i]
+            ai.steering = True
+            if ai not in steering_ais:
+                steering_ais.add(ai)
+    game_engine.ai_scheduler.reschedule()
+    if game_engine.character_system is not None:
+        game_engine.character_system.invalidate()
+    game_engine.time = time
+    game_engine.step_count = step_count
+    game_engine.hearing_system.noises = []
+    version = random_state[0]
+    internal_state = random_state[1:626]
+    has_gauss_next, gauss_next = random_state[626:]
+    game_engine.random.setstate((version, internal_state,
+                                 gauss_next if has_gauss_next else None))
+
+def get_path(ai, links, goal_segment_id):
+    # Returns the links of a path from (source, target, kind, start x)
+    # tuples, or None if it no longer fits the navigation graph, because
+    # tiles have changed since the checkpoint.
+    navigation_graph = ai.navigation_graph
+    navigation_graph.update()
+    segments = navigation_graph.segments
+    if goal_segment_id not in segments:
+        return None
+    link_kinds = Checkpoint.link_kinds
+    path = []
+    for source, target, kind, start_x in links:
+        segment = segments.get(source)
+        if segment is None:
+            return None
+        for link in segment.links:
+            if (link.target == target and link.start_x == start_x and
+                link_kinds.index(link.kind) == kind):
+                path.append(link)
+                break
+        else:
+            return None
+    return path
@@ -0,0 +1,12 @@
+import os
+
+import pyglet
+
+def init_pyglet():
+    # No window is ever opened, so keep pyglet from creating the hidden window
+    # it otherwise shares its GL context with. Levels are found relative to
+    # this package, so that the engine can be run from any script. Must be
+    # called before pyglet.gl is imported.
+    pyglet.options['shadow_window'] = False
+    pyglet.resource.path = [os.path.dirname(os.path.abspath(__file__))]
+    pyglet.resource.reindex()
@@ -0,0 +1,167 @@
+import heapq
+import math
+
+from level import TileMerger
+from streaming import LRUCache
+
+class HearingSystem(object):
+    # Noises spread through the tile grid around walls, not through them.
+    # Full tiles block sound, other solid tiles muffle it, and loudness
+    # drops by one per tile. Tiles without solid cells, like spawns and
+    # lights, are open air. The distance field of a source tile is flooded
+    # once, with Dijkstra up to max_volume, and cached until the tiles
+    # change. Each step, the noises are merged into one loudness map, so
+    # that listeners are looked up in constant time. The map keeps the
+    # loudest noise of each tile and the loudest one from another actor, so
+    # that the noise of a listener never hides the noises of others. Per
+    # step, the loudest max_noises noises are heard and the others are
+    # dropped, and at most max_floods fields are flooded. Noises that wait
+    # for a field are heard on a later step.
+    def __init__(self, tiles, tile_width=1.0, tile_height=1.0,
+                 max_volume=12, max_noises=8, max_floods=2, cache_size=256):
+        self.tiles = tiles
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.max_volume = max_volume
+        self.max_noises = max_noises
+        self.max_floods = max_floods
+        self.cost_table = bytearray(256)
+        for i, cell_mask in enumerate(TileMerger.get_cell_masks()):
+            if not cell_mask:
+                self.cost_table[i] = 1
+            elif cell_mask != TileMerger.full_cell_mask:
+                self.cost_table[i] = 2
+        self.fields = LRUCache(cache_size)
+        self.noises = []
+        self.loudness_map = {}
+        self.loudnesses = []
+        self.noise_count = 0
+        self.flood_count = 0
+
+    def get_index(self, x, y):
+        # Returns the data index of the tile at (x, y), or None.
+        tile_x = int(math.floor(x / self.tile_width + 0.5))
+        tile_y = int(math.floor(y / self.tile_height + 0.5))
+        if not self.tiles.in_bounds(tile_x, tile_y):
+            return None
+        return self.tiles.get_index(tile_x, tile_y)
+
+    def emit(self, x, y, volume, actor=None):
+        # Queues a noise that can be heard volume tiles away, in the open.
+        # Listeners do not hear the noises of their own actor.
+        index = self.get_index(x, y)
+        if index is not None and volume > 0.0:
+            self.noises.append((min(volume, self.max_volume), index, actor))
+
+    def invalidate_tile(self, tile_x, tile_y):
+        # Tile listener. A changed tile can open or close a way for any
+        # cached field, so they are all flooded again.
+        self.fields = LRUCache(self.fields.max_size)
+
+    def flood(self, source_index):
+        # Returns the (distance, index) pairs of the tiles within max_volume
+        # of the source tile, nearest first. The source itself can be solid,
+        # like the slope a character stands in.
+        tiles = self.tiles
+        data = tiles.data
+        width = tiles.width
+        size = len(data)
+        cost_table = self.cost_table
+        max_volume = self.max_volume
+        distances = {source_index: 0}
+        heap = [(0, source_index)]
+        field = []
+        while heap:
+            distance, index = heapq.heappop(heap)
+            if distance > distances[index]:
+                continue
+            field.append((distance, index))
+            x = index % width
+            for neighbor in (index - 1 if x else -1,
+                             index + 1 if x + 1 < width else -1,
+                             index - width, index + width):
+                if not 0 <= neighbor < size:
+                    continue
+                cost = cost_table[data[neighbor]]
+                if not cost:
+                    continue
+                neighbor_distance = distance + cost
+                if (neighbor_distance <= max_volume and
+                    neighbor_distance < distances.get(neighbor,
+                                                      max_volume + 1)):
+                    distances[neighbor] = neighbor_distance
+                    heapq.heappush(heap, (neighbor_distance, neighbor))
+        return field
+
+    def update(self, actors, positions):
+        # Merges the noises of the step into the loudness map and returns
+        # the loudness heard by each listener. The noises of an actor are
+        # merged per source tile first.
+        sources = {}
+        for noise in self.noises:
+            key = noise[1], noise[2]
+            source = sources.get(key)
+            if source is None or noise[0] > source[0]:
+                sources[key] = noise
+        sources = sorted(sources.itervalues(), reverse=True,
+                         key=lambda noise: noise[0])
+        waiting = []
+        loudness_map = {}
+        fields = self.fields
+        flood_count = 0
+        noise_count = 0
+        for noise in sources[:self.max_noises]:
+            volume, index, actor = noise
+            field = fields.get(index)
+            if field is None:
+                if flood_count == self.max_floods:
+                    waiting.append(noise)
+                    continue
+                field = self.flood(index)
+                fields.put(index, field)
+                flood_count += 1
+            noise_count += 1
+            for distance, tile_index in field:
+                loudness = volume - distance
+                if loudness <= 0.0:
+                    break
+                # (loudest, its actor, loudest from another actor)
+                heard = loudness_map.get(tile_index)
+                if heard is None:
+                    loudness_map[tile_index] = loudness, actor, 0.0
+                elif loudness > heard[0]:
+                    if actor is heard[1]:
+                        loudness_map[tile_index] = (loudness, actor,
+                                                    heard[2])
+                    else:
+                        loudness_map[tile_index] = (loudness, actor,
+                                                    heard[0])
+                elif actor is not heard[1] and loudness > heard[2]:
+                    loudness_map[tile_index] = heard[0], heard[1], loudness
+        self.noises = waiting
+        self.loudness_map = loudness_map
+        self.noise_count = noise_count
+        self.flood_count = flood_count
+        loudnesses = [0.0] * len(actors)
+        if loudness_map:
+            # get_index, inlined for every listener.
+            tiles = self.tiles
+            min_x = tiles.min_x
+            min_y = tiles.min_y
+            width = tiles.width
+            height = tiles.height
+            tile_width = self.tile_width
+            tile_height = self.tile_height
+            floor = math.floor
+            for k, (actor, (x, y)) in enumerate(zip(actors, positions)):
+                i = int(floor(x / tile_width + 0.5)) - min_x
+                j = int(floor(y / tile_height + 0.5)) - min_y
+                if 0 <= i < width and 0 <= j < height:
+                    heard = loudness_map.get(j * width + i)
+                    if heard is not None:
+                        if heard[1] is not actor:
+                            loudnesses[k] = heard[0]
+                        else:
+                            loudnesses[k] = heard[2]
+        self.loudnesses = loudnesses
+        return loudnesses
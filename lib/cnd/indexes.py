@@ -0,0 +1,42 @@
+import itertools
+
+class OrderedIndex(object):
+    # An ordered set with constant time add, remove and membership, for
+    # actors and the like. Removing leaves a hole that iteration skips, so
+    # items can be added and removed while iterating, without copying.
+    # Items added while iterating are not visited. Holes are squeezed out by
+    # compact() between steps, once they make up half of the slots.
+    def __init__(self, items=()):
+        self.items = []
+        self.indices = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __contains__(self, item):
+        return item in self.indices
+
+    def __iter__(self):
+        items = self.items
+        return itertools.ifilter(None, itertools.islice(items, len(items)))
+
+    def add(self, item):
+        assert item not in self.indices
+        self.indices[item] = len(self.items)
+        self.items.append(item)
+
+    def remove(self, item):
+        self.items[self.indices.pop(item)] = None
+
+    def discard(self, item):
+        if item in self.indices:
+            self.remove(item)
+
+    def compact(self):
+        # Iterations that are still running keep the old list.
+        if 2 * len(self.indices) < len(self.items):
+            self.items = [item for item in self.items if item is not None]
+            self.indices = dict((item, i)
+                                for i, item in enumerate(self.items))
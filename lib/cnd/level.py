@@ -0,0 +1,692 @@
+import errno
+import glob
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+
+import pyglet
+
+class TabInLevelError(Exception):
+    pass
+
+class LevelFormatError(Exception):
+    pass
+
+class LevelParser(object):
+    # Maps whitespace to empty tiles.
+    empty_table = ''.join('\0' if chr(i).isspace() else chr(i)
+                          for i in xrange(256))
+
+    def __init__(self, level_file):
+        self.level_file = level_file
+
+    def parse(self):
+        lines = []
+        for line in self.level_file:
+            line = line.rstrip()
+            if '\t' in line:
+                raise TabInLevelError()
+            lines.append(line)
+        width = max([len(line) for line in lines] or [0])
+        height = len(lines)
+        tiles = TileGrid(0, 1 - height, width, height)
+        for y, line in enumerate(lines):
+            row = line.ljust(width).translate(self.empty_table)
+            tiles.set_row(-y, row)
+        return tiles
+
+class TileMerger(object):
+    # Each tile is split into 2 x 2 cells, so that half tiles and the steps of
+    # slope tiles line up with full tiles. Cell (2 * x, 2 * y) is the
+    # lower-left cell of tile (x, y).
+    tile_cells = {
+        '@': (),
+        '%': (),
+        '*': (),
+        '!': (),
+        '/': ((0, 0), (1, 0), (1, 1)),
+        '\\': ((0, 0), (1, 0), (0, 1)),
+        '_': ((0, 0), (1, 0)),
+        '^': ((0, 1), (1, 1)),
+    }
+    default_tile_cells = (0, 0), (1, 0), (0, 1), (1, 1)
+    full_cell_mask = 15
+    _cell_masks = None
+    _opaque_table = None
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+
+    @classmethod
+    def get_cell_masks(cls):
+        # Returns the solid cells of each tile byte as a table of bit masks,
+        # with bit 2 * dy + dx set for cell (dx, dy). Byte 0 is the empty
+        # tile. The table is shared, and must not be changed.
+        if cls._cell_masks is None:
+            cell_masks = bytearray(256)
+            for i in xrange(1, 256):
+                tile_cells = cls.tile_cells.get(chr(i),
+                                                cls.default_tile_cells)
+                for dx, dy in tile_cells:
+                    cell_masks[i] |= 1 << (2 * dy + dx)
+            cls._cell_masks = cell_masks
+        return cls._cell_masks
+
+    @classmethod
+    def get_opaque_table(cls):
+        # Returns 1 for the tile bytes whose cells are all solid, and 0 for
+        # the others. The table is shared, and must not be changed.
+        if cls._opaque_table is None:
+            cls._opaque_table = bytearray(mask == cls.full_cell_mask
+                                          for mask in cls.get_cell_masks())
+        return cls._opaque_table
+
+    def get_cells(self):
+        cells = set()
+        for tile_position, tile_char in self.tiles.iteritems():
+            tile_x, tile_y = tile_position
+            tile_cells = self.tile_cells.get(tile_char,
+                                             self.default_tile_cells)
+            for dx, dy in tile_cells:
+                cells.add((2 * tile_x + dx, 2 * tile_y + dy))
+        return cells
+
+    def merge(self):
+        # Greedily grow rectangles, first to the right and then upwards,
+        # starting from the lowest unmerged cell.
+        cells = self.get_cells()
+        rectangles = []
+        for min_x, min_y in sorted(cells, key=lambda cell: (cell[1], cell[0])):
+            if (min_x, min_y) not in cells:
+                continue
+            max_x = min_x + 1
+            while (max_x, min_y) in cells:
+                max_x += 1
+            max_y = min_y + 1
+            while all((x, max_y) in cells for x in xrange(min_x, max_x)):
+                max_y += 1
+            for y in xrange(min_y, max_y):
+                for x in xrange(min_x, max_x):
+                    cells.remove((x, y))
+            rectangles.append((min_x, min_y, max_x, max_y))
+        return rectangles
+
+class GroundProbe(object):
+    # Finds the ground below points by scanning the cells of a tile column
+    # downwards, using the same cells that TileMerger turns into fixtures.
+    # Only tiles are ground. The ray cast that this replaces also hit the
+    # sensor circles of other characters, so characters no longer land on
+    # each other.
+    # Hits keep the data index of the tile instead of a tile record, and
+    # get_tile_record() looks the tile up in the grid when it is needed.
+    def __init__(self, tiles, half_tile_width=0.5, half_tile_height=0.5):
+        self.tiles = tiles
+        self.half_tile_width = half_tile_width
+        self.half_tile_height = half_tile_height
+        self.cell_masks = TileMerger.get_cell_masks()
+
+    def probe(self, x, y, length):
+        # Returns the hit point, the fraction of the length and the tile
+        # index of the first surface below (x, y), or None. A surface is the
+        # top of a solid cell with an empty cell above it. A point inside a
+        # solid cell does not hit the tile it is in, like a ray cast skips
+        # the fixture of the tile it starts in, but it hits the tile below.
+        tiles = self.tiles
+        tile_x, dx = divmod(int(math.floor(x / self.half_tile_width)) + 1, 2)
+        i = tile_x - tiles.min_x
+        if not 0 <= i < tiles.width:
+            return None
+        data = tiles.data
+        width = tiles.width
+        cell_masks = self.cell_masks
+        start_cell_y = int(math.floor(y / self.half_tile_height)) + 1
+        max_cell_y = 2 * (tiles.min_y + tiles.height)
+        min_cell_y = max(2 * tiles.min_y,
+                         int(math.ceil((y - length) / self.half_tile_height)))
+        solid_above = False
+        skip_tile_y = None
+        for cell_y in xrange(min(start_cell_y, max_cell_y - 1),
+                             min_cell_y - 1, -1):
+            tile_y, dy = divmod(cell_y, 2)
+            index = (tile_y - tiles.min_y) * width + i
+            value = data[index]
+            solid = cell_masks[value] >> (2 * dy + dx) & 1
+            if solid and cell_y == start_cell_y:
+                skip_tile_y = tile_y
+            if tile_y == skip_tile_y:
+                solid = 0
+            if solid and not solid_above and cell_y < start_cell_y:
+                hit_y = float(cell_y) * self.half_tile_height
+                fraction = (y - hit_y) / length
+                return (x, hit_y), fraction, index
+            solid_above = solid
+        return None
+
+    def get_tile_record(self, index):
+        # Returns the (tile position, tile char) of the tile at a data index.
+        tiles = self.tiles
+        tile_y, tile_x = divmod(index, tiles.width)
+        return ((tiles.min_x + tile_x, tiles.min_y + tile_y),
+                chr(tiles.data[index]))
+
+    def probe_all(self, origins, lengths):
+        probe = self.probe
+        return [probe(x, y, length)
+                for (x, y), length in zip(origins, lengths)]
+
+class TileGrid(object):
+    # Tiles stored row by row in a byte array, with 0 for empty tiles. Tile
+    # (x, y) is stored at index (y - min_y) * width + (x - min_x).
+    neighbor_offsets = (1, 0), (0, 1), (-1, 0), (0, -1)
+    diagonal_neighbor_offsets = neighbor_offsets + ((1, 1), (-1, 1),
+                                                    (-1, -1), (1, -1))
+
+    def __init__(self, min_x, min_y, width, height, data=None):
+        self.min_x = min_x
+        self.min_y = min_y
+        self.width = width
+        self.height = height
+        if data is None:
+            data = bytearray(width * height)
+        assert len(data) == width * height
+        self.data = data
+
+    @property
+    def max_x(self):
+        return self.min_x + self.width
+
+    @property
+    def max_y(self):
+        return self.min_y + self.height
+
+    @property
+    def bounds(self):
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+    def in_bounds(self, x, y):
+        return (0 <= x - self.min_x < self.width and
+                0 <= y - self.min_y < self.height)
+
+    def get_index(self, x, y):
+        return (y - self.min_y) * self.width + (x - self.min_x)
+
+    def get_tile(self, x, y):
+        x -= self.min_x
+        y -= self.min_y
+        if 0 <= x < self.width and 0 <= y < self.height:
+            value = self.data[y * self.width + x]
+            if value:
+                return chr(value)
+        return None
+
+    def set_tile(self, x, y, char):
+        if not self.in_bounds(x, y):
+            raise IndexError('tile (%d, %d) is outside the grid' % (x, y))
+        self.data[self.get_index(x, y)] = char or '\0'
+
+    def get_row(self, y, min_x=None, max_x=None):
+        # Returns the raw tile bytes of a row, clipped to the grid.
+        if not 0 <= y - self.min_y < self.height:
+            return bytearray()
+        min_x = self.min_x if min_x is None else max(min_x, self.min_x)
+        max_x = self.max_x if max_x is None else min(max_x, self.max_x)
+        if min_x >= max_x:
+            return bytearray()
+        index = self.get_index(min_x, y)
+        return self.data[index:index + max_x - min_x]
+
+    def set_row(self, y, row, min_x=None):
+        if min_x is None:
+            min_x = self.min_x
+        if not (self.in_bounds(min_x, y) and
+                min_x + len(row) <= self.max_x):
+            raise IndexError('row %d is outside the grid' % y)
+        index = self.get_index(min_x, y)
+        self.data[index:index + len(row)] = row
+
+    def get_column(self, x, min_y=None, max_y=None):
+        # Returns the raw tile bytes of a column from bottom to top, clipped
+        # to the grid.
+        if not 0 <= x - self.min_x < self.width:
+            return bytearray()
+        min_y = self.min_y if min_y is None else max(min_y, self.min_y)
+        max_y = self.max_y if max_y is None else min(max_y, self.max_y)
+        if min_y >= max_y:
+            return bytearray()
+        return self.data[self.get_index(x, min_y):
+                         self.get_index(x, max_y - 1) + 1:self.width]
+
+    def iter_bounds(self, min_x, min_y, max_x, max_y):
+        # Yields the non-empty tiles in [min_x, max_x) x [min_y, max_y).
+        min_x = max(min_x, self.min_x)
+        max_x = min(max_x, self.max_x)
+        for y in xrange(max(min_y, self.min_y), min(max_y, self.max_y)):
+            for i, value in enumerate(self.get_row(y, min_x, max_x)):
+                if value:
+                    yield (min_x + i, y), chr(value)
+
+    def iter_neighbors(self, x, y, offsets=neighbor_offsets):
+        # Yields the in-bounds neighbors of a tile, with None for empty
+        # tiles.
+        for dx, dy in offsets:
+            if self.in_bounds(x + dx, y + dy):
+                yield (x + dx, y + dy), self.get_tile(x + dx, y + dy)
+
+    def get(self, position, default=None):
+        char = self.get_tile(*position)
+        if char is None:
+            return default
+        return char
+
+    def __getitem__(self, position):
+        char = self.get_tile(*position)
+        if char is None:
+            raise KeyError(position)
+        return char
+
+    def __contains__(self, position):
+        return self.get_tile(*position) is not None
+
+    def __len__(self):
+        return len(self.data) - self.data.count('\0')
+
+    def __iter__(self):
+        for position, char in self.iteritems():
+            yield position
+
+    def iteritems(self):
+        return self.iter_bounds(*self.bounds)
+
+class LightMap(object):
+    # Light levels of the tiles, from 0 for dark to 255, stored like the tile
+    # grid. Lights are tiles whose char is in light_chars, with a radius and
+    # an intensity that falls off linearly to the radius. They are baked with
+    # recursive shadowcasting, in which full tiles cast shadows and are lit
+    # on their faces. Overlapping lights take the brightest.
+    light_chars = {'*': (10, 255), '!': (6, 192)}
+    ambient = 64
+    octants = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+    def __init__(self, tiles, data=None):
+        self.tiles = tiles
+        self.opaque_table = TileMerger.get_opaque_table()
+        self.lights = {}
+        for char in self.light_chars:
+            index = tiles.data.find(char)
+            while index != -1:
+                position = (tiles.min_x + index % tiles.width,
+                            tiles.min_y + index // tiles.width)
+                self.lights[position] = char
+                index = tiles.data.find(char, index + 1)
+        self.dirty_bounds = None
+        if data is None:
+            data = bytearray(tiles.width * tiles.height)
+            self.data = data
+            self.bake()
+        assert len(data) == tiles.width * tiles.height
+        self.data = data
+
+    def get_light(self, x, y):
+        tiles = self.tiles
+        x -= tiles.min_x
+        y -= tiles.min_y
+        if 0 <= x < tiles.width and 0 <= y < tiles.height:
+            return self.data[y * tiles.width + x]
+        return self.ambient
+
+    def get_row(self, y, min_x, max_x):
+        # Returns the light levels of the tiles in [min_x, max_x) of a row,
+        # which must be in the grid.
+        index = self.tiles.get_index(min_x, y)
+        return self.data[index:index + max_x - min_x]
+
+    def invalidate_tile(self, tile_x, tile_y):
+        # Tile listener. Bakes the area of every light that reaches the tile
+        # again, including a light that was added or removed there.
+        position = tile_x, tile_y
+        lights = self.lights.items()
+        old_char = self.lights.pop(position, None)
+        if old_char is not None:
+            lights.append((position, old_char))
+        char = self.tiles.get_tile(tile_x, tile_y)
+        if char in self.light_chars:
+            self.lights[position] = char
+            lights.append((position, char))
+        bounds = None
+        for (x, y), char in lights:
+            radius = self.light_chars[char][0]
+            if abs(x - tile_x) <= radius and abs(y - tile_y) <= radius:
+                bounds = union_bounds(bounds, (x - radius, y - radius,
+                                               x + radius + 1, y + radius + 1))
+        if bounds is not None:
+            self.bake(bounds)
+
+    def bake(self, bounds=None):
+        # Bakes the tiles in [min_x, max_x) x [min_y, max_y) from the lights
+        # that overlap them. Baked tiles are added to dirty_bounds, for the
+        # renderer.
+        tiles = self.tiles
+        if bounds is None:
+            bounds = tiles.bounds
+        min_x, min_y, max_x, max_y = bounds
+        bounds = (max(min_x, tiles.min_x), max(min_y, tiles.min_y),
+                  min(max_x, tiles.max_x), min(max_y, tiles.max_y))
+        min_x, min_y, max_x, max_y = bounds
+        if min_x >= max_x or min_y >= max_y:
+            return
+        ambient_row = bytearray(chr(self.ambient)) * (max_x - min_x)
+        for y in xrange(min_y, max_y):
+            index = tiles.get_index(min_x, y)
+            self.data[index:index + max_x - min_x] = ambient_row
+        for (x, y), char in self.lights.iteritems():
+            radius = self.light_chars[char][0]
+            if (min_x - radius <= x < max_x + radius and
+                min_y - radius <= y < max_y + radius):
+                self.cast_light(x, y, char, bounds)
+        self.dirty_bounds = union_bounds(self.dirty_bounds, bounds)
+
+    def cast_light(self, light_x, light_y, char, bounds):
+        # Lights the tiles within bounds that can be seen from the light,
+        # one octant at a time.
+        radius, intensity = self.light_chars[char]
+        min_x, min_y, max_x, max_y = bounds
+        tiles = self.tiles
+        tile_data = tiles.data
+        opaque_table = self.opaque_table
+        data = self.data
+        def light(x, y, squared_distance):
+            if min_x <= x < max_x and min_y <= y < max_y:
+                level = int(intensity *
+                            (1.0 - math.sqrt(squared_distance) / radius))
+                index = tiles.get_index(x, y)
+                if level > data[index]:
+                    data[index] = level
+        def is_opaque(x, y):
+            return (tiles.in_bounds(x, y) and
+                    opaque_table[tile_data[tiles.get_index(x, y)]])
+        light(light_x, light_y, 0)
+        for transform in self.octants:
+            self._cast_octant(light_x, light_y, radius, 1, 1.0, 0.0,
+                              transform, light, is_opaque)
+
+    def _cast_octant(self, light_x, light_y, radius, row, start, end,
+                     transform, light, is_opaque):
+        # Scans the rows of an octant outwards, between the start and end
+        # slopes. A run of opaque tiles narrows the scan, and the part of
+        # the octant before the run is scanned on its own.
+        if start < end:
+            return
+        xx, xy, yx, yy = transform
+        squared_radius = radius * radius
+        new_start = start
+        for j in xrange(row, radius + 1):
+            dx = -j - 1
+            dy = -j
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                x = light_x + dx * xx + dy * xy
+                y = light_y + dx * yx + dy * yy
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+                squared_distance = dx * dx + dy * dy
+                if squared_distance < squared_radius:
+                    light(x, y, squared_distance)
+                if blocked:
+                    if is_opaque(x, y):
+                        new_start = right_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif is_opaque(x, y) and j < radius:
+                    blocked = True
+                    self._cast_octant(light_x, light_y, radius, j + 1, start,
+                                      left_slope, transform, light, is_opaque)
+                    new_start = right_slope
+            if blocked:
+                break
+
+def union_bounds(bounds_a, bounds_b):
+    if bounds_a is None:
+        return bounds_b
+    return (min(bounds_a[0], bounds_b[0]), min(bounds_a[1], bounds_b[1]),
+            max(bounds_a[2], bounds_b[2]), max(bounds_a[3], bounds_b[3]))
+
+class LevelData(object):
+    # The merged cell rectangles are split into square chunks of tiles, so
+    # that chunks can be loaded on their own. The rectangles of each chunk
+    # are kept packed until the chunk is loaded.
+    spawn_chars = '@%'
+    rectangle_struct = struct.Struct('<iiii')
+
+    def __init__(self, tiles, chunk_size, chunk_rectangles, spawns,
+                 light_map):
+        self.tiles = tiles
+        self.chunk_size = chunk_size
+        self.chunk_rectangles = chunk_rectangles
+        self.spawns = spawns
+        self.light_map = light_map
+
+    def get_spawns(self, char):
+        return [position for spawn_char, position in self.spawns
+                if spawn_char == char]
+
+    def get_chunk_key(self, tile_x, tile_y):
+        return tile_x // self.chunk_size, tile_y // self.chunk_size
+
+    def get_chunk_tile_bounds(self, chunk_key):
+        # Returns the tiles of a chunk as [min_x, max_x) x [min_y, max_y).
+        chunk_x, chunk_y = chunk_key
+        size = self.chunk_size
+        return (chunk_x * size, chunk_y * size,
+                (chunk_x + 1) * size, (chunk_y + 1) * size)
+
+    def iter_chunk_keys(self, min_x=None, min_y=None, max_x=None,
+                        max_y=None):
+        # Yields the chunks that overlap the given tiles and the grid, with
+        # the tiles as [min_x, max_x) x [min_y, max_y).
+        tiles = self.tiles
+        min_x = tiles.min_x if min_x is None else max(min_x, tiles.min_x)
+        min_y = tiles.min_y if min_y is None else max(min_y, tiles.min_y)
+        max_x = tiles.max_x if max_x is None else min(max_x, tiles.max_x)
+        max_y = tiles.max_y if max_y is None else min(max_y, tiles.max_y)
+        if min_x >= max_x or min_y >= max_y:
+            return
+        min_chunk_x, min_chunk_y = self.get_chunk_key(min_x, min_y)
+        max_chunk_x, max_chunk_y = self.get_chunk_key(max_x - 1, max_y - 1)
+        for chunk_y in xrange(min_chunk_y, max_chunk_y + 1):
+            for chunk_x in xrange(min_chunk_x, max_chunk_x + 1):
+                yield chunk_x, chunk_y
+
+    def get_chunk_rectangles(self, chunk_key):
+        data = self.chunk_rectangles.get(chunk_key, '')
+        size = self.rectangle_struct.size
+        return [self.rectangle_struct.unpack_from(data, offset)
+                for offset in xrange(0, len(data), size)]
+
+    def merge_chunk(self, chunk_key):
+        # Merges the tiles of a chunk again, after its tiles have changed.
+        tile_bounds = self.get_chunk_tile_bounds(chunk_key)
+        chunk_tiles = dict(self.tiles.iter_bounds(*tile_bounds))
+        rectangles = TileMerger(chunk_tiles).merge()
+        if rectangles:
+            self.chunk_rectangles[chunk_key] = ''.join(
+                self.rectangle_struct.pack(*rectangle)
+                for rectangle in rectangles)
+        else:
+            self.chunk_rectangles.pop(chunk_key, None)
+
+    @property
+    def rectangle_count(self):
+        return (sum(len(data) for data in self.chunk_rectangles.itervalues())
+                // self.rectangle_struct.size)
+
+class LevelCompiler(object):
+    def __init__(self, level_file, chunk_size=32):
+        self.level_file = level_file
+        self.chunk_size = chunk_size
+
+    def compile(self):
+        tiles = LevelParser(self.level_file).parse()
+        spawns = sorted((char, position)
+                        for position, char in tiles.iteritems()
+                        if char in LevelData.spawn_chars)
+        level_data = LevelData(tiles, self.chunk_size, {}, spawns,
+                               LightMap(tiles))
+        for chunk_key in level_data.iter_chunk_keys():
+            level_data.merge_chunk(chunk_key)
+        return level_data
+
+class LevelCache(object):
+    # Compiled levels are stored as a header, the tile grid bytes, the baked
+    # light map bytes, the chunks with their merged cell rectangles and the
+    # spawn points. A cached file is only used if it was compiled from a
+    # source with the same SHA-1 hash.
+    magic = 'CNDL'
+    version = 3
+    header_struct = struct.Struct('<4sH20siiIIIII')
+    chunk_struct = struct.Struct('<iiI')
+    spawn_struct = struct.Struct('<cii')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_path(self, level_name):
+        return os.path.join(self.cache_dir, level_name + '.lvl')
+
+    def load(self, level_name, source):
+        source_hash = hashlib.sha1(source).digest()
+        path = self.get_path(level_name)
+        try:
+            level_data = self.read(path, source_hash)
+        except (IOError, LevelFormatError) as e:
+            logging.debug('Ignoring level cache %s: %s' % (path, e))
+            level_data = None
+        if level_data is None:
+            logging.debug('Compiling level %s.' % level_name)
+            level_compiler = LevelCompiler(source.splitlines())
+            level_data = level_compiler.compile()
+            try:
+                self.write(path, source_hash, level_data)
+            except (IOError, OSError) as e:
+                logging.warning('Could not write level cache %s: %s' %
+                                (path, e))
+        return level_data
+
+    def read(self, path, source_hash):
+        with open(path, 'rb') as cache_file:
+            try:
+                data = mmap.mmap(cache_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise LevelFormatError(str(e))
+        try:
+            return self.unpack(data, source_hash)
+        except struct.error as e:
+            raise LevelFormatError(str(e))
+        finally:
+            data.close()
+
+    def unpack(self, data, source_hash):
+        (magic, version, cached_hash, min_x, min_y, width, height,
+         chunk_size, chunk_count,
+         spawn_count) = self.header_struct.unpack_from(data)
+        if magic != self.magic or version != self.version:
+            raise LevelFormatError('unknown format')
+        if cached_hash != source_hash:
+            return None
+        offset = self.header_struct.size
+        tile_data = bytearray(data[offset:offset + width * height])
+        if len(tile_data) != width * height:
+            raise LevelFormatError('truncated tile grid')
+        tiles = TileGrid(min_x, min_y, width, height, tile_data)
+        offset += width * height
+        light_data = bytearray(data[offset:offset + width * height])
+        if len(light_data) != width * height:
+            raise LevelFormatError('truncated light map')
+        light_map = LightMap(tiles, light_data)
+        offset += width * height
+        chunk_rectangles = {}
+        rectangle_size = LevelData.rectangle_struct.size
+        for _ in xrange(chunk_count):
+            chunk_x, chunk_y, rectangle_count = self.chunk_struct.unpack_from(
+                data, offset)
+            offset += self.chunk_struct.size
+            size = rectangle_count * rectangle_size
+            rectangle_data = data[offset:offset + size]
+            if len(rectangle_data) != size:
+                raise LevelFormatError('truncated chunk')
+            chunk_rectangles[chunk_x, chunk_y] = rectangle_data
+            offset += size
+        spawns = []
+        for _ in xrange(spawn_count):
+            char, x, y = self.spawn_struct.unpack_from(data, offset)
+            spawns.append((char, (x, y)))
+            offset += self.spawn_struct.size
+        return LevelData(tiles, chunk_size, chunk_rectangles, spawns,
+                         light_map)
+
+    def pack(self, source_hash, level_data):
+        tiles = level_data.tiles
+        chunks = [self.header_struct.pack(self.magic, self.version,
+                                          source_hash, tiles.min_x,
+                                          tiles.min_y, tiles.width,
+                                          tiles.height, level_data.chunk_size,
+                                          len(level_data.chunk_rectangles),
+                                          len(level_data.spawns)),
+                  str(tiles.data), str(level_data.light_map.data)]
+        rectangle_size = LevelData.rectangle_struct.size
+        for chunk_key in sorted(level_data.chunk_rectangles):
+            rectangle_data = level_data.chunk_rectangles[chunk_key]
+            chunk_x, chunk_y = chunk_key
+            chunks.append(self.chunk_struct.pack(
+                chunk_x, chunk_y, len(rectangle_data) // rectangle_size))
+            chunks.append(rectangle_data)
+        for char, (x, y) in level_data.spawns:
+            chunks.append(self.spawn_struct.pack(char, x, y))
+        return ''.join(chunks)
+
+    def write(self, path, source_hash, level_data):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first, so that a concurrent reader never
+        # sees a partially written cache file.
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(self.pack(source_hash, level_data))
+        os.rename(temp_path, path)
+
+def get_cache_dir():
+    settings_path = pyglet.resource.get_settings_path('Cloak & Dagger')
+    return os.path.join(settings_path, 'levels')
+
+def main():
+    # Compile every level under resources/levels into the level cache.
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(levelname)s: %(message)s')
+    levels_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'resources', 'levels')
+    cache_dir = get_cache_dir()
+    if len(sys.argv) >= 2:
+        cache_dir = sys.argv[1]
+    level_cache = LevelCache(cache_dir)
+    for source_path in sorted(glob.glob(os.path.join(levels_dir, '*.txt'))):
+        level_name = os.path.splitext(os.path.basename(source_path))[0]
+        with open(source_path, 'rb') as source_file:
+            source = source_file.read()
+        level_cache.load(level_name, source)
+
+if __name__ == '__main__':
+    main()
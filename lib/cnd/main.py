@@ -1,10 +1,31 @@
 from Box2D import *
+import itertools
 import logging
 import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import pyglet
 from pyglet.gl import *
 import random
 import sys
+import threading
+
+from activation import ActivationSystem
+from checkpoint import restore_checkpoint, save_checkpoint
+from hearing import HearingSystem
+from indexes import OrderedIndex
+from level import GroundProbe, LevelCache, get_cache_dir
+from navigation import NavigationGraph
+from profiler import Profiler, ProfilerOverlay
+from quality import QualityController
+from replay import Recorder, Recording
+from scheduling import AIScheduler
+from simulation import SimulationThread, Snapshot
+from spatial import SpatialGrid
+from streaming import ChunkLoader
+from vision import VisionSystem
 
 class Enumeration(object):
     def __init__(self, names):
@@ -29,10 +50,19 @@ def sign(x):
     else:
         return 0
 
+def intersects(bounds_a, bounds_b):
+    min_x_a, min_y_a, max_x_a, max_y_a = bounds_a
+    min_x_b, min_y_b, max_x_b, max_y_b = bounds_b
+    return (min_x_a < max_x_b and min_x_b < max_x_a and
+            min_y_a < max_y_b and min_y_b < max_y_a)
+
 class Actor(object):
+    __slots__ = 'game_engine', 'dormant'
+
     def __init__(self, game_engine):
         assert isinstance(game_engine, GameEngine)
         self.game_engine = game_engine
+        self.dormant = False
         self.game_engine.add_actor(self)
 
     def delete(self):
@@ -46,118 +76,153 @@ class Actor(object):
     def end_step(self, dt):
         pass
 
-    def begin_contact(self, contact):
-        pass
-
-    def end_contact(self, contact):
+    def begin_contact(self, key, other_actor, other_key):
         pass
 
-    def draw(self):
+    def end_contact(self, key, other_actor, other_key):
         pass
 
-    def debug_draw(self):
-        pass
+    def get_draw_state(self):
+        return None
 
-class TabInLevelError(Exception):
-    pass
+    def get_bounds(self, draw_state):
+        return None
 
-class LevelParser(object):
-    def __init__(self, level_file):
-        self.level_file = level_file
+    def draw(self, draw_state):
+        pass
 
-    def parse(self):
-        tiles = {}
-        for y, line in enumerate(self.level_file):
-            line = line.rstrip()
-            if '\t' in line:
-                raise TabInLevelError()
-            for x, char in enumerate(line):
-                if not char.isspace():
-                    tiles[x, -y] = char
-        return tiles
+    def debug_draw(self, debug_renderer, draw_state):
+        pass
 
 class LevelActor(Actor):
-    def __init__(self, game_engine):
+    def __init__(self, game_engine, level_name='level'):
         super(LevelActor, self).__init__(game_engine)
         self.half_tile_width = 0.5
         self.half_tile_height = 0.5
         self.player_position = 0.0, 0.0
         self.guard_positions = []
-        level_name = 'resources/levels/level.txt'
-        with pyglet.resource.file(level_name) as level_file:
-            level_parser = LevelParser(level_file)
-            self.tiles = level_parser.parse()
-        self.body = self.game_engine.world.CreateStaticBody(userData=(self, None))
-        self._init_tiles()
-
-    def _init_tiles(self):
-        for tile_position, tile_char in self.tiles.iteritems():
-            tile_x, tile_y = tile_position
-            if tile_char == '@':
-                self.player_position = self.get_tile_center(tile_x, tile_y)
-            elif tile_char == '%':
-                guard_position = self.get_tile_center(tile_x, tile_y)
-                self.guard_positions.append(guard_position)
-            elif tile_char == '/':
-                center_x, center_y = self.get_tile_center(tile_x, tile_y)
-                min_x, min_y, max_x, max_y = self.get_tile_bounds(tile_x,
-                                                                  tile_y)
-                vertices_1 = ((min_x, min_y), (max_x, min_y),
-                              (max_x, center_y), (min_x, center_y))
-                vertices_2 = ((center_x, center_y), (max_x, center_y),
-                              (max_x, max_y), (center_x, max_y))
-                user_data = self, (tile_position, tile_char)
-                self.body.CreatePolygonFixture(vertices=vertices_1,
-                                               userData=user_data)
-                self.body.CreatePolygonFixture(vertices=vertices_2,
-                                               userData=user_data)
-            elif tile_char == '\\':
-                center_x, center_y = self.get_tile_center(tile_x, tile_y)
-                min_x, min_y, max_x, max_y = self.get_tile_bounds(tile_x,
-                                                                  tile_y)
-                vertices_1 = ((min_x, min_y), (max_x, min_y),
-                              (max_x, center_y), (min_x, center_y))
-                vertices_2 = ((min_x, center_y), (center_x, center_y),
-                              (center_x, max_y), (min_x, max_y))
-                user_data = self, (tile_position, tile_char)
-                self.body.CreatePolygonFixture(vertices=vertices_1,
-                                               userData=user_data)
-                self.body.CreatePolygonFixture(vertices=vertices_2,
-                                               userData=user_data)
-            elif tile_char == '_':
-                center_x, center_y = self.get_tile_center(tile_x, tile_y)
-                min_x, min_y, max_x, max_y = self.get_tile_bounds(tile_x,
-                                                                  tile_y)
-                vertices = ((min_x, min_y), (max_x, min_y),
-                            (max_x, center_y), (min_x, center_y))
-                user_data = self, (tile_position, tile_char)
-                self.body.CreatePolygonFixture(vertices=vertices,
-                                               userData=user_data)
-            elif tile_char == '^':
-                center_x, center_y = self.get_tile_center(tile_x, tile_y)
-                min_x, min_y, max_x, max_y = self.get_tile_bounds(tile_x,
-                                                                  tile_y)
-                vertices = ((min_x, center_y), (max_x, center_y),
-                            (max_x, max_y), (min_x, max_y))
-                user_data = self, (tile_position, tile_char)
-                self.body.CreatePolygonFixture(vertices=vertices,
-                                               userData=user_data)
-            elif tile_char == '=':
-                min_x, min_y, max_x, max_y = self.get_tile_bounds(tile_x,
-                                                                  tile_y)
-                vertices = ((min_x, min_y), (max_x, min_y),
-                            (max_x, max_y), (min_x, max_y))
-                user_data = self, (tile_position, tile_char)
-                self.body.CreatePolygonFixture(vertices=vertices,
-                                               userData=user_data)
-            else:
-                min_x, min_y, max_x, max_y = self.get_tile_bounds(tile_x,
-                                                                  tile_y)
+        level_path = 'resources/levels/%s.txt' % level_name
+        with pyglet.resource.file(level_path) as level_file:
+            source = level_file.read()
+        level_cache = LevelCache(get_cache_dir())
+        level_data = level_cache.load(level_name, source)
+        self.level_data = level_data
+        self.tiles = level_data.tiles
+        # Chunks that overlap the view plus load_margin get fixtures. Chunks
+        # within prefetch_margin are loaded in the background, and chunks
+        # beyond unload_margin lose their fixtures.
+        self.load_margin = 8.0
+        self.unload_margin = 16.0
+        self.prefetch_margin = 32.0
+        self.chunk_bodies = {}
+        self.chunk_version = 0
+        self.chunk_tile_position = None
+        self.tile_listeners = []
+        self.chunk_loader = ChunkLoader(self.load_chunk)
+        self.chunk_loader.start()
+        self._init_tiles(level_data)
+        self.update_chunks(*self.player_position)
+
+    def _init_tiles(self, level_data):
+        for tile_x, tile_y in level_data.get_spawns('@'):
+            self.player_position = self.get_tile_center(tile_x, tile_y)
+        for tile_x, tile_y in level_data.get_spawns('%'):
+            guard_position = self.get_tile_center(tile_x, tile_y)
+            self.guard_positions.append(guard_position)
+        logging.debug('Merged %d tiles into %d fixtures.' %
+                      (len(self.tiles), level_data.rectangle_count))
+
+    def delete(self):
+        self.chunk_loader.stop()
+        for chunk_key in self.chunk_bodies.keys():
+            self.unload_chunk(chunk_key)
+        super(LevelActor, self).delete()
+
+    def begin_step(self, dt):
+        self.update_chunks(*self.game_engine.player_actor.body.position)
+
+    def load_chunk(self, chunk_key):
+        # Called on the chunk loader thread.
+        return [self.get_cell_bounds(*cell_rectangle) for cell_rectangle
+                in self.level_data.get_chunk_rectangles(chunk_key)]
+
+    def get_chunk_keys(self, bounds, margin):
+        min_x, min_y, max_x, max_y = bounds
+        min_tile_x, min_tile_y = self.get_tile_position(min_x - margin,
+                                                        min_y - margin)
+        max_tile_x, max_tile_y = self.get_tile_position(max_x + margin,
+                                                        max_y + margin)
+        return set(self.level_data.iter_chunk_keys(min_tile_x, min_tile_y,
+                                                   max_tile_x + 1,
+                                                   max_tile_y + 1))
+
+    def get_chunk_bounds(self, chunk_key):
+        min_tile_x, min_tile_y, max_tile_x, max_tile_y = (
+            self.level_data.get_chunk_tile_bounds(chunk_key))
+        min_x, min_y, _, _ = self.get_tile_bounds(min_tile_x, min_tile_y)
+        _, _, max_x, max_y = self.get_tile_bounds(max_tile_x - 1,
+                                                  max_tile_y - 1)
+        return min_x, min_y, max_x, max_y
+
+    def update_chunks(self, x, y):
+        tile_position = self.get_tile_position(x, y)
+        if tile_position == self.chunk_tile_position:
+            return
+        self.chunk_tile_position = tile_position
+        view_bounds = self.game_engine.get_view_bounds(x, y)
+        keep_keys = self.get_chunk_keys(view_bounds, self.unload_margin)
+        for chunk_key in self.chunk_bodies.keys():
+            if chunk_key not in keep_keys:
+                self.unload_chunk(chunk_key)
+        # Chunks that are needed now are loaded here if the background
+        # thread has not got to them yet.
+        load_keys = self.get_chunk_keys(view_bounds, self.load_margin)
+        for chunk_key in sorted(load_keys):
+            if chunk_key not in self.chunk_bodies:
+                rectangles = self.chunk_loader.get(chunk_key, wait=True)
+                self.create_chunk_body(chunk_key, rectangles)
+        prefetch_keys = self.get_chunk_keys(view_bounds, self.prefetch_margin)
+        for chunk_key in sorted(prefetch_keys - load_keys):
+            if chunk_key not in self.chunk_bodies:
+                self.chunk_loader.request(chunk_key)
+
+    def create_chunk_body(self, chunk_key, rectangles):
+        body = None
+        if rectangles:
+            fixture_id = self.game_engine.fixture_table.add(self, chunk_key)
+            body = self.game_engine.world.CreateStaticBody(
+                userData=fixture_id)
+            for min_x, min_y, max_x, max_y in rectangles:
                 vertices = ((min_x, min_y), (max_x, min_y),
                             (max_x, max_y), (min_x, max_y))
-                user_data = self, (tile_position, tile_char)
-                self.body.CreatePolygonFixture(vertices=vertices,
-                                               userData=user_data)
+                body.CreatePolygonFixture(vertices=vertices,
+                                          userData=fixture_id)
+        self.chunk_bodies[chunk_key] = body
+        self.chunk_version += 1
+
+    def set_tile(self, tile_x, tile_y, char):
+        # Changes a tile at runtime. Only the chunk of the tile is merged
+        # again, and its body is rebuilt if it is loaded. Tile listeners are
+        # called with the tile position, so that they can update their own
+        # data for the tile.
+        self.tiles.set_tile(tile_x, tile_y, char)
+        chunk_key = self.level_data.get_chunk_key(tile_x, tile_y)
+        self.level_data.merge_chunk(chunk_key)
+        rectangles = self.load_chunk(chunk_key)
+        self.chunk_loader.put(chunk_key, rectangles)
+        if chunk_key in self.chunk_bodies:
+            self.unload_chunk(chunk_key)
+            self.create_chunk_body(chunk_key, rectangles)
+        for tile_listener in self.tile_listeners:
+            tile_listener(tile_x, tile_y)
+
+    def unload_chunk(self, chunk_key):
+        body = self.chunk_bodies.pop(chunk_key)
+        if body is not None:
+            fixture_id = body.userData
+            self.game_engine.world.DestroyBody(body)
+            self.game_engine.fixture_table.remove(fixture_id)
+        self.chunk_version += 1
 
     def get_tile_center(self, tile_x, tile_y):
         center_x = 2.0 * tile_x * self.half_tile_width
@@ -172,6 +237,33 @@ class LevelActor(Actor):
         max_y = center_y + self.half_tile_height
         return min_x, min_y, max_x, max_y
 
+    def get_cell_bounds(self, min_cell_x, min_cell_y, max_cell_x, max_cell_y):
+        min_x = float(min_cell_x - 1) * self.half_tile_width
+        min_y = float(min_cell_y - 1) * self.half_tile_height
+        max_x = float(max_cell_x - 1) * self.half_tile_width
+        max_y = float(max_cell_y - 1) * self.half_tile_height
+        return min_x, min_y, max_x, max_y
+
+    def get_tile_position(self, x, y):
+        tile_x = int(math.floor(0.5 * x / self.half_tile_width + 0.5))
+        tile_y = int(math.floor(0.5 * y / self.half_tile_height + 0.5))
+        return tile_x, tile_y
+
+    def find_tile(self, point, normal):
+        # Returns the (tile position, tile char) of the tile that a contact
+        # or hit point of a chunk fixture is on, or None. The point is on
+        # the surface of the tile, so it is moved a little against the
+        # normal, which points out of the tile, into the solid cell.
+        x, y = point
+        normal_x, normal_y = normal
+        x -= 0.01 * self.half_tile_width * normal_x
+        y -= 0.01 * self.half_tile_height * normal_y
+        tile_position = self.get_tile_position(x, y)
+        tile_char = self.tiles.get_tile(*tile_position)
+        if tile_char is None:
+            return None
+        return tile_position, tile_char
+
 class Controls(object):
     def on_key_press(self, key, modifiers):
         pass
@@ -180,6 +272,9 @@ class Controls(object):
         pass
 
 class CharacterControls(object):
+    __slots__ = 'left', 'right', 'up', 'down', 'jump'
+    flag_names = __slots__
+
     def __init__(self):
         self.left = False
         self.right = False
@@ -211,23 +306,16 @@ class CharacterControls(object):
         if key == pyglet.window.key.SPACE:
             self.jump = False
 
-class ClosestRayCastCallback(b2RayCastCallback):
-    def __init__(self, filter=None):
-        super(ClosestRayCastCallback, self).__init__()
-        self.filter = filter
-        self.fixture = None
-        self.point = None
-        self.normal = None
-        self.fraction = None
-
-    def ReportFixture(self, fixture, point, normal, fraction):
-        if ((self.fraction is None or fraction < self.fraction) and
-            (self.filter is None or self.filter(fixture))):
-            self.fixture = fixture
-            self.point = point
-            self.normal = normal
-            self.fraction = fraction
-        return 1.0
+    def get_flags(self):
+        return (int(self.left) | int(self.right) << 1 | int(self.up) << 2 |
+                int(self.down) << 3 | int(self.jump) << 4)
+
+    def set_flags(self, flags):
+        self.left = bool(flags & 1)
+        self.right = bool(flags & 2)
+        self.up = bool(flags & 4)
+        self.down = bool(flags & 8)
+        self.jump = bool(flags & 16)
 
 class CharacterActor(Actor):
     states = Enumeration("""
@@ -250,6 +338,13 @@ class CharacterActor(Actor):
     ground_states = (states.CRAWL, states.CROUCH, states.PUSH, states.RUN,
                      states.STAND, states.WALK)
 
+    __slots__ = ('name', 'face', 'walk_acceleration', 'max_walk_velocity',
+                 'drift_acceleration', 'max_drift_velocity',
+                 'min_jump_velocity', 'max_jump_velocity', 'half_width',
+                 'half_height', 'eye_height', 'debug_color', '_state',
+                 'radius', 'ground_probe_length', 'ground_hit', 'body',
+                 'controls', 'touching_actors')
+
     def __init__(self, game_engine, name='UNKNOWN', position=(0.0, 0.0),
                  debug_color=(0, 255, 0)):
         super(CharacterActor, self).__init__(game_engine)
@@ -263,14 +358,27 @@ class CharacterActor(Actor):
         self.max_jump_velocity = 9.0
         self.half_width = 0.3
         self.half_height = 0.8
+        self.eye_height = 0.5
         self.debug_color = debug_color
         self._state = self.states.STAND
         self.radius = max(self.half_width, self.half_height)
+        self.ground_probe_length = self.radius + 0.75
+        self.ground_hit = None
+        fixture_id = game_engine.fixture_table.add(self)
         self.body = game_engine.world.CreateDynamicBody(position=position,
-                                                        userData=(self, None))
+                                                        userData=fixture_id)
         self.body.CreateCircleFixture(radius=self.radius, density=1.0,
-                                      isSensor=True, userData=(self, None))
+                                      isSensor=True, userData=fixture_id)
         self.controls = CharacterControls()
+        self.touching_actors = {}
+        game_engine.contact_queue.subscribe(self, (CharacterActor,))
+
+    def delete(self):
+        game_engine = self.game_engine
+        fixture_id = self.body.userData
+        game_engine.world.DestroyBody(self.body)
+        game_engine.fixture_table.remove(fixture_id)
+        super(CharacterActor, self).delete()
 
     @property
     def facing_left(self):
@@ -338,51 +446,67 @@ class CharacterActor(Actor):
 
     def end_step(self, dt):
         self.step_ground()
-        self.step_collide()
 
     def step_ground(self):
-        callback = ClosestRayCastCallback()
+        # The ground below was probed for all characters at once, before
+        # end_step.
         x, y = self.body.position
-        p1 = x, y
-        length = self.radius + 0.75
-        p2 = x, y - length
-        self.game_engine.world.RayCast(callback, p1, p2)
-        if callback.fixture is None:
+        if self.ground_hit is None:
             if self.state in self.ground_states:
                 self.state = self.states.JUMP
         else:
-            distance = callback.fraction * length
+            point, fraction, tile_index = self.ground_hit
+            distance = fraction * self.ground_probe_length
             vx, vy = self.body.linearVelocity
-            sticky = False
             if (self.state in self.ground_states or
                 self.state in self.air_states and vy < 0.0 and
                 distance < self.radius):
-                x3, y3 = callback.point
+                x3, y3 = point
                 self.body.position = x, y3 + self.radius
                 self.body.linearVelocity = vx, 0.0
                 if self.state in self.air_states:
                     self.state = self.states.STAND
+                    # Landing makes a noise that carries further the faster
+                    # the fall.
+                    self.game_engine.hearing_system.emit(
+                        x, y3 + self.radius, -vy, self)
+
+    def begin_contact(self, key, other_actor, other_key):
+        count = self.touching_actors.get(other_actor, 0)
+        if not count:
+            logging.debug('Character %s touches %s.' %
+                          (self.name, other_actor.name))
+        self.touching_actors[other_actor] = count + 1
+
+    def end_contact(self, key, other_actor, other_key):
+        count = self.touching_actors.pop(other_actor, 0) - 1
+        if count > 0:
+            self.touching_actors[other_actor] = count
+
+    def get_eye_position(self):
+        x, y = self.body.position
+        return x, y + self.eye_height
 
-    def step_collide(self):
-        for contact_edge in self.body.contacts:
-            contact = contact_edge.contact
-            fixture_a = contact.fixtureA
-            fixture_b = contact.fixtureB
-            actor_a, key_a = fixture_a.userData
-            actor_b, key_b = fixture_b.userData
-            if actor_a is self and actor_b is not self:
-                self.collide(fixture_a, fixture_b)
-            elif actor_a is not self and actor_b is self:
-                self.collide(fixture_b, fixture_a)
-
-    def collide(self, fixture_a, fixture_b):
-        pass
-
-    def debug_draw(self):
-        glColor3ub(*self.debug_color)
+    def get_sight_points(self):
+        x, y = self.body.position
+        dy = 0.75 * self.half_height
+        return (x, y + dy), (x, y), (x, y - dy)
 
+    def get_draw_state(self):
         x, y = self.body.position
-        if self.state == self.states.CROUCH:
+        return x, y, self.state, self.face
+
+    def get_bounds(self, draw_state):
+        x, y, state, face = draw_state
+        return (x - self.radius - 0.2, y - self.radius,
+                x + self.radius + 0.2, y + self.radius)
+
+    def debug_draw(self, debug_renderer, draw_state):
+        x, y, state, face = draw_state
+        if debug_renderer.draw_fixtures:
+            debug_renderer.add_circle(x, y, self.radius,
+                                      debug_renderer.shape_color)
+        if state == self.states.CROUCH:
             half_width = 0.4
             half_height = 0.4
         else:
@@ -392,22 +516,13 @@ class CharacterActor(Actor):
         min_y = y - half_height
         max_x = x + half_width
         max_y = y + half_height
-        glBegin(GL_QUADS)
-        glVertex2f(min_x, min_y)
-        glVertex2f(max_x, min_y)
-        glVertex2f(max_x, max_y)
-        glVertex2f(min_x, max_y)
-        if self.facing_left:
-            glVertex2f(min_x - 0.2, max_y - 0.2)
-            glVertex2f(min_x, max_y - 0.2)
-            glVertex2f(min_x, max_y)
-            glVertex2f(min_x - 0.2, max_y)
+        debug_renderer.add_quad(min_x, min_y, max_x, max_y, self.debug_color)
+        if face < 0:
+            debug_renderer.add_quad(min_x - 0.2, max_y - 0.2, min_x, max_y,
+                                    self.debug_color)
         else:
-            glVertex2f(max_x, max_y - 0.2)
-            glVertex2f(max_x + 0.2, max_y - 0.2)
-            glVertex2f(max_x + 0.2, max_y)
-            glVertex2f(max_x, max_y)
-        glEnd()
+            debug_renderer.add_quad(max_x, max_y - 0.2, max_x + 0.2, max_y,
+                                    self.debug_color)
 
     def on_key_press(self, key, modifiers):
         self.controls.on_key_press(key, modifiers)
@@ -415,32 +530,266 @@ class CharacterActor(Actor):
     def on_key_release(self, key, modifiers):
         self.controls.on_key_release(key, modifiers)
 
+class CharacterSystem(object):
+    # Runs begin_step for every character at once, in NumPy arrays. The
+    # movement is the same as CharacterActor.begin_step, but each velocity
+    # is read once and written at most once. Parameters are gathered on the
+    # first step after the characters change, so call invalidate() after
+    # changing the parameters of a character.
+    def __init__(self, character_actors):
+        self.character_actors = character_actors
+        self.actors = []
+        self.dirty = True
+        states = CharacterActor.states
+        self.ground_table = numpy.zeros(len(states.names), dtype=bool)
+        self.ground_table[list(CharacterActor.ground_states)] = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    def _gather_parameters(self):
+        actors = list(self.character_actors)
+        self.actors = actors
+        def gather(name):
+            return numpy.array([getattr(actor, name) for actor in actors],
+                               dtype=numpy.float64)
+        self.walk_accelerations = gather('walk_acceleration')
+        self.max_walk_velocities = gather('max_walk_velocity')
+        self.drift_accelerations = gather('drift_acceleration')
+        self.max_drift_velocities = gather('max_drift_velocity')
+        self.min_jump_velocities = gather('min_jump_velocity')
+        self.max_jump_velocities = gather('max_jump_velocity')
+        self.dirty = False
+
+    def begin_step(self, dt):
+        if self.dirty:
+            self._gather_parameters()
+        actors = self.actors
+        count = len(actors)
+        if not count:
+            return
+        states = CharacterActor.states
+        chain = itertools.chain.from_iterable
+        controls = [actor.controls for actor in actors]
+        columns = numpy.fromiter(
+            chain((control.right - control.left, control.jump, actor.face,
+                   actor._state) for control, actor in zip(controls, actors)),
+            numpy.int8, 4 * count).reshape(count, 4)
+        face_inputs = columns[:, 0]
+        faces = columns[:, 2]
+        old_states = columns[:, 3]
+        velocities = numpy.fromiter(
+            chain(actor.body.linearVelocity for actor in actors),
+            numpy.float64, 2 * count).reshape(count, 2)
+        old_vx = velocities[:, 0]
+        old_vy = velocities[:, 1]
+        vx = old_vx
+        vy = old_vy
+
+        moving = face_inputs != 0
+        new_faces = numpy.where(moving, face_inputs, faces)
+
+        # Jump.
+        jumping = (columns[:, 1] != 0) & self.ground_table[old_states]
+        ratios = numpy.minimum(numpy.abs(vx) / self.max_walk_velocities, 1.0)
+        ratios **= 2
+        jump_vy = (ratios * self.min_jump_velocities +
+                   (1.0 - ratios) * self.max_jump_velocities)
+        vy = numpy.where(jumping, jump_vy, vy)
+        new_states = numpy.where(jumping, states.JUMP, old_states)
+        new_states[moving & (new_states == states.STAND)] = states.WALK
+        new_states[~moving & (new_states == states.WALK)] = states.STAND
+
+        # Walk.
+        walking = new_states == states.WALK
+        walk_vx = vx + new_faces * dt * self.walk_accelerations
+        walk_vx = (numpy.sign(walk_vx) *
+                   numpy.minimum(numpy.abs(walk_vx), self.max_walk_velocities))
+
+        # Stand.
+        standing = new_states == states.STAND
+        signs = numpy.sign(vx)
+        stand_vx = vx - signs * dt * self.walk_accelerations
+        stand_vx[numpy.sign(stand_vx) != signs] = 0.0
+
+        # Drift while jumping.
+        drifting = (new_states == states.JUMP) & moving
+        drift_vx = vx + face_inputs * dt * self.drift_accelerations
+        capped_vx = (numpy.sign(drift_vx) *
+                     numpy.minimum(numpy.abs(drift_vx),
+                                   self.max_drift_velocities))
+        capped_vx = signs * numpy.maximum(numpy.abs(vx),
+                                          numpy.abs(capped_vx))
+        drift_vx = numpy.where(signs == face_inputs, capped_vx, drift_vx)
+
+        vx = numpy.select([walking, standing, drifting],
+                          [walk_vx, stand_vx, drift_vx], vx)
+
+        # Write back only what changed. Characters never sleep, so skipping a
+        # velocity that is written back unchanged does not change the step.
+        for i in numpy.flatnonzero(new_faces != faces).tolist():
+            actors[i].face = int(new_faces[i])
+        for i in numpy.flatnonzero(new_states != old_states).tolist():
+            actors[i].state = int(new_states[i])
+        changed = (vx != old_vx) | (vy != old_vy)
+        vx = vx.tolist()
+        vy = vy.tolist()
+        for i in numpy.flatnonzero(changed).tolist():
+            actors[i].body.linearVelocity = vx[i], vy[i]
+
 class AI(object):
-    def __init__(self, actor):
+    # Patrols between the segments of the navigation graph, or walks left
+    # and right at random without one. A planned path is followed by
+    # steering every step, until the guard arrives or gets lost. Paths are
+    # planned again when the navigation graph changes.
+    __slots__ = ('actor', 'navigation_graph', 'min_turn_delay',
+                 'max_turn_delay', 'turn_time', 'path', 'path_version',
+                 'goal_x', 'goal_y', 'goal_segment_id', 'steering')
+
+    def __init__(self, actor, navigation_graph=None):
         assert isinstance(actor, CharacterActor)
         self.actor = actor
+        self.navigation_graph = navigation_graph
         self.min_turn_delay = 1.0
         self.max_turn_delay = 5.0
         self.turn_time = 0.0
+        self.path = None
+        self.path_version = None
+        self.goal_x = None
+        self.goal_y = None
+        self.goal_segment_id = None
+        self.steering = False
         self.update_turn_time()
 
     def update_turn_time(self):
-        turn_delay = random.uniform(self.min_turn_delay, self.max_turn_delay)
+        turn_delay = self.actor.game_engine.random.uniform(
+            self.min_turn_delay, self.max_turn_delay)
         self.turn_time = self.actor.game_engine.time + turn_delay
 
     def think(self):
         if self.actor.game_engine.time > self.turn_time:
             self.update_turn_time()
+            if self.navigation_graph is not None:
+                if not self.steering:
+                    self.plan_patrol()
+                return
             controls = self.actor.controls
             if controls.left or controls.right:
                 controls.left = False
                 controls.right = False
             else:
-                if random.random() < 0.5:
+                if self.actor.game_engine.random.random() < 0.5:
                     controls.left = True
                 else:
                     controls.right = True
 
+    def plan_patrol(self):
+        # Walks to a random point of the current segment, or to one of the
+        # segments that it links to.
+        random = self.actor.game_engine.random
+        x, y = self.actor.body.position
+        segment = self.navigation_graph.find_segment(x, y)
+        if segment is None:
+            return
+        if segment.links and random.random() < 0.5:
+            link = random.choice(segment.links)
+            segment = self.navigation_graph.segments[link.target]
+        cx = random.randint(segment.min_cx, segment.max_cx)
+        goal_x = self.navigation_graph.get_x(cx)
+        goal_y = (segment.get_height(cx) *
+                  self.navigation_graph.half_tile_height + self.actor.radius)
+        self.go_to(goal_x, goal_y)
+
+    def go_to(self, x, y):
+        # Plans a path to a point on the navigation graph. Returns False if
+        # there is none.
+        graph = self.navigation_graph
+        start_x, start_y = self.actor.body.position
+        start_segment = graph.find_segment(start_x, start_y)
+        goal_segment = graph.find_segment(x, y)
+        if start_segment is None or goal_segment is None:
+            return False
+        path = graph.find_path(start_segment, goal_segment)
+        if path is None:
+            return False
+        self.path = list(path)
+        self.path_version = graph.version
+        self.goal_x = x
+        self.goal_y = y
+        self.goal_segment_id = goal_segment.segment_id
+        if not self.steering:
+            self.steering = True
+            self.actor.game_engine.steering_ais.add(self)
+        return True
+
+    def stop(self):
+        self.path = None
+        self.path_version = None
+        self.goal_x = None
+        self.goal_y = None
+        self.goal_segment_id = None
+        controls = self.actor.controls
+        controls.left = controls.right = controls.jump = False
+        if self.steering:
+            self.steering = False
+            self.actor.game_engine.steering_ais.remove(self)
+
+    def steer(self):
+        # Sets the controls towards the start of the next link, or the goal
+        # after the last one. Guards brake to stop on the target, and jump
+        # from standing still.
+        actor = self.actor
+        controls = actor.controls
+        if actor.state in actor.air_states:
+            controls.jump = False
+            return
+        if self.path_version != self.navigation_graph.version:
+            # The links of the path are stale, so plan again.
+            goal_x, goal_y = self.goal_x, self.goal_y
+            self.stop()
+            self.go_to(goal_x, goal_y)
+            if not self.steering:
+                return
+        x, y = actor.body.position
+        segment = self.navigation_graph.find_segment(x, y)
+        link = self.path[0] if self.path else None
+        if (segment is not None and link is not None and
+            segment.segment_id == link.target):
+            self.path.pop(0)
+            link = self.path[0] if self.path else None
+        if link is None:
+            segment_id = self.goal_segment_id
+        else:
+            segment_id = link.source
+        if segment is None or segment.segment_id != segment_id:
+            # Lost, so wait for the next patrol.
+            self.stop()
+            return
+        if link is not None and link.kind == 'drop':
+            # Walk off the end of the segment.
+            direction = sign(link.end_x - link.start_x)
+            controls.left = direction < 0
+            controls.right = direction > 0
+            return
+        target_x = self.goal_x if link is None else link.start_x
+        dx = target_x - x
+        vx, vy = actor.body.linearVelocity
+        stop_distance = 0.5 * vx * vx / actor.walk_acceleration
+        if abs(dx) > 0.25 and (sign(vx) != sign(dx) or
+                               abs(dx) > stop_distance):
+            controls.left = dx < 0.0
+            controls.right = dx > 0.0
+        elif abs(dx) > 0.25 or abs(vx) > 0.1:
+            # Brake, so that the guard stops on the target.
+            controls.left = controls.right = False
+        elif link is None:
+            self.stop()
+        else:
+            direction = sign(link.end_x - link.start_x)
+            controls.left = direction < 0
+            controls.right = direction > 0
+            controls.jump = True
+
 def generate_circle_vertices(center=(0.0, 0.0), radius=1.0, angle=0.0,
                              vertex_count=256):
     cx, cy = center
@@ -450,124 +799,653 @@ def generate_circle_vertices(center=(0.0, 0.0), radius=1.0, angle=0.0,
         vy = cy + radius * math.sin(vertex_angle)
         yield vx, vy
 
-class MyContactListener(b2ContactListener):
+class DebugRenderer(object):
+    # Each loaded level chunk gets a vertex list that is built once, kept on
+    # the GPU and looked up by view. Actors are drawn from snapshot
+    # draw states into vertex lists that are refilled every frame, so that
+    # drawing never reads the world while it is being stepped.
+    def __init__(self, game_engine):
+        self.game_engine = game_engine
+        self.shape_color = 0, 127, 0
+        self.circle_vertices = list(generate_circle_vertices(vertex_count=16))
+        self.chunk_width = 16.0
+        self.chunk_height = 16.0
+        self.static_grid = None
+        self.chunk_vertex_lists = {}
+        self.chunk_version = None
+        self.line_vertex_list = None
+        self.quad_vertex_list = None
+        self.draw_fixtures = True
+        self.line_vertices = []
+        self.line_colors = []
+        self.quad_vertices = []
+        self.quad_colors = []
+
+    def delete(self):
+        self.invalidate_static()
+        if self.line_vertex_list is not None:
+            self.line_vertex_list.delete()
+            self.line_vertex_list = None
+        if self.quad_vertex_list is not None:
+            self.quad_vertex_list.delete()
+            self.quad_vertex_list = None
+
+    def invalidate_static(self):
+        if self.static_grid is not None:
+            for body, vertex_list in self.chunk_vertex_lists.itervalues():
+                vertex_list.delete()
+            self.chunk_vertex_lists.clear()
+            self.static_grid = None
+
+    def add_line(self, x1, y1, x2, y2, color):
+        self.line_vertices.extend((x1, y1, x2, y2))
+        self.line_colors.extend(color * 2)
+
+    def add_circle(self, x, y, radius, color):
+        x1 = x + radius * self.circle_vertices[-1][0]
+        y1 = y + radius * self.circle_vertices[-1][1]
+        for vx, vy in self.circle_vertices:
+            x2 = x + radius * vx
+            y2 = y + radius * vy
+            self.add_line(x1, y1, x2, y2, color)
+            x1, y1 = x2, y2
+        self.add_line(x, y, x + radius, y, color)
+
+    def add_quad(self, min_x, min_y, max_x, max_y, color):
+        self.quad_vertices.extend((min_x, min_y, max_x, min_y,
+                                   max_x, max_y, min_x, max_y))
+        self.quad_colors.extend(color * 4)
+
+    def get_fixture_points(self, body, fixture):
+        x, y = body.position
+        cos_angle = math.cos(body.angle)
+        sin_angle = math.sin(body.angle)
+        shape = fixture.shape
+        if isinstance(shape, b2PolygonShape):
+            points = list(shape.vertices)
+        elif isinstance(shape, b2CircleShape):
+            cx, cy = shape.pos
+            radius = shape.radius
+            points = [(cx + radius * vx, cy + radius * vy)
+                      for vx, vy in self.circle_vertices]
+            points.append((cx, cy))
+            points.append((cx + radius, cy))
+        else:
+            assert False
+        return [(x + cos_angle * vx - sin_angle * vy,
+                 y + sin_angle * vx + cos_angle * vy)
+                for vx, vy in points]
+
+    def add_fixture(self, body, fixture):
+        points = self.get_fixture_points(body, fixture)
+        if isinstance(fixture.shape, b2CircleShape):
+            x1, y1, x2, y2 = points.pop(-2) + points.pop(-1)
+            self.add_line(x1, y1, x2, y2, self.shape_color)
+        x1, y1 = points[-1]
+        for x2, y2 in points:
+            self.add_line(x1, y1, x2, y2, self.shape_color)
+            x1, y1 = x2, y2
+        return points
+
+    def _update_static_grid(self):
+        # Adds vertex lists for the chunks that were loaded or rebuilt and
+        # deletes the ones of unloaded or rebuilt chunks, since the last
+        # call.
+        level_actor = self.game_engine.level_actor
+        if self.static_grid is None:
+            self.static_grid = SpatialGrid(self.chunk_width, self.chunk_height)
+        chunk_bodies = level_actor.chunk_bodies
+        for chunk_key in self.chunk_vertex_lists.keys():
+            body, vertex_list = self.chunk_vertex_lists[chunk_key]
+            if chunk_bodies.get(chunk_key) is not body:
+                del self.chunk_vertex_lists[chunk_key]
+                self.static_grid.remove(vertex_list)
+                vertex_list.delete()
+        for chunk_key, body in chunk_bodies.iteritems():
+            if body is None or chunk_key in self.chunk_vertex_lists:
+                continue
+            for fixture in body.fixtures:
+                self.add_fixture(body, fixture)
+            vertex_list = pyglet.graphics.vertex_list(
+                len(self.line_vertices) // 2,
+                ('v2f/static', self.line_vertices),
+                ('c3B/static', self.line_colors))
+            self.clear()
+            self.static_grid.insert(vertex_list,
+                                    level_actor.get_chunk_bounds(chunk_key))
+            self.chunk_vertex_lists[chunk_key] = body, vertex_list
+        self.chunk_version = level_actor.chunk_version
+
+    def clear(self):
+        del self.line_vertices[:]
+        del self.line_colors[:]
+        del self.quad_vertices[:]
+        del self.quad_colors[:]
+
+    def _update_vertex_list(self, vertex_list, vertices, colors):
+        count = len(vertices) // 2
+        if vertex_list is None:
+            vertex_list = pyglet.graphics.vertex_list(count, 'v2f/stream',
+                                                      'c3B/stream')
+        elif vertex_list.get_size() != count:
+            vertex_list.resize(count)
+        vertex_list.vertices = vertices
+        vertex_list.colors = colors
+        return vertex_list
+
+    def draw_shapes(self, view_bounds):
+        level_actor = self.game_engine.level_actor
+        if (self.static_grid is None or
+            self.chunk_version != level_actor.chunk_version):
+            with self.game_engine.lock:
+                self._update_static_grid()
+        for vertex_list in self.static_grid.query(view_bounds):
+            vertex_list.draw(GL_LINES)
+
+    def draw_actors(self, view_bounds, draw_states):
+        for actor, draw_state in draw_states:
+            if draw_state is not None:
+                bounds = actor.get_bounds(draw_state)
+                if bounds is None or intersects(bounds, view_bounds):
+                    actor.debug_draw(self, draw_state)
+        self.flush()
+
+    def flush(self):
+        if self.line_vertices:
+            self.line_vertex_list = self._update_vertex_list(
+                self.line_vertex_list, self.line_vertices, self.line_colors)
+            self.line_vertex_list.draw(GL_LINES)
+        if self.quad_vertices:
+            self.quad_vertex_list = self._update_vertex_list(
+                self.quad_vertex_list, self.quad_vertices, self.quad_colors)
+            self.quad_vertex_list.draw(GL_QUADS)
+        self.clear()
+
+class LightRenderer(object):
+    # Darkens the level by its light map, drawn as one alpha texture with a
+    # texel per tile, stretched over the tile grid. Linear filtering blends
+    # the light between tile centers. Tiles that were baked again are
+    # uploaded before the next draw.
+    def __init__(self, game_engine):
+        self.game_engine = game_engine
+        self.texture = None
+        self.dark_table = ''.join(chr(255 - i) for i in xrange(256))
+
+    def delete(self):
+        self.texture = None
+
+    def get_image_data(self, min_x, min_y, max_x, max_y):
+        light_map = self.game_engine.light_map
+        rows = [str(light_map.get_row(y, min_x, max_x))
+                for y in xrange(min_y, max_y)]
+        data = ''.join(rows).translate(self.dark_table)
+        return pyglet.image.ImageData(max_x - min_x, max_y - min_y, 'A', data)
+
+    def _update_texture(self):
+        light_map = self.game_engine.light_map
+        tiles = light_map.tiles
+        if self.texture is None:
+            self.texture = self.get_image_data(*tiles.bounds).get_texture()
+        elif light_map.dirty_bounds is not None:
+            min_x, min_y, max_x, max_y = light_map.dirty_bounds
+            self.texture.blit_into(
+                self.get_image_data(min_x, min_y, max_x, max_y),
+                min_x - tiles.min_x, min_y - tiles.min_y, 0)
+        light_map.dirty_bounds = None
+
+    def draw(self):
+        game_engine = self.game_engine
+        light_map = game_engine.light_map
+        if self.texture is None or light_map.dirty_bounds is not None:
+            with game_engine.lock:
+                self._update_texture()
+        tiles = light_map.tiles
+        level_actor = game_engine.level_actor
+        min_x, min_y, _, _ = level_actor.get_tile_bounds(tiles.min_x,
+                                                         tiles.min_y)
+        glPushAttrib(GL_ENABLE_BIT | GL_COLOR_BUFFER_BIT | GL_CURRENT_BIT)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        glColor4ub(0, 0, 0, 255)
+        self.texture.blit(min_x, min_y,
+                          width=(2.0 * level_actor.half_tile_width *
+                                 tiles.width),
+                          height=(2.0 * level_actor.half_tile_height *
+                                  tiles.height))
+        glPopAttrib()
+
+class FixtureTable(object):
+    # The user data of bodies and fixtures is an integer ID into a table of
+    # (actor, key) records, shared by all fixtures of a body. IDs of removed
+    # records are reused.
+    def __init__(self):
+        self.records = []
+        self.free_ids = []
+
+    def __len__(self):
+        return len(self.records) - len(self.free_ids)
+
+    def __getitem__(self, fixture_id):
+        return self.records[fixture_id]
+
+    def add(self, actor, key=None):
+        record = actor, key
+        if self.free_ids:
+            fixture_id = self.free_ids.pop()
+            self.records[fixture_id] = record
+        else:
+            fixture_id = len(self.records)
+            self.records.append(record)
+        return fixture_id
+
+    def remove(self, fixture_id):
+        self.records[fixture_id] = None
+        self.free_ids.append(fixture_id)
+
+class ContactQueue(b2ContactListener):
+    # Buffers the contact events of world.Step, to be dispatched in one
+    # batch after it. Actors subscribe to contacts with the actor types they
+    # care about, and other contacts, like those between level chunks, are
+    # dropped as they happen. Events from outside a step, like the end
+    # contacts of a destroyed body, wait for the next dispatch.
+    def __init__(self, fixture_table):
+        super(ContactQueue, self).__init__()
+        self.fixture_table = fixture_table
+        self.subscriptions = {}
+        self.events = []
+        self.event_count = 0
+
+    def subscribe(self, actor, actor_types):
+        self.subscriptions[actor] = tuple(actor_types)
+
+    def unsubscribe(self, actor):
+        self.subscriptions.pop(actor, None)
+
     def BeginContact(self, contact):
-        actor_a, key_a = contact.fixtureA.userData
-        actor_b, key_b = contact.fixtureB.userData
-        actor_a.begin_contact(contact)
-        actor_b.begin_contact(contact)
+        self.queue(True, contact)
 
     def EndContact(self, contact):
-        actor_a, key_a = contact.fixtureA.userData
-        actor_b, key_b = contact.fixtureB.userData
-        actor_a.end_contact(contact)
-        actor_b.end_contact(contact)
+        self.queue(False, contact)
+
+    def queue(self, begin, contact):
+        fixture_table = self.fixture_table
+        actor_a, key_a = fixture_table[contact.fixtureA.userData]
+        actor_b, key_b = fixture_table[contact.fixtureB.userData]
+        if actor_a is actor_b:
+            return
+        actor_types = self.subscriptions.get(actor_a)
+        if actor_types and isinstance(actor_b, actor_types):
+            self.events.append((begin, actor_a, key_a, actor_b, key_b))
+        actor_types = self.subscriptions.get(actor_b)
+        if actor_types and isinstance(actor_a, actor_types):
+            self.events.append((begin, actor_b, key_b, actor_a, key_a))
+
+    def dispatch(self):
+        # Actors that unsubscribed since their events were queued, by being
+        # removed, do not get them.
+        events = self.events
+        self.events = []
+        self.event_count = len(events)
+        subscriptions = self.subscriptions
+        for begin, actor, key, other_actor, other_key in events:
+            if actor in subscriptions:
+                if begin:
+                    actor.begin_contact(key, other_actor, other_key)
+                else:
+                    actor.end_contact(key, other_actor, other_key)
 
 class GameEngine(object):
-    def __init__(self, view_width, view_height):
+    phase_names = ('activate', 'think', 'begin_step', 'step_world', 'end_step',
+                   'update_vision', 'update_hearing', 'draw_shapes',
+                   'draw_actors', 'draw_light')
+    counter_names = ('bodies', 'fixtures', 'contacts', 'events', 'probes',
+                     'rays', 'noises', 'floods', 'thinks', 'dormant',
+                     'chunks', 'quality')
+
+    def __init__(self, view_width, view_height, level_name='level',
+                 guard_count=None, seed=None, profiler=None,
+                 batch_characters=True, activation_radius=24.0,
+                 navigation=True, quality_level_index=0, dt=1.0 / 60.0):
         self.view_width = view_width
         self.view_height = view_height
+        self.level_name = level_name
+        self.guard_count = guard_count
+        self.dt = dt
         self.time = 0.0
+        self.step_count = 0
+        self.probe_count = 0
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.input_filters = []
+        self.lock = threading.Lock()
+        if profiler is None:
+            profiler = Profiler(self.phase_names, self.counter_names)
+        self.profiler = profiler
         self.world = b2World(gravity=(0.0, -13.0))
-        self.contact_listener = MyContactListener()
-        self.world.contactListener = self.contact_listener
-        self.actors = []
+        self.fixture_table = FixtureTable()
+        self.contact_queue = ContactQueue(self.fixture_table)
+        self.world.contactListener = self.contact_queue
+        # Actors by type, and the ones that are not dormant. The level actor
+        # is self.level_actor, and the AIs of guards are in self.ais.
+        self.actors = OrderedIndex()
+        self.character_actors = OrderedIndex()
+        self.guard_actors = OrderedIndex()
+        self.active_actors = OrderedIndex()
+        self.active_character_actors = OrderedIndex()
         self.ais = {}
+        self.ai_scheduler = AIScheduler()
+        self.steering_ais = OrderedIndex()
+        self.indexes = (self.actors, self.character_actors,
+                        self.guard_actors, self.active_actors,
+                        self.active_character_actors, self.steering_ais)
+        self.observer_actors = []
+        self.navigation_graph = None
+        self.character_system = None
+        if batch_characters and numpy is not None:
+            self.character_system = CharacterSystem(
+                self.active_character_actors)
+        self.activation_system = None
+        if activation_radius is not None:
+            self.activation_system = ActivationSystem(self, activation_radius)
         self.camera_scale = float(view_height) / 20.0
-        self.level_actor = LevelActor(self)
+        self.level_actor = LevelActor(self, level_name)
         player_position = self.level_actor.player_position
         self.player_actor = CharacterActor(self, name='THIEF',
                                            position=player_position,
                                            debug_color=(0, 127, 255))
-        for i, guard_position in enumerate(self.level_actor.guard_positions):
+        guard_positions = self.level_actor.guard_positions
+        if guard_count is not None and guard_positions:
+            guard_positions = [guard_positions[i % len(guard_positions)]
+                               for i in xrange(guard_count)]
+        for i, guard_position in enumerate(guard_positions):
             guard_name = 'GUARD_%s' % i
             guard_actor = CharacterActor(self, name=guard_name,
                                          position=guard_position,
                                          debug_color=(255, 127, 0))
             guard_actor.walk_acceleration = 5.0
             guard_actor.max_walk_velocity = 3.0
-            if random.randrange(2):
-                guard_actor.left = True
-            else:
-                guard_actor.right = True
-            self.ais[guard_actor] = AI(guard_actor)
-        self.circle_vertices = list(generate_circle_vertices())
+            if navigation and self.navigation_graph is None:
+                self.navigation_graph = self.create_navigation_graph(
+                    guard_actor)
+            if self.navigation_graph is None:
+                if self.random.randrange(2):
+                    guard_actor.controls.left = True
+                else:
+                    guard_actor.controls.right = True
+            ai = AI(guard_actor, self.navigation_graph)
+            self.ais[guard_actor] = ai
+            self.ai_scheduler.add(ai)
+            self.guard_actors.add(guard_actor)
+            if self.activation_system is not None:
+                self.activation_system.add(guard_actor)
+        level_actor = self.level_actor
+        self.ground_probe = GroundProbe(level_actor.tiles,
+                                        level_actor.half_tile_width,
+                                        level_actor.half_tile_height)
+        self.light_map = level_actor.level_data.light_map
+        level_actor.tile_listeners.append(self.light_map.invalidate_tile)
+        self.vision_system = VisionSystem(level_actor.tiles,
+                                          2.0 * level_actor.half_tile_width,
+                                          2.0 * level_actor.half_tile_height,
+                                          self.light_map)
+        self.hearing_system = HearingSystem(level_actor.tiles,
+                                            2.0 * level_actor.half_tile_width,
+                                            2.0 * level_actor.half_tile_height)
+        level_actor.tile_listeners.append(self.hearing_system.invalidate_tile)
+        self.debug_renderer = DebugRenderer(self)
+        self.light_renderer = LightRenderer(self)
+        self.set_quality_level(quality_level_index)
+
+    def set_quality_level(self, level_index):
+        self.quality_level_index = level_index
+        self.quality_level = QualityController.levels[level_index]
+        self.debug_renderer.draw_fixtures = self.quality_level.draw_fixtures
+
+    def create_navigation_graph(self, character_actor):
+        # Builds the navigation graph for characters like the given one.
+        level_actor = self.level_actor
+        navigation_graph = NavigationGraph(
+            level_actor.tiles, level_actor.half_tile_width,
+            level_actor.half_tile_height,
+            walk_velocity=character_actor.max_walk_velocity,
+            walk_acceleration=character_actor.walk_acceleration,
+            jump_velocity=character_actor.max_jump_velocity,
+            drift_velocity=character_actor.max_drift_velocity,
+            drift_acceleration=character_actor.drift_acceleration,
+            gravity=-self.world.gravity[1], radius=character_actor.radius,
+            dt=self.dt)
+        level_actor.tile_listeners.append(navigation_graph.invalidate_tile)
+        return navigation_graph
 
     def delete(self):
-        for actor in self.actors[:]:
+        for actor in self.actors:
             actor.delete()
         assert not self.actors
+        self.debug_renderer.delete()
+        self.light_renderer.delete()
 
     def add_actor(self, actor):
-        assert actor not in self.actors
-        self.actors.append(actor)
+        self.actors.add(actor)
+        self.active_actors.add(actor)
+        if isinstance(actor, CharacterActor):
+            self.character_actors.add(actor)
+            self.active_character_actors.add(actor)
+            if self.character_system is not None:
+                self.character_system.invalidate()
 
     def remove_actor(self, actor):
-        assert actor in self.actors
         self.actors.remove(actor)
+        self.contact_queue.unsubscribe(actor)
+        if not actor.dormant:
+            self.active_actors.remove(actor)
+        if isinstance(actor, CharacterActor):
+            self.character_actors.remove(actor)
+            if not actor.dormant:
+                self.active_character_actors.remove(actor)
+            if self.character_system is not None:
+                self.character_system.invalidate()
+        ai = self.ais.pop(actor, None)
+        if ai is not None and ai.steering:
+            ai.stop()
+        if ai is not None and not actor.dormant:
+            self.ai_scheduler.remove(ai)
+        if actor in self.guard_actors:
+            self.guard_actors.remove(actor)
+            if self.activation_system is not None:
+                self.activation_system.remove(actor)
+
+    def sleep_actor(self, actor):
+        assert not actor.dormant
+        actor.dormant = True
+        actor.body.active = False
+        self.active_actors.remove(actor)
+        self.active_character_actors.remove(actor)
+        if self.character_system is not None:
+            self.character_system.invalidate()
+        ai = self.ais.get(actor)
+        if ai is not None:
+            self.ai_scheduler.remove(ai)
+            if ai.steering:
+                ai.stop()
+
+    def wake_actor(self, actor):
+        assert actor.dormant
+        actor.dormant = False
+        actor.body.active = True
+        self.active_actors.add(actor)
+        self.active_character_actors.add(actor)
+        if self.character_system is not None:
+            self.character_system.invalidate()
+        ai = self.ais.get(actor)
+        if ai is not None:
+            ai.update_turn_time()
+            self.ai_scheduler.add(ai)
 
     def step(self, dt):
         self.time += dt
-        if self.actors:
-            actor = random.choice(self.actors)
-            ai = self.ais.get(actor)
-            if ai is not None:
-                ai.think()
-        for actor in self.actors[:]:
-            actor.begin_step(dt)
-        self.world.Step(dt, 10, 10)
-        for actor in self.actors[:]:
-            actor.end_step(dt)
+        self.step_count += 1
+        profiler = self.profiler
+        if self.activation_system is not None:
+            profiler.call('activate', self.activation_system.update)
+        profiler.call('think', self.think)
+        for input_filter in self.input_filters:
+            input_filter.filter_input(self)
+        profiler.call('begin_step', self.begin_step, dt)
+        profiler.call('step_world', self.step_world, dt)
+        profiler.call('end_step', self.end_step, dt)
+        profiler.call('update_vision', self.update_vision)
+        profiler.call('update_hearing', self.update_hearing)
+        for index in self.indexes:
+            index.compact()
+        if profiler.enabled:
+            self.count()
+            profiler.end_record('step', self.time)
+
+    def count(self):
+        profiler = self.profiler
+        profiler.set_counter('bodies', self.world.bodyCount)
+        fixture_count = sum(len(body.fixtures) for body in self.world.bodies)
+        profiler.set_counter('fixtures', fixture_count)
+        profiler.set_counter('contacts', self.world.contactCount)
+        profiler.set_counter('events', self.contact_queue.event_count)
+        profiler.set_counter('probes', self.probe_count)
+        profiler.set_counter('rays', self.vision_system.ray_count)
+        profiler.set_counter('noises', self.hearing_system.noise_count)
+        profiler.set_counter('floods', self.hearing_system.flood_count)
+        profiler.set_counter('thinks', self.ai_scheduler.think_count)
+        profiler.set_counter('dormant',
+                             len(self.actors) - len(self.active_actors))
+        profiler.set_counter('chunks', len(self.level_actor.chunk_bodies))
+        profiler.set_counter('quality', self.quality_level_index)
 
-    def draw(self):
+    def think(self):
+        self.ai_scheduler.think(self.time)
+        for ai in self.steering_ais:
+            ai.steer()
+
+    def begin_step(self, dt):
+        character_system = self.character_system
+        if character_system is None:
+            for actor in self.active_actors:
+                actor.begin_step(dt)
+        else:
+            character_system.begin_step(dt)
+            for actor in self.active_actors:
+                if not isinstance(actor, CharacterActor):
+                    actor.begin_step(dt)
+
+    def step_world(self, dt):
+        quality_level = self.quality_level
+        self.world.Step(dt, quality_level.velocity_iterations,
+                        quality_level.position_iterations)
+        self.contact_queue.dispatch()
+
+    def end_step(self, dt):
+        character_actors = list(self.active_character_actors)
+        origins = [actor.body.position for actor in character_actors]
+        skipped_actors = self.get_skipped_actors(character_actors, origins, dt)
+        if skipped_actors:
+            probed = [i for i, actor in enumerate(character_actors)
+                      if actor not in skipped_actors]
+            character_actors = [character_actors[i] for i in probed]
+            origins = [origins[i] for i in probed]
+        self.probe_ground(character_actors, origins)
+        self.probe_count = len(character_actors)
+        for actor in self.active_actors:
+            if actor not in skipped_actors:
+                actor.end_step(dt)
+
+    def get_skipped_actors(self, character_actors, positions, dt):
+        # Distant characters on the ground take turns to be probed, one step
+        # in probe_interval, and skip end_step in between. The ground is flat
+        # within a cell column, so a character is only skipped if it cannot
+        # walk out of its column before its next turn, and never misses a
+        # ledge. Characters in the air are probed every step, so that they
+        # land in time.
+        quality_level = self.quality_level
+        probe_interval = quality_level.probe_interval
+        skipped_actors = set()
+        if probe_interval == 1:
+            return skipped_actors
+        x, y = self.player_actor.body.position
+        max_squared_distance = quality_level.near_distance ** 2
+        ground_states = CharacterActor.ground_states
+        half_tile_width = self.level_actor.half_tile_width
+        turn = self.step_count % probe_interval
+        for i, (actor, position) in enumerate(zip(character_actors,
+                                                  positions)):
+            turns_left = (i + turn) % probe_interval
+            if turns_left and actor._state in ground_states:
+                actor_x, actor_y = position
+                if ((actor_x - x) ** 2 + (actor_y - y) ** 2 >
+                    max_squared_distance):
+                    cell_x = actor_x / half_tile_width
+                    offset = cell_x - math.floor(cell_x)
+                    reach = (actor.max_walk_velocity *
+                             (probe_interval - turns_left) * dt /
+                             half_tile_width)
+                    if reach < offset < 1.0 - reach:
+                        skipped_actors.add(actor)
+        return skipped_actors
+
+    def probe_ground(self, character_actors, origins):
+        lengths = [actor.ground_probe_length for actor in character_actors]
+        ground_hits = self.ground_probe.probe_all(origins, lengths)
+        for actor, ground_hit in zip(character_actors, ground_hits):
+            actor.ground_hit = ground_hit
+
+    def update_vision(self):
+        guard_actors = [actor for actor in self.active_character_actors
+                        if actor in self.ais]
+        self.observer_actors = guard_actors
+        eyes = [guard_actor.get_eye_position() for guard_actor in guard_actors]
+        faces = [guard_actor.face for guard_actor in guard_actors]
+        player_actor = self.player_actor
+        self.vision_system.update(eyes, faces, player_actor.body.position,
+                                  player_actor.get_sight_points())
+
+    def update_hearing(self):
+        # Guards hear the noises of every character but their own.
+        guard_actors = self.observer_actors
+        positions = [guard_actor.body.position for guard_actor in guard_actors]
+        self.hearing_system.update(guard_actors, positions)
+
+    def get_snapshot(self):
+        camera_position = tuple(self.player_actor.body.position)
+        draw_states = [(actor, actor.get_draw_state())
+                       for actor in self.active_actors]
+        return Snapshot(self.time, camera_position, draw_states)
+
+    def draw(self, snapshot):
         glPushMatrix()
         glTranslatef(self.view_width // 2, self.view_height // 2, 0)
         glScalef(self.camera_scale, self.camera_scale, self.camera_scale)
-        x, y = self.player_actor.body.position
+        x, y = snapshot.camera_position
         glTranslatef(-x, -y, 0.0)
-        for actor in self.actors:
-            actor.draw()
-        self.debug_draw()
+        view_bounds = self.get_view_bounds(x, y)
+        profiler = self.profiler
+        profiler.call('draw_shapes', self.debug_renderer.draw_shapes,
+                      view_bounds)
+        profiler.call('draw_actors', self.draw_actors, view_bounds,
+                      snapshot.draw_states)
+        profiler.call('draw_light', self.light_renderer.draw)
         glPopMatrix()
+        if profiler.enabled:
+            profiler.end_record('draw', snapshot.time)
 
-    def debug_draw(self):
-        self.debug_draw_shapes()
-        self.debug_draw_actors()
-
-    def debug_draw_shapes(self):
-        glColor3ub(0, 127, 0)
-        for body in self.world.bodies:
-            glPushMatrix()
-            x, y = body.position
-            glTranslatef(x, y, 0.0)
-            angle = body.angle * 180.0 / math.pi
-            glRotatef(angle, 0.0, 0.0, 1.0)
-            for fixture in body.fixtures:
-                shape = fixture.shape
-                if isinstance(shape, b2PolygonShape):
-                    glBegin(GL_LINE_LOOP)
-                    for vx, vy in shape.vertices:
-                        glVertex2f(vx, vy)
-                    glEnd()
-                elif isinstance(shape, b2CircleShape):
-                    cx, cy = shape.pos
-                    radius = shape.radius
-                    glBegin(GL_LINE_LOOP)
-                    stride = len(self.circle_vertices) / 16
-                    for vx, vy in self.circle_vertices[::stride]:
-                        glVertex2f(cx + radius * vx, cy + radius * vy)
-                    glEnd()
-                    glBegin(GL_LINES)
-                    glVertex2f(cx, cy)
-                    glVertex2f(cx + radius, cy)
-                    glEnd()
-                else:
-                    assert False
-            glPopMatrix()
+    def draw_actors(self, view_bounds, draw_states):
+        for actor, draw_state in draw_states:
+            bounds = actor.get_bounds(draw_state)
+            if bounds is None or intersects(bounds, view_bounds):
+                actor.draw(draw_state)
+        self.debug_renderer.draw_actors(view_bounds, draw_states)
 
-    def debug_draw_actors(self):
-        for actor in self.actors:
-            actor.debug_draw()
+    def get_view_bounds(self, x, y):
+        half_width = 0.5 * float(self.view_width) / self.camera_scale
+        half_height = 0.5 * float(self.view_height) / self.camera_scale
+        return x - half_width, y - half_height, x + half_width, y + half_height
 
     def on_key_press(self, key, modifiers):
         self.player_actor.controls.on_key_press(key, modifiers)
@@ -581,42 +1459,114 @@ class MyWindow(pyglet.window.Window):
         if self.fullscreen:
             self.set_exclusive_mouse()
             self.set_exclusive_keyboard()
-        self.game_engine = GameEngine(self.width, self.height)
-        self.time = 0.0
+        seed = get_arg_value('seed')
+        if seed is not None:
+            seed = int(seed)
+        batch_characters = '--no-batch' not in sys.argv
+        activation_radius = 24.0
+        if '--no-activation' in sys.argv:
+            activation_radius = None
+        navigation = '--no-navigation' not in sys.argv
         self.dt = 1.0 / 60.0
+        self.game_engine = GameEngine(self.width, self.height, seed=seed,
+                                      batch_characters=batch_characters,
+                                      activation_radius=activation_radius,
+                                      navigation=navigation, dt=self.dt)
         self.max_dt = 10.0 * self.dt
-        pyglet.clock.schedule_interval(self.step, 0.1 * self.dt)
         self.clock_display = pyglet.clock.ClockDisplay()
+        profiler = self.game_engine.profiler
+        profiler.enabled = '--profile' in sys.argv
+        trace_path = get_arg_value('profile-trace')
+        if trace_path is not None:
+            profiler.enabled = True
+            profiler.open_trace(trace_path)
+        self.recording_path = get_arg_value('record')
+        self.recording = None
+        if self.recording_path is not None:
+            self.recording = Recording(
+                self.game_engine.level_name, self.game_engine.seed,
+                self.game_engine.guard_count,
+                len(self.game_engine.character_actors), self.dt,
+                view_width=self.width, view_height=self.height,
+                activation_radius=activation_radius, navigation=navigation,
+                batch_characters=batch_characters)
+            recorder = Recorder(self.recording)
+            self.game_engine.input_filters.append(recorder)
+        self.profiler_overlay = ProfilerOverlay(profiler, 10,
+                                                self.height - 10)
+        self.profiler_overlay_visible = profiler.enabled
+        self.quicksave = None
+        # Steps at lower quality would not replay the same, so recordings
+        # are made at full quality.
+        quality_controller = None
+        if '--no-adaptive-quality' not in sys.argv and self.recording is None:
+            quality_controller = QualityController(self.dt)
+        self.simulation_thread = SimulationThread(self.game_engine, self.dt,
+                                                  self.max_dt,
+                                                  quality_controller)
+        self.simulation_thread.start()
+        # Redraw at the display rate, which the simulation steps at too. The
+        # simulation runs on its own thread, and drawing interpolates between
+        # its snapshots.
+        pyglet.clock.schedule_interval(self.update, self.dt)
 
     def close(self):
-        pyglet.clock.unschedule(self.step)
+        pyglet.clock.unschedule(self.update)
+        self.simulation_thread.stop()
+        self.game_engine.profiler.close_trace()
+        if self.recording is not None:
+            self.recording.save(self.recording_path)
+            logging.info('Recorded %d steps to %s.' %
+                         (self.recording.step_count, self.recording_path))
         super(MyWindow, self).close()
 
-    def step(self, dt):
-        if dt > self.max_dt:
-            skip = (dt - self.max_dt) / self.dt
-            logging.debug('Skipping %g frames.' % skip)
-            dt = self.max_dt
-        self.time += dt
-        while self.game_engine.time + self.dt < self.time:
-            self.game_engine.step(self.dt)
+    def update(self, dt):
+        pass
 
     def on_draw(self):
         self.clear()
-        self.game_engine.draw()
+        snapshot = self.simulation_thread.get_interpolated_snapshot()
+        self.game_engine.draw(snapshot)
         self.clock_display.draw()
+        if self.profiler_overlay_visible:
+            self.profiler_overlay.draw()
 
     def on_key_press(self, key, modifiers):
         if key == pyglet.window.key.ESCAPE:
             self.close()
+        elif key == pyglet.window.key.F3:
+            profiler = self.game_engine.profiler
+            self.profiler_overlay_visible = not self.profiler_overlay_visible
+            profiler.enabled = (self.profiler_overlay_visible or
+                                profiler.trace_file is not None)
+        elif key == pyglet.window.key.F5:
+            with self.game_engine.lock:
+                self.quicksave = save_checkpoint(self.game_engine)
+            logging.info('Saved a checkpoint of %d bytes.' %
+                         len(self.quicksave))
+        elif key == pyglet.window.key.F9:
+            if self.quicksave is not None:
+                with self.game_engine.lock:
+                    restore_checkpoint(self.game_engine, self.quicksave)
         else:
-            self.game_engine.on_key_press(key, modifiers)
+            with self.game_engine.lock:
+                self.game_engine.on_key_press(key, modifiers)
 
     def on_key_release(self, key, modifiers):
-        if key == pyglet.window.key.ESCAPE:
+        if key in (pyglet.window.key.ESCAPE, pyglet.window.key.F3,
+                   pyglet.window.key.F5, pyglet.window.key.F9):
             pass
         else:
-            self.game_engine.on_key_release(key, modifiers)
+            with self.game_engine.lock:
+                self.game_engine.on_key_release(key, modifiers)
+
+def get_arg_value(name, default=None):
+    # Returns the value of a --name=value command line argument.
+    prefix = '--%s=' % name
+    for arg in sys.argv:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
 
 def configure_logging():
     root_logger = logging.getLogger()
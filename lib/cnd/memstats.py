@@ -0,0 +1,49 @@
+import sys
+
+def get_size(obj):
+    # The size of an object with its attribute dictionary, if it has one.
+    # Objects with __slots__ have none.
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+    return size
+
+def get_memory_stats(game_engine):
+    # Returns (name, count, bytes) rows for the objects that grow with the
+    # level size and the guard count. Shared objects, like the actor of a
+    # fixture record, are counted where they are owned.
+    rows = []
+    def add_row(name, objects, get_size=get_size):
+        objects = list(objects)
+        rows.append((name, len(objects), sum(get_size(obj)
+                                             for obj in objects)))
+    character_actors = game_engine.character_actors
+    add_row('characters', character_actors)
+    add_row('controls', [actor.controls for actor in character_actors])
+    add_row('ais', game_engine.ais.itervalues())
+    fixture_table = game_engine.fixture_table
+    records = [record for record in fixture_table.records
+               if record is not None]
+    rows.append(('fixture ids', len(records),
+                 sys.getsizeof(fixture_table.records) +
+                 sum(sys.getsizeof(record) for record in records)))
+    level_data = game_engine.level_actor.level_data
+    tiles = level_data.tiles
+    rows.append(('tiles', tiles.width * tiles.height,
+                 sys.getsizeof(tiles.data)))
+    rows.append(('light map', tiles.width * tiles.height,
+                 sys.getsizeof(level_data.light_map.data)))
+    add_row('chunks', level_data.chunk_rectangles.itervalues(),
+            sys.getsizeof)
+    return rows
+
+def write_memory_stats(report_file, rows):
+    report_file.write('%-14s %9s %12s %9s\n' %
+                      ('memory', 'count', 'bytes', 'per item'))
+    total_size = 0
+    for name, count, size in rows:
+        report_file.write('%-14s %9d %12d %9.1f\n' %
+                          (name, count, size, float(size) / max(count, 1)))
+        total_size += size
+    report_file.write('%-14s %9s %12d\n' % ('total', '', total_size))
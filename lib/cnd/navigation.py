@@ -0,0 +1,335 @@
+import heapq
+import itertools
+import math
+
+from level import TileMerger
+from streaming import LRUCache
+
+class Segment(object):
+    # A run of cell columns whose surfaces are at most one cell apart, so
+    # that a character can walk from one end to the other. Heights are the
+    # surface cell rows of the columns, starting at min_cx.
+    def __init__(self, segment_id, min_cx, heights):
+        self.segment_id = segment_id
+        self.min_cx = min_cx
+        self.heights = heights
+        self.links = []
+
+    @property
+    def max_cx(self):
+        return self.min_cx + len(self.heights) - 1
+
+    def get_height(self, cx):
+        return self.heights[cx - self.min_cx]
+
+class Link(object):
+    # A jump or drop from the source segment, taking off at start_x and
+    # landing on the target segment at end_x after cost seconds.
+    def __init__(self, kind, source, target, start_x, end_x, cost):
+        self.kind = kind
+        self.source = source
+        self.target = target
+        self.start_x = start_x
+        self.end_x = end_x
+        self.cost = cost
+
+class NavigationGraph(object):
+    # Walkable surfaces of the tile grid, split into segments and linked by
+    # the jumps and drops of a character. Surfaces are found per cell
+    # column with the same cells as GroundProbe. Jumps start from standing
+    # with jump_velocity and drift sideways, and drops walk off the end of
+    # a segment. Both are traced with the integration of the physics world,
+    # at its time step dt, and land like CharacterActor.step_ground does. A
+    # landing only counts if the character can brake to a stop on the
+    # segment it lands on.
+    def __init__(self, tiles, half_tile_width=0.5, half_tile_height=0.5,
+                 walk_velocity=3.0, walk_acceleration=5.0, jump_velocity=9.0,
+                 drift_velocity=2.0, drift_acceleration=5.0, gravity=13.0,
+                 radius=0.8, max_drop=8.0, dt=1.0 / 60.0,
+                 path_cache_size=1024):
+        self.tiles = tiles
+        self.half_tile_width = half_tile_width
+        self.half_tile_height = half_tile_height
+        self.walk_velocity = walk_velocity
+        self.walk_acceleration = walk_acceleration
+        self.jump_velocity = jump_velocity
+        self.drift_velocity = drift_velocity
+        self.drift_acceleration = drift_acceleration
+        self.gravity = gravity
+        self.radius = radius
+        self.max_drop = max_drop
+        self.dt = dt
+        self.cell_masks = TileMerger.get_cell_masks()
+        self.surfaces = {}
+        self.segments = {}
+        self.column_segments = {}
+        self.segment_ids = itertools.count()
+        self.path_cache = LRUCache(path_cache_size)
+        self.search_count = 0
+        self.dirty_columns = set()
+        self.version = 0
+        min_cx = 2 * tiles.min_x
+        max_cx = 2 * tiles.max_x - 1
+        for cx in xrange(min_cx, max_cx + 1):
+            self.surfaces[cx] = self.find_surfaces(cx)
+        self.rebuild(min_cx, max_cx)
+
+    @property
+    def reach(self):
+        # The most cell columns that a jump or drop can cross.
+        speed = max(self.walk_velocity, self.drift_velocity)
+        time = (self.jump_velocity + math.sqrt(
+            self.jump_velocity ** 2 + 2.0 * self.gravity *
+            self.max_drop)) / self.gravity
+        return int(math.ceil(speed * time / self.half_tile_width)) + 1
+
+    def get_x(self, cx):
+        return (cx - 0.5) * self.half_tile_width
+
+    def get_cx(self, x):
+        return int(math.floor(x / self.half_tile_width)) + 1
+
+    def find_surfaces(self, cx):
+        # Returns the surface cell rows of a cell column, from the bottom.
+        # A surface is the top of a solid cell with an empty cell above it.
+        tile_x, dx = divmod(cx, 2)
+        column = self.tiles.get_column(tile_x)
+        cell_masks = self.cell_masks
+        surfaces = []
+        solid_below = False
+        cell_y = 2 * self.tiles.min_y
+        for value in column:
+            for dy in (0, 1):
+                solid = cell_masks[value] >> (2 * dy + dx) & 1
+                if solid_below and not solid:
+                    surfaces.append(cell_y - 1)
+                solid_below = solid
+                cell_y += 1
+        if solid_below:
+            surfaces.append(cell_y - 1)
+        return surfaces
+
+    def find_segment(self, x, y):
+        # Returns the segment of the highest surface below (x, y), if it is
+        # at most a tile further down than a standing character, or None.
+        self.update()
+        cx = self.get_cx(x)
+        max_cell_y = int(math.floor(y / self.half_tile_height))
+        for cell_y in reversed(self.surfaces.get(cx, ())):
+            if cell_y <= max_cell_y:
+                distance = y - cell_y * self.half_tile_height
+                if distance > self.radius + 2.0 * self.half_tile_height:
+                    return None
+                return self.segments[self.column_segments[cx][cell_y]]
+        return None
+
+    def invalidate_tile(self, tile_x, tile_y):
+        # Tile listener. The surfaces, segments and links around the tile are
+        # rebuilt before the next lookup or search. The version changes, so
+        # that paths planned before can be told apart, since their links are
+        # rebuilt too.
+        self.dirty_columns.update((2 * tile_x, 2 * tile_x + 1))
+        self.version += 1
+        self.path_cache = LRUCache(self.path_cache.max_size)
+
+    def update(self):
+        # Rebuilds each run of adjacent dirty columns on its own, so that
+        # edits far apart do not rebuild everything between them.
+        if not self.dirty_columns:
+            return
+        dirty_columns = sorted(self.dirty_columns)
+        self.dirty_columns.clear()
+        for cx in dirty_columns:
+            self.surfaces[cx] = self.find_surfaces(cx)
+        min_cx = max_cx = dirty_columns[0]
+        for cx in dirty_columns[1:]:
+            if cx > max_cx + 1:
+                self.rebuild(min_cx, max_cx)
+                min_cx = cx
+            max_cx = cx
+        self.rebuild(min_cx, max_cx)
+
+    def rebuild(self, min_cx, max_cx):
+        # Removes the segments of the columns and their neighbors, widened
+        # until no segment crosses the border, then builds them again. Links
+        # are rebuilt for every segment within reach.
+        columns = set()
+        stack = range(min_cx - 1, max_cx + 2)
+        while stack:
+            cx = stack.pop()
+            if cx in columns:
+                continue
+            columns.add(cx)
+            for segment_id in self.column_segments.pop(cx, {}).itervalues():
+                segment = self.segments.pop(segment_id, None)
+                if segment is not None:
+                    stack.extend(xrange(segment.min_cx, segment.max_cx + 1))
+        min_cx = min(columns)
+        max_cx = max(columns)
+        self._build_segments(min_cx, max_cx)
+        reach = self.reach
+        for segment_id in self.get_segment_ids(min_cx - reach,
+                                               max_cx + reach):
+            self._build_links(self.segments[segment_id])
+
+    def get_segment_ids(self, min_cx, max_cx):
+        segment_ids = set()
+        for cx in xrange(min_cx, max_cx + 1):
+            segment_ids.update(self.column_segments.get(cx, {}).itervalues())
+        return sorted(segment_ids)
+
+    def _build_segments(self, min_cx, max_cx):
+        # Extends each segment into the next column through the closest
+        # surface that is at most one cell higher or lower.
+        open_segments = []
+        for cx in xrange(min_cx, max_cx + 2):
+            surfaces = self.surfaces.get(cx, ()) if cx <= max_cx else ()
+            next_segments = []
+            taken = set()
+            for heights, start_cx in open_segments:
+                height = heights[-1]
+                candidates = [cell_y for cell_y in surfaces
+                              if abs(cell_y - height) <= 1 and
+                              cell_y not in taken]
+                if candidates:
+                    cell_y = min(candidates,
+                                 key=lambda cell_y: abs(cell_y - height))
+                    taken.add(cell_y)
+                    heights.append(cell_y)
+                    next_segments.append((heights, start_cx))
+                else:
+                    self._add_segment(start_cx, heights)
+            for cell_y in surfaces:
+                if cell_y not in taken:
+                    next_segments.append(([cell_y], cx))
+            open_segments = next_segments
+
+    def _add_segment(self, min_cx, heights):
+        segment = Segment(next(self.segment_ids), min_cx, heights)
+        self.segments[segment.segment_id] = segment
+        for i, cell_y in enumerate(heights):
+            self.column_segments.setdefault(min_cx + i, {})[cell_y] = (
+                segment.segment_id)
+
+    def _build_links(self, segment):
+        # Keeps the cheapest link to each other segment, with drops off
+        # both ends and standing jumps from every tile of the segment.
+        best_links = {}
+        def add_link(link):
+            if link is not None and link.target != segment.segment_id:
+                best_link = best_links.get(link.target)
+                if best_link is None or link.cost < best_link.cost:
+                    best_links[link.target] = link
+        add_link(self._trace(segment, segment.max_cx, 1, 'drop'))
+        add_link(self._trace(segment, segment.min_cx, -1, 'drop'))
+        for cx in xrange(segment.min_cx, segment.max_cx + 1, 2):
+            add_link(self._trace(segment, cx, 1, 'jump'))
+            add_link(self._trace(segment, cx, -1, 'jump'))
+        segment.links = [best_links[target] for target in sorted(best_links)]
+
+    def _trace(self, segment, start_cx, direction, kind):
+        # Follows the path of the character center until it lands on a
+        # surface while falling, or has fallen further than max_drop.
+        dt = self.dt
+        radius = self.radius
+        half_tile_height = self.half_tile_height
+        start_x = self.get_x(start_cx)
+        start_y = segment.get_height(start_cx) * half_tile_height
+        x = start_x
+        y = start_y + radius
+        if kind == 'jump':
+            vx = 0.0
+            vy = self.jump_velocity
+        else:
+            vx = direction * self.walk_velocity
+            vy = 0.0
+        time = 0.0
+        while y > start_y + radius - self.max_drop:
+            if kind == 'jump':
+                vx += direction * dt * self.drift_acceleration
+                if abs(vx) > self.drift_velocity:
+                    vx = direction * self.drift_velocity
+            vy -= self.gravity * dt
+            x += vx * dt
+            y += vy * dt
+            time += dt
+            if vy >= 0.0:
+                continue
+            cx = self.get_cx(x)
+            if cx == start_cx:
+                continue
+            max_cell_y = int(math.floor(y / half_tile_height))
+            for cell_y in reversed(self.surfaces.get(cx, ())):
+                if cell_y <= max_cell_y:
+                    if y - cell_y * half_tile_height < radius:
+                        target = self.segments[
+                            self.column_segments[cx][cell_y]]
+                        stop_x = (x + 0.5 * vx * abs(vx) /
+                                  self.walk_acceleration)
+                        if (target.min_cx - 1 <=
+                            stop_x / self.half_tile_width <=
+                            target.max_cx):
+                            return Link(kind, segment.segment_id,
+                                        target.segment_id, start_x, x, time)
+                        return None
+                    break
+        return None
+
+    def find_path(self, start_segment, goal_segment):
+        # Returns the links from the start to the goal segment, or None if
+        # there is no path. Results are cached per pair of segments until
+        # the tiles change.
+        self.update()
+        key = start_segment.segment_id, goal_segment.segment_id
+        path = self.path_cache.get(key, False)
+        if path is False:
+            path = self._search(start_segment, goal_segment)
+            self.path_cache.put(key, path)
+        return path
+
+    def _search(self, start_segment, goal_segment):
+        # A* over segments. Walking costs the distance between where a
+        # segment was entered and where the next link starts. The estimate is
+        # the horizontal distance to the goal segment at walking speed, which
+        # no link beats.
+        self.search_count += 1
+        walk_velocity = self.walk_velocity
+        goal_min_x = self.get_x(goal_segment.min_cx)
+        goal_max_x = self.get_x(goal_segment.max_cx)
+        def estimate(x):
+            if x < goal_min_x:
+                return (goal_min_x - x) / walk_velocity
+            return max(x - goal_max_x, 0.0) / walk_velocity
+        start_x = self.get_x(0.5 * (start_segment.min_cx +
+                                    start_segment.max_cx))
+        counter = itertools.count()
+        heap = [(estimate(start_x), next(counter), 0.0, start_segment,
+                 start_x)]
+        costs = {start_segment.segment_id: 0.0}
+        came_from = {}
+        while heap:
+            _, _, cost, segment, x = heapq.heappop(heap)
+            if cost > costs[segment.segment_id]:
+                continue
+            if segment is goal_segment:
+                path = []
+                segment_id = segment.segment_id
+                while segment_id in came_from:
+                    link = came_from[segment_id]
+                    path.append(link)
+                    segment_id = link.source
+                path.reverse()
+                return path
+            for link in segment.links:
+                target = self.segments.get(link.target)
+                if target is None:
+                    continue
+                next_cost = (cost + abs(link.start_x - x) / walk_velocity +
+                             link.cost)
+                if next_cost < costs.get(link.target, float('inf')):
+                    costs[link.target] = next_cost
+                    came_from[link.target] = link
+                    heapq.heappush(heap, (next_cost + estimate(link.end_x),
+                                          next(counter), next_cost, target,
+                                          link.end_x))
+        return None
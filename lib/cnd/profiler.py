@@ -0,0 +1,123 @@
+from collections import deque
+import csv
+import json
+import threading
+from timeit import default_timer
+
+import pyglet
+
+class Profiler(object):
+    # Times named phases and keeps the last window_size samples of each. A
+    # window size of None keeps every sample. When disabled, call() only
+    # adds a function call per phase. The simulation and render threads
+    # share a profiler, so each thread keeps its own record, and records
+    # are written to the trace one at a time.
+    def __init__(self, phase_names, counter_names, window_size=120):
+        self.phase_names = tuple(phase_names)
+        self.counter_names = tuple(counter_names)
+        self.enabled = False
+        self.samples = dict((name, deque(maxlen=window_size))
+                            for name in self.phase_names)
+        self.counters = dict((name, 0) for name in self.counter_names)
+        self.local = threading.local()
+        self.trace_lock = threading.Lock()
+        self.trace_file = None
+        self.trace_writer = None
+
+    @property
+    def record(self):
+        # The phases and counters of the calling thread since its last
+        # record.
+        try:
+            return self.local.record
+        except AttributeError:
+            self.local.record = {}
+            return self.local.record
+
+    def call(self, name, func, *args):
+        if not self.enabled:
+            return func(*args)
+        start_time = default_timer()
+        result = func(*args)
+        elapsed = default_timer() - start_time
+        self.samples[name].append(elapsed)
+        self.record[name] = elapsed
+        return result
+
+    def set_counter(self, name, value):
+        self.counters[name] = value
+        self.record[name] = value
+
+    def get_stats(self, name):
+        # Returns the mean and max of the sample window, in seconds.
+        samples = self.samples[name]
+        if not samples:
+            return 0.0, 0.0
+        return sum(samples) / len(samples), max(samples)
+
+    def open_trace(self, path):
+        self.close_trace()
+        with self.trace_lock:
+            self.trace_file = open(path, 'wb')
+            if path.endswith('.csv'):
+                self.trace_writer = csv.writer(self.trace_file)
+                self.trace_writer.writerow(('kind', 'time') +
+                                           self.phase_names +
+                                           self.counter_names)
+            else:
+                self.trace_writer = None
+
+    def close_trace(self):
+        with self.trace_lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+                self.trace_writer = None
+
+    def end_record(self, kind, time):
+        # Writes the phases and counters of the calling thread since its
+        # last record as one line of the trace.
+        record = self.record
+        if record:
+            with self.trace_lock:
+                if self.trace_writer is not None:
+                    row = [kind, '%.6f' % time]
+                    for name in self.phase_names + self.counter_names:
+                        row.append(record.get(name, ''))
+                    self.trace_writer.writerow(row)
+                elif self.trace_file is not None:
+                    record['kind'] = kind
+                    record['time'] = time
+                    self.trace_file.write(json.dumps(record, sort_keys=True))
+                    self.trace_file.write('\n')
+        record.clear()
+
+class ProfilerOverlay(object):
+    def __init__(self, profiler, x, y, update_interval=15):
+        self.profiler = profiler
+        self.x = x
+        self.y = y
+        self.update_interval = update_interval
+        self.frame_count = 0
+        self.label = None
+
+    def get_text(self):
+        lines = []
+        for name in self.profiler.phase_names:
+            mean, max_ = self.profiler.get_stats(name)
+            lines.append('%-14s %7.3f ms  max %7.3f ms' %
+                         (name, 1000.0 * mean, 1000.0 * max_))
+        lines.append('  '.join('%s %s' % (name, self.profiler.counters[name])
+                               for name in self.profiler.counter_names))
+        return '\n'.join(lines)
+
+    def draw(self):
+        if self.label is None:
+            self.label = pyglet.text.Label(font_name='Courier New',
+                                           font_size=10, x=self.x, y=self.y,
+                                           anchor_y='top', width=640,
+                                           multiline=True)
+        if self.frame_count % self.update_interval == 0:
+            self.label.text = self.get_text()
+        self.frame_count += 1
+        self.label.draw()
@@ -0,0 +1,79 @@
+import logging
+
+class QualityLevel(object):
+    # Settings that trade accuracy for step time. Characters on the ground
+    # that are further than near_distance from the thief are probed every
+    # probe_interval steps. Without draw_fixtures, the sensor circles of
+    # characters are not drawn. Level chunks are still drawn, since their
+    # outlines are all there is to see of the level, and they are kept on
+    # the GPU anyway.
+    __slots__ = ('name', 'velocity_iterations', 'position_iterations',
+                 'probe_interval', 'near_distance', 'draw_fixtures')
+
+    def __init__(self, name, velocity_iterations, position_iterations,
+                 probe_interval=1, near_distance=16.0, draw_fixtures=True):
+        self.name = name
+        self.velocity_iterations = velocity_iterations
+        self.position_iterations = position_iterations
+        self.probe_interval = probe_interval
+        self.near_distance = near_distance
+        self.draw_fixtures = draw_fixtures
+
+class QualityController(object):
+    # Lowers the quality level when steps take too long for the budget, and
+    # raises it again after they have been cheap for a while. Step times are
+    # smoothed, so that a single slow step changes nothing, but falling
+    # behind the clock by more than the budget lowers the level at once.
+    # After a change, the level is held for hold_steps, so that the new
+    # step times can be measured.
+    levels = (
+        QualityLevel('full', 10, 10),
+        QualityLevel('reduced', 8, 3),
+        QualityLevel('low', 6, 2, probe_interval=2, draw_fixtures=False),
+        QualityLevel('minimal', 4, 1, probe_interval=4, draw_fixtures=False),
+    )
+
+    def __init__(self, budget, high_ratio=0.6, low_ratio=0.3, smoothing=0.1,
+                 hold_steps=15, recovery_steps=120):
+        self.budget = budget
+        self.high_ratio = high_ratio
+        self.low_ratio = low_ratio
+        self.smoothing = smoothing
+        self.hold_steps = hold_steps
+        self.recovery_steps = recovery_steps
+        self.level_index = 0
+        self.mean_time = 0.0
+        self.held_steps = 0
+        self.cheap_steps = 0
+
+    @property
+    def level(self):
+        return self.levels[self.level_index]
+
+    def update(self, step_time, lag=0.0):
+        # Takes the time of the last step and how far the simulation is
+        # behind the clock. Returns whether the level has changed.
+        self.mean_time += self.smoothing * (step_time - self.mean_time)
+        self.held_steps += 1
+        if self.mean_time < self.low_ratio * self.budget:
+            self.cheap_steps += 1
+        else:
+            self.cheap_steps = 0
+        if self.held_steps < self.hold_steps:
+            return False
+        if self.mean_time > self.high_ratio * self.budget or lag > self.budget:
+            if self.level_index + 1 < len(self.levels):
+                self.set_level_index(self.level_index + 1)
+                return True
+        elif self.cheap_steps >= self.recovery_steps and self.level_index:
+            self.set_level_index(self.level_index - 1)
+            return True
+        return False
+
+    def set_level_index(self, level_index):
+        logging.debug('Quality changes from %s to %s at %.3f ms per step.' %
+                      (self.level.name, self.levels[level_index].name,
+                       1000.0 * self.mean_time))
+        self.level_index = level_index
+        self.held_steps = 0
+        self.cheap_steps = 0
@@ -0,0 +1,160 @@
+import logging
+import struct
+import zlib
+
+class ReplayError(Exception):
+    pass
+
+def get_checksum(game_engine):
+    # CRC of the state of every character, to detect diverging replays.
+    checksum = zlib.crc32(struct.pack('<d', game_engine.time))
+    for actor in game_engine.character_actors:
+        x, y = actor.body.position
+        vx, vy = actor.body.linearVelocity
+        data = struct.pack('<4d2b', x, y, vx, vy, actor.state, actor.face)
+        checksum = zlib.crc32(data, checksum)
+    return checksum & 0xffffffff
+
+class Recording(object):
+    # The controls of every character are stored as one byte of flags per
+    # character per step, followed by a checksum every checksum_interval
+    # steps. The body is compressed with zlib. The header has the game engine
+    # settings that change how it steps, so that a replay uses the same ones.
+    # The view size is one of them, since guards in view are kept awake.
+    magic = 'CNDR'
+    version = 2
+    header_struct = struct.Struct('<4sHiiIIdIIdBBBI')
+
+    def __init__(self, level_name, seed, guard_count, character_count, dt,
+                 view_width=640, view_height=480, activation_radius=24.0,
+                 navigation=True, batch_characters=True,
+                 quality_level_index=0, checksum_interval=60):
+        self.level_name = level_name
+        self.seed = seed
+        self.guard_count = guard_count
+        self.character_count = character_count
+        self.dt = dt
+        self.view_width = view_width
+        self.view_height = view_height
+        self.activation_radius = activation_radius
+        self.navigation = navigation
+        self.batch_characters = batch_characters
+        self.quality_level_index = quality_level_index
+        self.checksum_interval = checksum_interval
+        self.controls = bytearray()
+        self.checksums = []
+
+    @property
+    def step_count(self):
+        return len(self.controls) // self.character_count
+
+    def save(self, path):
+        guard_count = self.guard_count
+        if guard_count is None:
+            guard_count = -1
+        activation_radius = self.activation_radius
+        if activation_radius is None:
+            activation_radius = -1.0
+        body = ''.join([struct.pack('<I', len(self.level_name)),
+                        self.level_name,
+                        struct.pack('<I', len(self.checksums)),
+                        struct.pack('<%dI' % len(self.checksums),
+                                    *self.checksums),
+                        str(self.controls)])
+        header = self.header_struct.pack(self.magic, self.version, self.seed,
+                                         guard_count, self.character_count,
+                                         self.checksum_interval, self.dt,
+                                         self.view_width, self.view_height,
+                                         activation_radius, self.navigation,
+                                         self.batch_characters,
+                                         self.quality_level_index,
+                                         len(body))
+        with open(path, 'wb') as recording_file:
+            recording_file.write(header)
+            recording_file.write(zlib.compress(body))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as recording_file:
+            data = recording_file.read()
+        try:
+            (magic, version, seed, guard_count, character_count,
+             checksum_interval, dt, view_width, view_height,
+             activation_radius, navigation,
+             batch_characters, quality_level_index,
+             body_size) = cls.header_struct.unpack_from(data)
+            if magic != cls.magic or version != cls.version:
+                raise ReplayError('unknown recording format')
+            body = zlib.decompress(data[cls.header_struct.size:])
+            if len(body) != body_size:
+                raise ReplayError('truncated recording')
+            offset = 0
+            name_size, = struct.unpack_from('<I', body, offset)
+            offset += 4
+            level_name = body[offset:offset + name_size]
+            offset += name_size
+            checksum_count, = struct.unpack_from('<I', body, offset)
+            offset += 4
+            checksums = struct.unpack_from('<%dI' % checksum_count, body,
+                                           offset)
+            offset += 4 * checksum_count
+        except (struct.error, zlib.error) as e:
+            raise ReplayError(str(e))
+        if guard_count < 0:
+            guard_count = None
+        if activation_radius < 0.0:
+            activation_radius = None
+        recording = cls(level_name, seed, guard_count, character_count, dt,
+                        view_width=view_width, view_height=view_height,
+                        activation_radius=activation_radius,
+                        navigation=bool(navigation),
+                        batch_characters=bool(batch_characters),
+                        quality_level_index=quality_level_index,
+                        checksum_interval=checksum_interval)
+        recording.checksums = list(checksums)
+        recording.controls = bytearray(body[offset:])
+        return recording
+
+class Recorder(object):
+    # Records the controls of every character after the AI has thought, so
+    # that a replay does not depend on the AI.
+    def __init__(self, recording):
+        self.recording = recording
+
+    def filter_input(self, game_engine):
+        recording = self.recording
+        assert len(game_engine.character_actors) == recording.character_count
+        if recording.step_count % recording.checksum_interval == 0:
+            recording.checksums.append(get_checksum(game_engine))
+        for actor in game_engine.character_actors:
+            recording.controls.append(actor.controls.get_flags())
+
+class Replayer(object):
+    # Overrides the controls of every character with the recorded ones and
+    # compares checksums along the way.
+    def __init__(self, recording):
+        self.recording = recording
+        self.step_index = 0
+        self.divergence_step = None
+
+    @property
+    def finished(self):
+        return self.step_index >= self.recording.step_count
+
+    def filter_input(self, game_engine):
+        recording = self.recording
+        if len(game_engine.character_actors) != recording.character_count:
+            raise ReplayError('character count does not match recording')
+        if self.finished:
+            raise ReplayError('replay is finished')
+        step_index = self.step_index
+        interval = recording.checksum_interval
+        if step_index % interval == 0 and self.divergence_step is None:
+            checksum = get_checksum(game_engine)
+            if checksum != recording.checksums[step_index // interval]:
+                logging.warning('Replay diverged at step %d.' % step_index)
+                self.divergence_step = step_index
+        offset = step_index * recording.character_count
+        for i, actor in enumerate(game_engine.character_actors):
+            actor.controls.set_flags(recording.controls[offset + i])
+        self.step_index += 1
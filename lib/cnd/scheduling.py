@@ -0,0 +1,64 @@
+import heapq
+import itertools
+from timeit import default_timer
+
+class AIScheduler(object):
+    # A heap of AIs keyed on their turn time, so that each step only wakes
+    # the AIs that are due. Removed AIs are left in the heap and skipped.
+    # At most max_think_count AIs think per step, and no more are started
+    # once time_budget seconds have passed. AIs over budget stay due and
+    # think in the next step.
+    def __init__(self, max_think_count=64, time_budget=None):
+        self.max_think_count = max_think_count
+        self.time_budget = time_budget
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.think_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ai):
+        return ai in self.entries
+
+    def add(self, ai):
+        assert ai not in self.entries
+        entry = [ai.turn_time, next(self.counter), ai]
+        self.entries[ai] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, ai):
+        entry = self.entries.pop(ai)
+        entry[-1] = None
+
+    def reschedule(self):
+        # Rebuilds the heap after turn times have been changed from outside.
+        # Entries keep their counters, and removed ones are dropped.
+        heap = self.entries.values()
+        for entry in heap:
+            entry[0] = entry[-1].turn_time
+        heapq.heapify(heap)
+        self.heap = heap
+
+    def think(self, time):
+        heap = self.heap
+        start_time = default_timer()
+        think_count = 0
+        while heap and heap[0][0] < time:
+            if (self.max_think_count is not None and
+                think_count >= self.max_think_count):
+                break
+            if (self.time_budget is not None and think_count and
+                default_timer() - start_time > self.time_budget):
+                break
+            entry = heapq.heappop(heap)
+            ai = entry[-1]
+            if ai is None:
+                continue
+            ai.think()
+            think_count += 1
+            entry = [ai.turn_time, next(self.counter), ai]
+            self.entries[ai] = entry
+            heapq.heappush(heap, entry)
+        self.think_count = think_count
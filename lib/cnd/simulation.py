@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from timeit import default_timer
+
+class Snapshot(object):
+    # What the renderer needs from one step. Draw states are tuples that
+    # start with the x and y of the actor, or None.
+    __slots__ = 'time', 'camera_position', 'draw_states'
+
+    def __init__(self, time, camera_position, draw_states):
+        self.time = time
+        self.camera_position = camera_position
+        self.draw_states = tuple(draw_states)
+
+def lerp(a, b, alpha):
+    return a + alpha * (b - a)
+
+def interpolate_snapshots(previous, current, alpha):
+    # Interpolates positions from the previous to the current snapshot.
+    # Everything else is taken from the current snapshot.
+    previous_states = dict(previous.draw_states)
+    draw_states = []
+    for actor, draw_state in current.draw_states:
+        previous_state = previous_states.get(actor)
+        if draw_state is not None and previous_state is not None:
+            x = lerp(previous_state[0], draw_state[0], alpha)
+            y = lerp(previous_state[1], draw_state[1], alpha)
+            draw_state = (x, y) + draw_state[2:]
+        draw_states.append((actor, draw_state))
+    previous_x, previous_y = previous.camera_position
+    current_x, current_y = current.camera_position
+    camera_position = (lerp(previous_x, current_x, alpha),
+                       lerp(previous_y, current_y, alpha))
+    return Snapshot(lerp(previous.time, current.time, alpha),
+                    camera_position, draw_states)
+
+class SimulationThread(threading.Thread):
+    # Steps the game engine at a fixed time step, holding the engine lock
+    # while stepping. After each step, the last two snapshots are published
+    # together with the wall clock time of the newest one. A quality
+    # controller, if given, is told the time of every step and sets the
+    # quality level of the game engine.
+    def __init__(self, game_engine, dt=1.0 / 60.0, max_dt=10.0 / 60.0,
+                 quality_controller=None):
+        super(SimulationThread, self).__init__(name='SimulationThread')
+        self.daemon = True
+        self.game_engine = game_engine
+        self.dt = dt
+        self.max_dt = max_dt
+        self.quality_controller = quality_controller
+        self.running = False
+        snapshot = game_engine.get_snapshot()
+        self.snapshots = snapshot, snapshot, default_timer()
+
+    def start(self):
+        self.running = True
+        super(SimulationThread, self).start()
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join()
+
+    def get_interpolated_snapshot(self):
+        # Draws one step behind the simulation, so that there is always a
+        # newer snapshot to interpolate towards.
+        previous, current, publish_time = self.snapshots
+        alpha = (default_timer() - publish_time) / self.dt
+        alpha = min(max(alpha, 0.0), 1.0)
+        return interpolate_snapshots(previous, current, alpha)
+
+    def run(self):
+        game_engine = self.game_engine
+        quality_controller = self.quality_controller
+        next_time = default_timer()
+        while self.running:
+            now = default_timer()
+            if now - next_time > self.max_dt:
+                skip = (now - next_time - self.max_dt) / self.dt
+                logging.debug('Skipping %g frames.' % skip)
+                next_time = now - self.max_dt
+            while next_time <= now and self.running:
+                start_time = default_timer()
+                with game_engine.lock:
+                    game_engine.step(self.dt)
+                    snapshot = game_engine.get_snapshot()
+                end_time = default_timer()
+                self.snapshots = self.snapshots[1], snapshot, end_time
+                next_time += self.dt
+                if (quality_controller is not None and
+                    quality_controller.update(end_time - start_time,
+                                              end_time - next_time)):
+                    with game_engine.lock:
+                        game_engine.set_quality_level(
+                            quality_controller.level_index)
+            time.sleep(max(next_time - default_timer(), 0.0))
@@ -0,0 +1,46 @@
+import math
+
+class SpatialGrid(object):
+    # A uniform grid of buckets for bounds queries. Items are inserted with
+    # their bounds, and kept in each cell that the bounds overlap. Queries
+    # can return items whose bounds do not overlap the query bounds.
+    def __init__(self, cell_width=16.0, cell_height=16.0):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.cells = {}
+        self.item_cells = {}
+
+    def __len__(self):
+        return len(self.item_cells)
+
+    def get_cell_keys(self, bounds):
+        min_x, min_y, max_x, max_y = bounds
+        min_cell_x = int(math.floor(min_x / self.cell_width))
+        min_cell_y = int(math.floor(min_y / self.cell_height))
+        max_cell_x = int(math.floor(max_x / self.cell_width))
+        max_cell_y = int(math.floor(max_y / self.cell_height))
+        for cell_y in xrange(min_cell_y, max_cell_y + 1):
+            for cell_x in xrange(min_cell_x, max_cell_x + 1):
+                yield cell_x, cell_y
+
+    def insert(self, item, bounds):
+        assert item not in self.item_cells
+        cell_keys = list(self.get_cell_keys(bounds))
+        for cell_key in cell_keys:
+            self.cells.setdefault(cell_key, set()).add(item)
+        self.item_cells[item] = cell_keys
+
+    def remove(self, item):
+        for cell_key in self.item_cells.pop(item):
+            cell = self.cells[cell_key]
+            cell.remove(item)
+            if not cell:
+                del self.cells[cell_key]
+
+    def query(self, bounds):
+        items = set()
+        for cell_key in self.get_cell_keys(bounds):
+            cell = self.cells.get(cell_key)
+            if cell:
+                items.update(cell)
+        return items
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import logging
+import Queue
+import threading
+
+class LRUCache(object):
+    # Drops the least recently used item once max_size items are stored.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+class ChunkLoader(threading.Thread):
+    # Loads chunks on a background thread into an LRU cache. A chunk that is
+    # needed before it has been loaded can be loaded on the calling thread
+    # instead. load_chunk must not touch the physics world.
+    def __init__(self, load_chunk, cache_size=64):
+        super(ChunkLoader, self).__init__(name='ChunkLoader')
+        self.daemon = True
+        self.load_chunk = load_chunk
+        self.cache = LRUCache(cache_size)
+        self.pending = set()
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.load_count = 0
+
+    def request(self, chunk_key):
+        with self.lock:
+            if chunk_key in self.cache or chunk_key in self.pending:
+                return
+            self.pending.add(chunk_key)
+        self.requests.put(chunk_key)
+
+    def get(self, chunk_key, wait=False):
+        # Returns the loaded chunk, or None if it is still being loaded and
+        # wait is false.
+        with self.lock:
+            chunk = self.cache.get(chunk_key)
+        if chunk is None and wait:
+            chunk = self._load(chunk_key)
+        return chunk
+
+    def put(self, chunk_key, chunk):
+        # Replaces a chunk that has changed. A load of the old chunk that is
+        # still running is thrown away.
+        with self.lock:
+            self.generations[chunk_key] = (
+                self.generations.get(chunk_key, 0) + 1)
+            self.cache.put(chunk_key, chunk)
+            self.pending.discard(chunk_key)
+
+    def stop(self):
+        self.requests.put(None)
+        if self.is_alive():
+            self.join()
+
+    def _load(self, chunk_key):
+        with self.lock:
+            generation = self.generations.get(chunk_key, 0)
+        chunk = self.load_chunk(chunk_key)
+        with self.lock:
+            if self.generations.get(chunk_key, 0) == generation:
+                self.cache.put(chunk_key, chunk)
+                self.pending.discard(chunk_key)
+            self.load_count += 1
+        return chunk
+
+    def run(self):
+        while True:
+            chunk_key = self.requests.get()
+            if chunk_key is None:
+                break
+            with self.lock:
+                if chunk_key in self.cache:
+                    self.pending.discard(chunk_key)
+                    continue
+            try:
+                self._load(chunk_key)
+            except Exception:
+                logging.exception('Could not load chunk %s.' % (chunk_key,))
+                with self.lock:
+                    self.pending.discard(chunk_key)
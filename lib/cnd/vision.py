@@ -0,0 +1,187 @@
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from level import TileMerger
+
+class VisionSystem(object):
+    # Guard sight is checked against the tile grid, not the physics world.
+    # Full tiles block sight. Half tiles and slopes do not. With a light map,
+    # the view distance shrinks towards dark_view_distance as the light at
+    # the target gets darker. With NumPy, steps with at least min_batch_size
+    # rays walk them all at once in are_clear(). Those steps cast every ray
+    # of an observer, instead of stopping at the first clear one.
+    def __init__(self, tiles, tile_width=1.0, tile_height=1.0,
+                 light_map=None):
+        self.tiles = tiles
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.light_map = light_map
+        self.view_distance = 12.0
+        self.dark_view_distance = 3.0
+        self.view_angle = 0.5 * math.pi
+        self.opaque_table = TileMerger.get_opaque_table()
+        self.min_batch_size = 32
+        self.opaque_array = None
+        if numpy is not None:
+            self.opaque_array = numpy.frombuffer(self.opaque_table,
+                                                 dtype=numpy.uint8) != 0
+        self.visible = []
+        self.distances = []
+        self.ray_count = 0
+
+    def is_clear(self, x1, y1, x2, y2):
+        # Walk the tiles crossed by the segment in order (Amanatides and Woo).
+        # Tile (x, y) covers [x - 0.5, x + 0.5) in tile units.
+        tiles = self.tiles
+        data = tiles.data
+        opaque_table = self.opaque_table
+        min_x = tiles.min_x
+        min_y = tiles.min_y
+        width = tiles.width
+        height = tiles.height
+        u1 = x1 / self.tile_width + 0.5
+        v1 = y1 / self.tile_height + 0.5
+        u2 = x2 / self.tile_width + 0.5
+        v2 = y2 / self.tile_height + 0.5
+        tile_x = int(math.floor(u1))
+        tile_y = int(math.floor(v1))
+        du = u2 - u1
+        dv = v2 - v1
+        if du > 0.0:
+            step_x = 1
+            delta_x = 1.0 / du
+            max_x = (tile_x + 1 - u1) * delta_x
+        elif du < 0.0:
+            step_x = -1
+            delta_x = -1.0 / du
+            max_x = (u1 - tile_x) * delta_x
+        else:
+            step_x = 0
+            delta_x = max_x = float('inf')
+        if dv > 0.0:
+            step_y = 1
+            delta_y = 1.0 / dv
+            max_y = (tile_y + 1 - v1) * delta_y
+        elif dv < 0.0:
+            step_y = -1
+            delta_y = -1.0 / dv
+            max_y = (v1 - tile_y) * delta_y
+        else:
+            step_y = 0
+            delta_y = max_y = float('inf')
+        tile_count = (abs(int(math.floor(u2)) - tile_x) +
+                      abs(int(math.floor(v2)) - tile_y) + 1)
+        for _ in xrange(tile_count):
+            i = tile_x - min_x
+            j = tile_y - min_y
+            if (0 <= i < width and 0 <= j < height and
+                opaque_table[data[j * width + i]]):
+                return False
+            if max_x < max_y:
+                max_x += delta_x
+                tile_x += step_x
+            else:
+                max_y += delta_y
+                tile_y += step_y
+        return True
+
+    def are_clear(self, segments):
+        # Walks the tiles of all the (x1, y1, x2, y2) segments at once, with
+        # the same steps as is_clear(), and returns a list of flags.
+        if numpy is None:
+            return [self.is_clear(*segment) for segment in segments]
+        if not segments:
+            return []
+        tiles = self.tiles
+        width = tiles.width
+        height = tiles.height
+        data = numpy.frombuffer(tiles.data, dtype=numpy.uint8)
+        x1, y1, x2, y2 = numpy.array(segments, dtype=float).T
+        u1 = x1 / self.tile_width + 0.5
+        v1 = y1 / self.tile_height + 0.5
+        u2 = x2 / self.tile_width + 0.5
+        v2 = y2 / self.tile_height + 0.5
+        tile_x = numpy.floor(u1).astype(int)
+        tile_y = numpy.floor(v1).astype(int)
+        du = u2 - u1
+        dv = v2 - v1
+        step_x = numpy.sign(du).astype(int)
+        step_y = numpy.sign(dv).astype(int)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            delta_x = 1.0 / numpy.abs(du)
+            delta_y = 1.0 / numpy.abs(dv)
+            max_x = numpy.where(du > 0.0, (tile_x + 1 - u1) * delta_x,
+                                numpy.where(du < 0.0, (u1 - tile_x) * delta_x,
+                                            numpy.inf))
+            max_y = numpy.where(dv > 0.0, (tile_y + 1 - v1) * delta_y,
+                                numpy.where(dv < 0.0, (v1 - tile_y) * delta_y,
+                                            numpy.inf))
+        tile_counts = (numpy.abs(numpy.floor(u2).astype(int) - tile_x) +
+                       numpy.abs(numpy.floor(v2).astype(int) - tile_y) + 1)
+        clear = numpy.ones(len(segments), dtype=bool)
+        for k in xrange(tile_counts.max()):
+            i = tile_x - tiles.min_x
+            j = tile_y - tiles.min_y
+            inside = ((k < tile_counts) & (0 <= i) & (i < width) &
+                      (0 <= j) & (j < height))
+            indices = j[inside] * width + i[inside]
+            clear[inside] &= ~self.opaque_array[data[indices]]
+            step_xs = max_x < max_y
+            step_ys = ~step_xs
+            max_x[step_xs] += delta_x[step_xs]
+            tile_x[step_xs] += step_x[step_xs]
+            max_y[step_ys] += delta_y[step_ys]
+            tile_y[step_ys] += step_y[step_ys]
+        return clear.tolist()
+
+    def update(self, eyes, faces, target, target_points):
+        # For each observer, checks if any of the target points can be seen
+        # from its eye. Observers out of range or facing away cast no rays.
+        target_x, target_y = target
+        min_cos = math.cos(0.5 * self.view_angle)
+        view_distance = self.view_distance
+        if self.light_map is not None:
+            light = self.light_map.get_light(
+                int(math.floor(target_x / self.tile_width + 0.5)),
+                int(math.floor(target_y / self.tile_height + 0.5)))
+            view_distance = (self.dark_view_distance +
+                             (view_distance - self.dark_view_distance) *
+                             light / 255.0)
+        distances = []
+        in_view = []
+        for (eye_x, eye_y), face in zip(eyes, faces):
+            dx = target_x - eye_x
+            dy = target_y - eye_y
+            distance = math.sqrt(dx * dx + dy * dy)
+            distances.append(distance)
+            in_view.append(distance < view_distance and
+                           face * dx >= min_cos * distance)
+        ray_count = sum(in_view) * len(target_points)
+        if numpy is not None and ray_count >= self.min_batch_size:
+            segments = [(eye_x, eye_y, point_x, point_y)
+                        for (eye_x, eye_y), seeing in zip(eyes, in_view)
+                        if seeing for point_x, point_y in target_points]
+            clear = iter(self.are_clear(segments))
+            visible = [seeing and
+                       any([next(clear) for _ in target_points])
+                       for seeing in in_view]
+        else:
+            is_clear = self.is_clear
+            visible = []
+            ray_count = 0
+            for (eye_x, eye_y), seeing in zip(eyes, in_view):
+                seen = False
+                if seeing:
+                    for point_x, point_y in target_points:
+                        ray_count += 1
+                        if is_clear(eye_x, eye_y, point_x, point_y):
+                            seen = True
+                            break
+                visible.append(seen)
+        self.visible = visible
+        self.distances = distances
+        self.ray_count = ray_count
+        return visible, distances
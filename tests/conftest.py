@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# Import the game as the cnd package, like bench.py and batch.py do.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+
+from cnd.headless import init_pyglet
+
+init_pyglet()
+
+from cnd.level import LevelParser, TileGrid
+
+def make_tile_grid(lines):
+    # Tile (x, y) is at line -y, column x. Unlike LevelParser, keeps the
+    # trailing spaces of the lines.
+    tiles = TileGrid(0, 1 - len(lines), len(lines[0]), len(lines))
+    for y, line in enumerate(lines):
+        tiles.set_row(-y, line.translate(LevelParser.empty_table))
+    return tiles
+
+@pytest.fixture
+def game_engine_factory():
+    # Creates headless game engines, and deletes them after the test.
+    from cnd.main import GameEngine
+    game_engines = []
+    def create_game_engine(**kwargs):
+        kwargs.setdefault('seed', 0)
+        game_engine = GameEngine(640, 480, **kwargs)
+        game_engines.append(game_engine)
+        return game_engine
+    yield create_game_engine
+    for game_engine in game_engines:
+        game_engine.delete()
@@ -0,0 +1,42 @@
+from cnd.activation import Patrol
+
+def test_patrol_walks_back_and_forth():
+    patrol = Patrol(2.0, 1.0, 1, 2.0, (0.0, 1.0, 4.0, 1.0), 10.0)
+    assert patrol.get_position(10.0) == (2.0, 1)
+    assert patrol.get_position(10.5) == (3.0, 1)
+    assert patrol.get_position(11.5) == (3.0, -1)
+    assert patrol.get_position(13.0) == (0.0, 1)
+    assert patrol.get_position(14.0) == (2.0, 1)
+
+def test_patrol_starting_to_the_left():
+    patrol = Patrol(2.0, 1.0, -1, 2.0, (0.0, 1.0, 4.0, 1.0), 0.0)
+    assert patrol.get_position(0.5) == (1.0, -1)
+    assert patrol.get_position(1.5) == (1.0, 1)
+
+def test_patrol_without_speed_or_length_stands_still():
+    patrol = Patrol(2.0, 1.0, -1, 0.0, (0.0, 1.0, 4.0, 1.0), 0.0)
+    assert patrol.get_position(5.0) == (2.0, -1)
+    patrol = Patrol(2.0, 1.0, 1, 3.0, (2.0, 1.0, 2.0, 1.0), 0.0)
+    assert patrol.get_position(5.0) == (2.0, 1)
+    assert Patrol(*patrol.get_args()).get_args() == patrol.get_args()
+
+def test_guards_in_view_are_awake(game_engine_factory):
+    # Some guards start outside the activation radius, but inside the view.
+    game_engine = game_engine_factory(guard_count=8, activation_radius=4.0)
+    activation_system = game_engine.activation_system
+    seen_count = 0
+    for _ in xrange(60):
+        game_engine.step(game_engine.dt)
+        x, y = game_engine.player_actor.body.position
+        min_x, min_y, max_x, max_y = game_engine.get_view_bounds(x, y)
+        for actor in game_engine.guard_actors:
+            patrol = activation_system.patrols.get(actor)
+            if patrol is None:
+                guard_x, guard_y = actor.body.position
+            else:
+                guard_x, face = patrol.get_position(game_engine.time)
+                guard_y = patrol.y
+            if min_x < guard_x < max_x and min_y < guard_y < max_y:
+                assert not actor.dormant
+                seen_count += 1
+    assert seen_count
@@ -0,0 +1,44 @@
+from cnd.checkpoint import restore_checkpoint, save_checkpoint
+
+def step_until_planned(game_engine, max_step_count=600):
+    for _ in xrange(max_step_count):
+        game_engine.step(game_engine.dt)
+        if any(ai.path for ai in game_engine.ais.itervalues()):
+            return
+    assert False, 'no guard planned a path'
+
+def assert_paths_in_graph(game_engine):
+    segments = game_engine.navigation_graph.segments
+    for ai in game_engine.ais.itervalues():
+        for link in ai.path or ():
+            assert link in segments[link.source].links
+
+def test_restore_keeps_paths(game_engine_factory):
+    game_engine = game_engine_factory(guard_count=8, activation_radius=None)
+    step_until_planned(game_engine)
+    paths = dict((ai, ai.path) for ai in game_engine.ais.itervalues())
+    checkpoint = save_checkpoint(game_engine)
+    for _ in xrange(30):
+        game_engine.step(game_engine.dt)
+    restore_checkpoint(game_engine, checkpoint)
+    for ai, path in paths.iteritems():
+        assert ai.path == path
+    assert save_checkpoint(game_engine).data == checkpoint.data
+
+def test_save_and_restore_around_tile_edits(game_engine_factory):
+    game_engine = game_engine_factory(guard_count=8, activation_radius=None)
+    step_until_planned(game_engine)
+    first_checkpoint = save_checkpoint(game_engine)
+    # Rebuilds the segments of the path, so that its links are gone.
+    game_engine.level_actor.set_tile(10, -1, '#')
+    game_engine.step(game_engine.dt)
+    second_checkpoint = save_checkpoint(game_engine)
+    restore_checkpoint(game_engine, first_checkpoint)
+    assert_paths_in_graph(game_engine)
+    for ai in game_engine.ais.itervalues():
+        assert ai.steering == bool(ai.path)
+    restore_checkpoint(game_engine, second_checkpoint)
+    assert_paths_in_graph(game_engine)
+    third_checkpoint = save_checkpoint(game_engine)
+    restore_checkpoint(game_engine, third_checkpoint)
+    assert save_checkpoint(game_engine).data == third_checkpoint.data
@@ -0,0 +1,68 @@
+from cnd.hearing import HearingSystem
+from conftest import make_tile_grid
+
+def create_hearing_system(lines, **kwargs):
+    return HearingSystem(make_tile_grid(lines), **kwargs)
+
+# Tile (x, y) is at line -y, column x, with its center at (x, y).
+open_lines = [' ' * 12] * 3
+
+def test_loudness_drops_by_one_per_tile():
+    hearing_system = create_hearing_system(open_lines)
+    hearing_system.emit(1.0, -1.0, 6.0)
+    assert hearing_system.update(['guard', 'other'],
+                                 [(4.0, -1.0), (11.0, -1.0)]) == [3.0, 0.0]
+
+def test_full_tiles_block_and_partial_tiles_muffle():
+    hearing_system = create_hearing_system(['  #  ',
+                                            '  #  ',
+                                            '  _  '])
+    hearing_system.emit(0.0, -2.0, 6.0)
+    # The wall reaches the top of the grid, so the only way is through the
+    # half tile at (2, -2), which costs 2.
+    assert hearing_system.update(['guard'], [(4.0, -2.0)]) == [1.0]
+
+def test_spawn_and_light_tiles_are_open_air():
+    hearing_system = create_hearing_system(['%@*!  '])
+    hearing_system.emit(0.0, 0.0, 6.0)
+    assert hearing_system.update(['guard'], [(4.0, 0.0)]) == [2.0]
+
+def test_loudest_of_several_sources_is_heard():
+    hearing_system = create_hearing_system(open_lines, max_floods=3)
+    hearing_system.emit(0.0, -1.0, 6.0, 'thief')
+    hearing_system.emit(8.0, -1.0, 5.0, 'guard_a')
+    hearing_system.emit(5.0, -1.0, 2.0, 'guard_b')
+    assert hearing_system.update(['guard_c'], [(5.0, -1.0)]) == [2.0]
+    assert hearing_system.noise_count == 3
+
+def test_own_noise_does_not_hide_other_noises():
+    hearing_system = create_hearing_system(open_lines)
+    hearing_system.emit(2.0, -1.0, 4.0, 'thief')
+    hearing_system.emit(3.0, -1.0, 9.0, 'guard')
+    assert hearing_system.update(['guard', 'thief'],
+                                 [(3.0, -1.0), (2.0, -1.0)]) == [3.0, 8.0]
+
+def test_own_noise_in_the_same_tile_does_not_hide_other_noises():
+    hearing_system = create_hearing_system(open_lines)
+    hearing_system.emit(3.0, -1.0, 4.0, 'thief')
+    hearing_system.emit(3.2, -1.0, 9.0, 'guard')
+    assert hearing_system.update(['guard'], [(3.0, -1.0)]) == [4.0]
+
+def test_noises_wait_for_floods():
+    hearing_system = create_hearing_system(open_lines, max_floods=1)
+    hearing_system.emit(0.0, -1.0, 3.0, 'thief')
+    hearing_system.emit(11.0, -1.0, 4.0, 'guard')
+    assert hearing_system.update(['listener'], [(0.0, -1.0)]) == [0.0]
+    assert hearing_system.flood_count == 1
+    assert hearing_system.update(['listener'], [(0.0, -1.0)]) == [3.0]
+    assert hearing_system.noises == []
+
+def test_fields_are_flooded_again_after_an_edit():
+    hearing_system = create_hearing_system(open_lines)
+    hearing_system.emit(0.0, -1.0, 6.0)
+    assert hearing_system.update(['guard'], [(4.0, -1.0)]) == [2.0]
+    for y in (0, -1, -2):
+        hearing_system.tiles.set_tile(2, y, '#')
+        hearing_system.invalidate_tile(2, y)
+    hearing_system.emit(0.0, -1.0, 6.0)
+    assert hearing_system.update(['guard'], [(4.0, -1.0)]) == [0.0]
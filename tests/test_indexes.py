@@ -0,0 +1,54 @@
+from cnd.indexes import OrderedIndex
+
+def test_items_keep_their_insertion_order():
+    index = OrderedIndex(['a', 'b', 'c'])
+    index.remove('b')
+    index.add('b')
+    assert list(index) == ['a', 'c', 'b']
+    assert len(index) == 3
+    assert 'b' in index
+    index.discard('d')
+    assert len(index) == 3
+
+def test_remove_and_add_while_iterating():
+    index = OrderedIndex(['a', 'b', 'c', 'd'])
+    visited = []
+    for item in index:
+        visited.append(item)
+        if item == 'a':
+            # Removed items are skipped and added items are not visited.
+            index.remove('c')
+            index.add('e')
+        elif item == 'b':
+            index.remove('b')
+    assert visited == ['a', 'b', 'd']
+    assert list(index) == ['a', 'd', 'e']
+
+def test_compact_while_iterating():
+    index = OrderedIndex(['a', 'b', 'c', 'd'])
+    visited = []
+    for item in index:
+        visited.append(item)
+        if item == 'a':
+            index.remove('b')
+            index.remove('c')
+            index.remove('d')
+            index.compact()
+            index.add('e')
+    # The running iteration keeps the old list.
+    assert visited == ['a']
+    assert index.items == ['a', 'e']
+    assert index.indices == {'a': 0, 'e': 1}
+
+def test_compact_waits_for_half_of_the_slots_to_be_holes():
+    index = OrderedIndex(['a', 'b', 'c', 'd'])
+    index.remove('a')
+    index.compact()
+    assert index.items == [None, 'b', 'c', 'd']
+    index.remove('b')
+    index.remove('c')
+    index.compact()
+    assert index.items == ['d']
+    index.remove('d')
+    assert 'd' not in index
+    assert list(index) == []
@@ -0,0 +1,144 @@
+import hashlib
+
+from cnd.level import (GroundProbe, LevelCache, LevelCompiler,
+                       LevelFormatError, LevelParser, TileGrid, TileMerger)
+
+level_source = '''\
+          %         *
+        ^^^=^^
+%          =       %
+##    _____=    /####\\       %
+##         =   /###^^^^^^   ##
+## @       =  /####    !    ##
+#####    ##########_________##
+##############################
+'''
+
+def compile_level(source=level_source, chunk_size=8):
+    return LevelCompiler(source.splitlines(), chunk_size).compile()
+
+def assert_same_level(level_data, other_level_data):
+    assert level_data.tiles.bounds == other_level_data.tiles.bounds
+    assert level_data.tiles.data == other_level_data.tiles.data
+    assert level_data.light_map.data == other_level_data.light_map.data
+    assert level_data.chunk_size == other_level_data.chunk_size
+    assert level_data.spawns == other_level_data.spawns
+    assert (sorted(level_data.chunk_rectangles) ==
+            sorted(other_level_data.chunk_rectangles))
+    for chunk_key in level_data.chunk_rectangles:
+        assert (level_data.get_chunk_rectangles(chunk_key) ==
+                other_level_data.get_chunk_rectangles(chunk_key))
+
+def test_cache_pack_unpack_round_trip():
+    level_data = compile_level()
+    level_cache = LevelCache('unused')
+    data = level_cache.pack('h' * 20, level_data)
+    assert_same_level(level_cache.unpack(data, 'h' * 20), level_data)
+
+def test_cache_ignores_other_source_hash():
+    level_cache = LevelCache('unused')
+    data = level_cache.pack('h' * 20, compile_level())
+    assert level_cache.unpack(data, 'x' * 20) is None
+
+def test_cache_rejects_truncated_data():
+    level_cache = LevelCache('unused')
+    data = level_cache.pack('h' * 20, compile_level())
+    try:
+        level_cache.unpack(data[:LevelCache.header_struct.size + 10],
+                           'h' * 20)
+    except LevelFormatError:
+        pass
+    else:
+        assert False, 'truncated data was unpacked'
+
+def test_cache_load_writes_and_reads_file(tmpdir):
+    level_cache = LevelCache(str(tmpdir.join('levels')))
+    compiled = level_cache.load('level', level_source)
+    source_hash = hashlib.sha1(level_source).digest()
+    cached = level_cache.read(level_cache.get_path('level'), source_hash)
+    assert_same_level(cached, compiled)
+    assert compiled.get_spawns('@') == [(3, -5)]
+
+def get_cells(rectangles):
+    cells = set()
+    for min_x, min_y, max_x, max_y in rectangles:
+        for y in xrange(min_y, max_y):
+            for x in xrange(min_x, max_x):
+                assert (x, y) not in cells
+                cells.add((x, y))
+    return cells
+
+def test_merged_rectangles_cover_the_cells_once():
+    tiles = LevelParser(level_source.splitlines()).parse()
+    tile_merger = TileMerger(tiles)
+    assert get_cells(tile_merger.merge()) == tile_merger.get_cells()
+
+def test_tile_grid_set_and_get():
+    tiles = TileGrid(-2, -3, 4, 5)
+    tiles.set_tile(-2, 1, '#')
+    assert tiles.get_tile(-2, 1) == '#'
+    assert tiles[-2, 1] == '#'
+    assert (1, 1) not in tiles
+    assert tiles.get_tile(2, 1) is None
+    assert len(tiles) == 1
+    assert list(tiles.iteritems()) == [((-2, 1), '#')]
+    tiles.set_tile(-2, 1, None)
+    assert len(tiles) == 0
+    try:
+        tiles.set_tile(2, 1, '#')
+    except IndexError:
+        pass
+    else:
+        assert False, 'tile outside the grid was set'
+
+def test_merge_chunk_after_edit_matches_compile():
+    level_data = compile_level()
+    lines = level_source.splitlines()
+    # Fill the gap in the floor below the player, at tile (7, -6).
+    lines[6] = lines[6][:7] + '#' + lines[6][8:]
+    level_data.tiles.set_tile(7, -6, '#')
+    chunk_key = level_data.get_chunk_key(7, -6)
+    level_data.merge_chunk(chunk_key)
+    level_data.light_map.invalidate_tile(7, -6)
+    assert_same_level(level_data, compile_level('\n'.join(lines)))
+
+def test_merge_chunk_drops_empty_chunk():
+    level_data = compile_level('#')
+    level_data.tiles.set_tile(0, 0, None)
+    level_data.merge_chunk((0, 0))
+    assert level_data.chunk_rectangles == {}
+    assert level_data.rectangle_count == 0
+
+def test_ground_probe_finds_surface_below():
+    tiles = LevelParser(level_source.splitlines()).parse()
+    ground_probe = GroundProbe(tiles)
+    # The player spawns at (3, -5), above the floor at y = -6.
+    point, fraction, tile_index = ground_probe.probe(3.0, -5.0, 2.0)
+    assert point == (3.0, -5.5)
+    assert fraction == 0.25
+    assert ground_probe.get_tile_record(tile_index) == ((3, -6), '#')
+    assert ground_probe.probe(3.0, -5.0, 0.25) is None
+
+def test_ground_probe_sees_edits():
+    tiles = LevelParser(level_source.splitlines()).parse()
+    ground_probe = GroundProbe(tiles)
+    tiles.set_tile(3, -5, '_')
+    point, fraction, tile_index = ground_probe.probe(3.0, -4.0, 2.0)
+    assert point == (3.0, -5.0)
+    assert ground_probe.get_tile_record(tile_index) == ((3, -5), '_')
+
+def test_ground_probe_hits_keep_tile_indices():
+    tiles = LevelParser(['#' * 64, '#' * 64]).parse()
+    ground_probe = GroundProbe(tiles)
+    for x in xrange(64):
+        point, fraction, tile_index = ground_probe.probe(float(x), 1.0, 2.0)
+        assert tile_index == tiles.width + x
+        assert ground_probe.get_tile_record(tile_index) == ((x, 0), '#')
+
+def test_ground_probe_inside_a_tile_hits_the_tile_below():
+    tiles = LevelParser(['#', '#']).parse()
+    ground_probe = GroundProbe(tiles)
+    point, fraction, tile_index = ground_probe.probe(0.0, -0.2, 1.0)
+    assert point == (0.0, -0.5)
+    assert ground_probe.get_tile_record(tile_index) == ((0, -1), '#')
+    assert ground_probe.probe(0.0, -1.2, 1.0) is None
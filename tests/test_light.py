@@ -0,0 +1,63 @@
+from cnd.level import LevelParser, LightMap, TileGrid
+
+level_lines = [
+    '                              ',
+    '   *         #          !     ',
+    '             #                ',
+    '       ####  #     ######     ',
+    '                              ',
+    '##############################',
+]
+
+def create_light_map():
+    tiles = LevelParser(level_lines).parse()
+    return tiles, LightMap(tiles)
+
+def set_tile(light_map, tile_x, tile_y, char):
+    light_map.tiles.set_tile(tile_x, tile_y, char)
+    light_map.invalidate_tile(tile_x, tile_y)
+
+def assert_same_as_full_bake(light_map):
+    assert light_map.data == LightMap(light_map.tiles).data
+
+def test_light_falls_off_and_walls_cast_shadows():
+    tiles, light_map = create_light_map()
+    assert light_map.get_light(3, -1) == 255
+    assert light_map.get_light(4, -1) > light_map.get_light(7, -1)
+    # The ledge at y = -3 shadows the floor below it from the '*' light,
+    # and is lit on its face.
+    assert light_map.get_light(9, -4) == LightMap.ambient
+    assert light_map.get_light(7, -3) > LightMap.ambient
+    # Outside the grid is ambient.
+    assert light_map.get_light(100, 100) == LightMap.ambient
+
+def test_added_wall_matches_full_bake():
+    tiles, light_map = create_light_map()
+    set_tile(light_map, 5, -1, '#')
+    assert_same_as_full_bake(light_map)
+
+def test_removed_wall_matches_full_bake():
+    tiles, light_map = create_light_map()
+    for y in (-1, -2):
+        set_tile(light_map, 13, y, None)
+        assert_same_as_full_bake(light_map)
+
+def test_added_and_removed_lights_match_full_bake():
+    tiles, light_map = create_light_map()
+    set_tile(light_map, 18, -4, '*')
+    assert_same_as_full_bake(light_map)
+    set_tile(light_map, 3, -1, None)
+    assert_same_as_full_bake(light_map)
+    set_tile(light_map, 24, -1, '#')
+    assert_same_as_full_bake(light_map)
+
+def test_edit_far_from_lights_bakes_nothing():
+    tiles = TileGrid(0, 0, 40, 1)
+    tiles.set_tile(0, 0, '!')
+    light_map = LightMap(tiles)
+    light_map.dirty_bounds = None
+    set_tile(light_map, 30, 0, '#')
+    assert light_map.dirty_bounds is None
+    set_tile(light_map, 4, 0, '#')
+    assert light_map.dirty_bounds == (0, 0, 7, 1)
+    assert_same_as_full_bake(light_map)
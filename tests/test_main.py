@@ -0,0 +1,72 @@
+from Box2D import b2RayCastCallback
+
+class RayCastCallback(b2RayCastCallback):
+    def __init__(self):
+        super(RayCastCallback, self).__init__()
+        self.hits = []
+
+    def ReportFixture(self, fixture, point, normal, fraction):
+        self.hits.append((fraction, fixture, tuple(point), tuple(normal)))
+        return 1.0
+
+def test_find_tile_of_chunk_fixture_hit(game_engine_factory):
+    game_engine = game_engine_factory(guard_count=0)
+    level_actor = game_engine.level_actor
+    # The thief spawns at tile (3, -5), on the floor of tile (3, -6).
+    x, y = level_actor.get_tile_center(3, -5)
+    callback = RayCastCallback()
+    game_engine.world.RayCast(callback, (x, y), (x, y - 2.0))
+    fraction, fixture, point, normal = min(
+        hit for hit in callback.hits
+        if game_engine.fixture_table[hit[1].userData][0] is level_actor)
+    actor, chunk_key = game_engine.fixture_table[fixture.userData]
+    assert chunk_key == level_actor.level_data.get_chunk_key(3, -6)
+    assert level_actor.find_tile(point, normal) == ((3, -6), '#')
+
+def test_find_tile_of_side_and_slope(game_engine_factory):
+    game_engine = game_engine_factory(guard_count=0)
+    level_actor = game_engine.level_actor
+    # The left face of the wall at (28, -5), and the top of the slope at
+    # (14, -5).
+    assert level_actor.find_tile((27.5, -5.0), (-1.0, 0.0)) == ((28, -5),
+                                                                '#')
+    assert level_actor.find_tile((14.25, -4.5), (0.0, 1.0)) == ((14, -5),
+                                                                '/')
+    assert level_actor.find_tile((5.0, -4.5), (0.0, 1.0)) is None
+
+def test_guards_plan_again_after_edits(game_engine_factory):
+    game_engine = game_engine_factory(guard_count=8, activation_radius=None)
+    ais = game_engine.ais.values()
+    for _ in xrange(600):
+        game_engine.step(game_engine.dt)
+        if any(ai.path for ai in ais):
+            break
+    planned_ais = [ai for ai in ais if ai.path]
+    assert planned_ais
+    # Rebuilds the segments of the path, so that its links are gone.
+    game_engine.level_actor.set_tile(10, -1, '#')
+    graph = game_engine.navigation_graph
+    for _ in xrange(120):
+        game_engine.step(game_engine.dt)
+        for ai in ais:
+            if ai.steering and ai.actor.state not in ai.actor.air_states:
+                assert ai.path_version == graph.version
+                for link in ai.path:
+                    assert link in graph.segments[link.source].links
+
+def test_batched_characters_step_like_single_ones(game_engine_factory):
+    game_engines = [game_engine_factory(guard_count=8,
+                                        batch_characters=batch_characters)
+                    for batch_characters in (True, False)]
+    assert game_engines[0].character_system is not None
+    assert game_engines[1].character_system is None
+    for game_engine in game_engines:
+        game_engine.player_actor.controls.right = True
+    for _ in xrange(180):
+        states = []
+        for game_engine in game_engines:
+            game_engine.step(game_engine.dt)
+            states.append([(tuple(actor.body.position),
+                            tuple(actor.body.linearVelocity), actor.state)
+                           for actor in game_engine.character_actors])
+        assert states[0] == states[1]
@@ -0,0 +1,69 @@
+from cnd.level import LevelParser
+from cnd.navigation import NavigationGraph
+
+def create_graph(lines):
+    tiles = LevelParser(lines).parse()
+    return tiles, NavigationGraph(tiles)
+
+def test_find_segment_on_floor():
+    tiles, graph = create_graph(['    ',
+                                 '####'])
+    # The floor is the row at y = -1, with its top at y = -0.5.
+    segment = graph.find_segment(1.0, 0.3)
+    assert segment is not None
+    assert (segment.min_cx, segment.max_cx) == (0, 7)
+    assert segment.heights == [-1] * 8
+    assert graph.find_segment(1.0, 3.0) is None
+
+def test_find_path_jumps_to_ledge():
+    tiles, graph = create_graph(['     ##',
+                                 '       ',
+                                 '#######'])
+    start = graph.find_segment(0.0, -1.2)
+    goal = graph.find_segment(6.0, 0.8)
+    assert start is not None and goal is not None
+    path = graph.find_path(start, goal)
+    assert [link.kind for link in path] == ['jump']
+    assert path[0].target == goal.segment_id
+
+def test_find_segment_after_edit():
+    tiles, graph = create_graph(['    ',
+                                 '####'])
+    tiles.set_tile(2, 0, '#')
+    graph.invalidate_tile(2, 0)
+    segment = graph.find_segment(2.0, 1.3)
+    assert segment is not None
+    assert segment.get_height(graph.get_cx(2.0)) == 1
+    assert graph.find_segment(0.0, 0.3).get_height(graph.get_cx(0.0)) == -1
+
+def test_find_path_after_edit():
+    tiles, graph = create_graph(['## ##'])
+    start = graph.find_segment(0.0, 0.8)
+    goal = graph.find_segment(4.0, 0.8)
+    path = graph.find_path(start, goal)
+    assert path
+    tiles.set_tile(2, 0, '#')
+    graph.invalidate_tile(2, 0)
+    start = graph.find_segment(0.0, 0.8)
+    goal = graph.find_segment(4.0, 0.8)
+    assert start is goal
+    assert graph.find_path(start, goal) == []
+
+def test_far_edits_rebuild_separately():
+    # Platforms of four tiles, with a gap of one tile between them.
+    tiles, graph = create_graph(['#### ' * 24])
+    middle = graph.find_segment(60.0, 0.8)
+    tiles.set_tile(0, 0, None)
+    graph.invalidate_tile(0, 0)
+    tiles.set_tile(118, 0, None)
+    graph.invalidate_tile(118, 0)
+    assert graph.find_segment(60.0, 0.8) is middle
+    assert graph.find_segment(0.0, 0.8) is None
+    assert graph.find_segment(1.0, 0.8) is not None
+
+def test_edits_change_the_version():
+    tiles, graph = create_graph(['####'])
+    version = graph.version
+    tiles.set_tile(1, 0, None)
+    graph.invalidate_tile(1, 0)
+    assert graph.version != version
@@ -0,0 +1,32 @@
+import json
+import threading
+
+from cnd.profiler import Profiler
+
+def test_threads_keep_their_own_records(tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    profiler = Profiler(('step_world', 'draw_shapes'), ('probes',))
+    profiler.enabled = True
+    profiler.open_trace(path)
+    stepped = threading.Event()
+    drawn = threading.Event()
+    def step():
+        profiler.call('step_world', lambda: None)
+        profiler.set_counter('probes', 3)
+        stepped.set()
+        drawn.wait()
+        profiler.end_record('step', 1.0)
+    thread = threading.Thread(target=step)
+    thread.start()
+    stepped.wait()
+    profiler.call('draw_shapes', lambda: None)
+    profiler.end_record('draw', 0.5)
+    drawn.set()
+    thread.join()
+    profiler.close_trace()
+    with open(path) as trace_file:
+        records = [json.loads(line) for line in trace_file]
+    assert sorted(records[0]) == ['draw_shapes', 'kind', 'time']
+    assert records[0]['kind'] == 'draw'
+    assert sorted(records[1]) == ['kind', 'probes', 'step_world', 'time']
+    assert records[1]['kind'] == 'step'
@@ -0,0 +1,38 @@
+from cnd.quality import QualityController
+
+def test_slow_steps_lower_the_level():
+    quality_controller = QualityController(1.0, hold_steps=2, smoothing=1.0)
+    assert not quality_controller.update(0.9)
+    assert quality_controller.update(0.9)
+    assert quality_controller.level.name == 'reduced'
+
+def test_level_is_held_after_a_change():
+    quality_controller = QualityController(1.0, hold_steps=3, smoothing=1.0)
+    changes = [quality_controller.update(0.9) for _ in xrange(6)]
+    assert changes == [False, False, True, False, False, True]
+    assert quality_controller.level.name == 'low'
+
+def test_falling_behind_lowers_the_level():
+    quality_controller = QualityController(1.0, hold_steps=1)
+    assert quality_controller.update(0.1, lag=1.5)
+    assert quality_controller.level_index == 1
+
+def test_single_slow_step_changes_nothing():
+    quality_controller = QualityController(1.0, hold_steps=1)
+    assert not quality_controller.update(2.0)
+    assert quality_controller.level_index == 0
+
+def test_cheap_steps_raise_the_level():
+    quality_controller = QualityController(1.0, hold_steps=1,
+                                           recovery_steps=5, smoothing=1.0)
+    quality_controller.set_level_index(2)
+    changes = [quality_controller.update(0.1) for _ in xrange(5)]
+    assert changes == [False] * 4 + [True]
+    assert quality_controller.level.name == 'reduced'
+
+def test_level_stays_at_the_ends():
+    quality_controller = QualityController(1.0, hold_steps=1, smoothing=1.0)
+    quality_controller.set_level_index(len(QualityController.levels) - 1)
+    assert not quality_controller.update(0.9)
+    quality_controller.set_level_index(0)
+    assert not any(quality_controller.update(0.1) for _ in xrange(200))
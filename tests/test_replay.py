@@ -0,0 +1,47 @@
+from cnd.bench import Benchmark
+from cnd.replay import Recorder, Recording, Replayer
+
+def test_record_and_replay(game_engine_factory, tmpdir):
+    settings = dict(guard_count=6, activation_radius=6.0, navigation=False,
+                    batch_characters=False)
+    game_engine = game_engine_factory(**settings)
+    recording = Recording(game_engine.level_name, game_engine.seed,
+                          game_engine.guard_count,
+                          len(game_engine.character_actors), game_engine.dt,
+                          activation_radius=6.0, navigation=False,
+                          batch_characters=False, checksum_interval=10)
+    game_engine.input_filters.append(Recorder(recording))
+    for _ in xrange(120):
+        game_engine.step(game_engine.dt)
+    path = str(tmpdir.join('recording.cndr'))
+    recording.save(path)
+    recording = Recording.load(path)
+    assert recording.step_count == 120
+    assert (recording.activation_radius, recording.navigation,
+            recording.batch_characters) == (6.0, False, False)
+    assert (recording.view_width, recording.view_height) == (640, 480)
+    game_engine = game_engine_factory(**settings)
+    replayer = Replayer(recording)
+    game_engine.input_filters.append(replayer)
+    while not replayer.finished:
+        game_engine.step(game_engine.dt)
+    assert replayer.divergence_step is None
+
+def test_benchmark_replays_with_recorded_settings(tmpdir):
+    benchmark = Benchmark(guard_count=6, step_count=120,
+                          activation_radius=None, navigation=False,
+                          quality_level_index=1, record=True)
+    benchmark.run()
+    path = str(tmpdir.join('recording.cndr'))
+    benchmark.recording.save(path)
+    benchmark = Benchmark.from_recording(Recording.load(path))
+    assert benchmark.activation_radius is None
+    assert not benchmark.navigation
+    assert benchmark.quality_level_index == 1
+    benchmark.run()
+    assert benchmark.replayer.divergence_step is None
+
+def test_benchmark_records_only_when_asked():
+    benchmark = Benchmark(guard_count=2, step_count=10)
+    benchmark.run()
+    assert benchmark.recording is None
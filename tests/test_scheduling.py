@@ -0,0 +1,89 @@
+import cnd.scheduling
+from cnd.scheduling import AIScheduler
+
+class FakeAI(object):
+    def __init__(self, name, turn_time, log, interval=1.0):
+        self.name = name
+        self.turn_time = turn_time
+        self.log = log
+        self.interval = interval
+
+    def think(self):
+        self.log.append(self.name)
+        self.turn_time += self.interval
+
+def test_only_due_ais_think():
+    log = []
+    scheduler = AIScheduler()
+    for name, turn_time in [('a', 0.5), ('b', 2.5), ('c', 1.5)]:
+        scheduler.add(FakeAI(name, turn_time, log))
+    scheduler.think(1.0)
+    assert log == ['a']
+    # a and c are both due at 1.5, and c was queued first.
+    scheduler.think(2.0)
+    assert log == ['a', 'c', 'a']
+    assert scheduler.think_count == 2
+
+def test_ties_think_in_the_order_they_were_added():
+    log = []
+    scheduler = AIScheduler()
+    for name in 'bcad':
+        scheduler.add(FakeAI(name, 0.0, log))
+    scheduler.think(0.5)
+    assert log == list('bcad')
+
+def test_ais_over_the_think_count_think_next_step():
+    log = []
+    scheduler = AIScheduler(max_think_count=2)
+    for name in 'abcd':
+        scheduler.add(FakeAI(name, 0.0, log))
+    scheduler.think(0.5)
+    assert log == ['a', 'b']
+    scheduler.think(0.5)
+    assert log == ['a', 'b', 'c', 'd']
+    scheduler.think(0.5)
+    assert scheduler.think_count == 0
+
+def test_ais_over_the_time_budget_think_next_step(monkeypatch):
+    # Each call to the timer takes one second.
+    times = iter(xrange(1000))
+    monkeypatch.setattr(cnd.scheduling, 'default_timer',
+                        lambda: float(next(times)))
+    log = []
+    scheduler = AIScheduler(max_think_count=None, time_budget=0.5)
+    for name in 'abc':
+        scheduler.add(FakeAI(name, 0.0, log))
+    # The first AI always thinks, so that every step makes progress.
+    scheduler.think(0.5)
+    assert log == ['a']
+    scheduler.think(0.5)
+    assert log == ['a', 'b']
+    scheduler.think(0.5)
+    assert log == ['a', 'b', 'c']
+
+def test_removed_ais_do_not_think():
+    log = []
+    scheduler = AIScheduler()
+    ais = [FakeAI(name, 0.0, log) for name in 'abc']
+    for ai in ais:
+        scheduler.add(ai)
+    scheduler.remove(ais[1])
+    assert len(scheduler) == 2
+    assert ais[1] not in scheduler
+    scheduler.think(0.5)
+    assert log == ['a', 'c']
+
+def test_reschedule_picks_up_changed_turn_times():
+    log = []
+    scheduler = AIScheduler()
+    ais = [FakeAI(name, 0.0, log, interval=10.0) for name in 'abc']
+    for ai in ais:
+        scheduler.add(ai)
+    scheduler.remove(ais[2])
+    ais[0].turn_time = 5.0
+    scheduler.reschedule()
+    assert len(scheduler.heap) == 2
+    scheduler.think(0.5)
+    assert log == ['b']
+    scheduler.think(5.5)
+    assert log == ['b', 'a']
@@ -0,0 +1,21 @@
+from cnd.spatial import SpatialGrid
+
+def test_query_finds_items_in_overlapping_cells():
+    grid = SpatialGrid(16.0, 16.0)
+    grid.insert('a', (0.0, 0.0, 4.0, 4.0))
+    grid.insert('b', (40.0, 40.0, 44.0, 44.0))
+    grid.insert('c', (-20.0, 10.0, 20.0, 12.0))
+    assert grid.query((1.0, 1.0, 2.0, 2.0)) == set(['a', 'c'])
+    assert grid.query((-17.0, 0.0, -16.5, 1.0)) == set(['c'])
+    assert grid.query((36.0, 36.0, 50.0, 50.0)) == set(['b'])
+    assert grid.query((100.0, 100.0, 101.0, 101.0)) == set()
+    assert len(grid) == 3
+
+def test_remove_drops_empty_cells():
+    grid = SpatialGrid(16.0, 16.0)
+    grid.insert('a', (0.0, 0.0, 20.0, 4.0))
+    assert sorted(grid.cells) == [(0, 0), (1, 0)]
+    grid.remove('a')
+    assert grid.cells == {}
+    assert len(grid) == 0
+    assert grid.query((0.0, 0.0, 20.0, 4.0)) == set()
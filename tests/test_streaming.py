@@ -0,0 +1,46 @@
+import threading
+
+from cnd.streaming import ChunkLoader, LRUCache
+
+def test_lru_cache_drops_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.get('b', 'missing') == 'missing'
+    assert len(cache) == 2
+
+def test_lru_cache_put_replaces():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('a', 2)
+    assert len(cache) == 1
+    assert cache.get('a') == 2
+
+def test_chunk_loader_loads_in_background():
+    loaded = threading.Event()
+    def load_chunk(chunk_key):
+        loaded.set()
+        return chunk_key[0] + chunk_key[1]
+    chunk_loader = ChunkLoader(load_chunk)
+    chunk_loader.start()
+    try:
+        chunk_loader.request((1, 2))
+        assert loaded.wait(5.0)
+        assert chunk_loader.get((1, 2), wait=True) == 3
+    finally:
+        chunk_loader.stop()
+
+def test_chunk_loader_put_discards_stale_load():
+    # A load that started before put() is not cached over the new chunk.
+    chunk_loader = ChunkLoader(lambda chunk_key: 'old')
+    def load_chunk(chunk_key):
+        chunk_loader.put(chunk_key, 'new')
+        return 'old'
+    chunk_loader.load_chunk = load_chunk
+    assert chunk_loader.get((0, 0), wait=True) == 'old'
+    assert chunk_loader.get((0, 0)) == 'new'
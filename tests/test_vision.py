@@ -0,0 +1,60 @@
+from random import Random
+
+import cnd.vision
+from cnd.vision import VisionSystem
+from conftest import make_tile_grid
+
+def create_vision_system(lines):
+    return VisionSystem(make_tile_grid(lines))
+
+def test_full_tiles_block_sight_and_half_tiles_do_not():
+    vision_system = create_vision_system(['   #   _   '])
+    assert not vision_system.is_clear(0.0, 0.0, 5.0, 0.0)
+    assert vision_system.is_clear(5.0, 0.0, 10.0, 0.0)
+    assert vision_system.is_clear(0.0, 0.0, 0.0, 5.0)
+
+def test_observers_see_in_front_within_range():
+    vision_system = create_vision_system([' ' * 20])
+    target = 10.0, 0.0
+    visible, distances = vision_system.update(
+        [(5.0, 0.0), (5.0, 0.0), (-5.0, 0.0)], [1, -1, 1], target, [target])
+    assert visible == [True, False, False]
+    assert distances == [5.0, 5.0, 15.0]
+    assert vision_system.ray_count == 1
+
+def test_batched_rays_match_single_ones():
+    random = Random(0)
+    vision_system = create_vision_system([
+        ''.join(random.choice('  #_/') for _ in xrange(16))
+        for _ in xrange(12)])
+    segments = [(random.uniform(-2.0, 17.0), random.uniform(-13.0, 2.0),
+                 random.uniform(-2.0, 17.0), random.uniform(-13.0, 2.0))
+                for _ in xrange(500)]
+    # Rays along the grid lines and rays of no length.
+    segments.extend([(0.0, -3.0, 12.0, -3.0), (4.0, 0.0, 4.0, -11.0),
+                     (2.5, -2.5, 9.5, -9.5), (6.0, -6.0, 6.0, -6.0)])
+    clear = [vision_system.is_clear(*segment) for segment in segments]
+    assert vision_system.are_clear(segments) == clear
+    assert True in clear and False in clear
+
+def test_batched_update_matches_single_rays():
+    random = Random(1)
+    vision_system = create_vision_system([
+        ''.join(random.choice('   #') for _ in xrange(24))
+        for _ in xrange(8)])
+    eyes = [(random.uniform(0.0, 23.0), random.uniform(-7.0, 0.0))
+            for _ in xrange(40)]
+    faces = [random.choice((-1, 1)) for _ in eyes]
+    target = 12.0, -3.5
+    target_points = [(12.0, -3.0), (12.0, -4.0), (11.6, -3.5)]
+    vision_system.min_batch_size = 0
+    batched = vision_system.update(eyes, faces, target, target_points)
+    assert vision_system.ray_count > 0
+    vision_system.min_batch_size = len(eyes) * len(target_points) + 1
+    assert vision_system.update(eyes, faces, target, target_points) == batched
+
+def test_are_clear_without_numpy(monkeypatch):
+    monkeypatch.setattr(cnd.vision, 'numpy', None)
+    vision_system = create_vision_system(['   #   _   '])
+    assert vision_system.are_clear([(0.0, 0.0, 5.0, 0.0),
+                                    (5.0, 0.0, 10.0, 0.0)]) == [False, True]